@@ -1,4 +1,4 @@
-import requests
+import httpx
 import os
 import logging
 from typing import Dict, List, Union
@@ -6,12 +6,45 @@ from starlette.datastructures import FormData
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP client pool: connections to Ash's server are kept alive and
+# reused across webhooks instead of opening one per request
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))  # seconds
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))  # seconds per request
+
 class ServerCommunicator:
     def __init__(self):
         # Ash's server URLs (single server on port 5000)
         self.layer1_server_url = os.getenv("LAYER1_SERVER_URL", "http://localhost:5000/api/layer1")
         self.layer2_server_url = os.getenv("LAYER2_SERVER_URL", "http://localhost:5000/api/layer2")
         self.rag_server_url = os.getenv("RAG_SERVER_URL", "http://localhost:5000/api/rag")
+        self.client = None
+    
+    async def start(self):
+        """Open the pooled HTTP client (called from the app lifespan)"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=HTTP_TIMEOUT
+            )
+    
+    async def close(self):
+        """Close the pooled HTTP client and its connections"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def _post(self, url: str, payload: Dict) -> httpx.Response:
+        """POST JSON through the shared client"""
+        if self.client is None:
+            # Used outside the app lifespan (scripts, tests)
+            await self.start()
+        return await self.client.post(url, json=payload)
     
     def _extract_twilio_data(self, call_data: Union[Dict, FormData], from_number: str, to_number: str) -> Dict:
         """Extract Twilio fields from call data and create proper JSON payload"""
@@ -52,11 +85,7 @@ class ServerCommunicator:
             # Extract and format Twilio data properly
             payload = self._extract_twilio_data(call_data, from_number, to_number)
             
-            response = requests.post(
-                f"{self.layer1_server_url}/check_spam",
-                json=payload,
-                timeout=10  # Increased timeout for better reliability
-            )
+            response = await self._post(f"{self.layer1_server_url}/check_spam", payload)
             
             if response.status_code == 200:
                 return response.json()
@@ -64,13 +93,13 @@ class ServerCommunicator:
                 logger.error(f"Layer 1 server error: {response.status_code} - {response.text}")
                 return {"is_spam": False, "reason": "Layer 1 server error", "confidence": 0.0, "layer": 1}
                 
-        except requests.Timeout as e:
+        except httpx.TimeoutException as e:
             logger.error(f"Layer 1 timeout error: {e}")
             return {"is_spam": False, "reason": "Layer 1 timeout", "confidence": 0.0, "layer": 1}
-        except requests.ConnectionError as e:
+        except httpx.ConnectError as e:
             logger.error(f"Layer 1 connection error: {e}")
             return {"is_spam": False, "reason": "Layer 1 connection failed", "confidence": 0.0, "layer": 1}
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Layer 1 communication error: {e}")
             return {"is_spam": False, "reason": "Layer 1 communication failed", "confidence": 0.0, "layer": 1}
         except Exception as e:
@@ -87,11 +116,7 @@ class ServerCommunicator:
             if 'threshold' not in payload:
                 payload['threshold'] = 0.5  # Base threshold for ML model
             
-            response = requests.post(
-                f"{self.layer2_server_url}/ml_check_spam",
-                json=payload,
-                timeout=10
-            )
+            response = await self._post(f"{self.layer2_server_url}/ml_check_spam", payload)
             
             if response.status_code == 200:
                 result = response.json()
@@ -103,13 +128,13 @@ class ServerCommunicator:
                 logger.error(f"Layer 2 server error: {response.status_code} - {response.text}")
                 return {"is_spam": False, "reason": "Layer 2 server error", "confidence": 0.0, "layer": 2}
                 
-        except requests.Timeout as e:
+        except httpx.TimeoutException as e:
             logger.error(f"Layer 2 timeout error: {e}")
             return {"is_spam": False, "reason": "Layer 2 timeout", "confidence": 0.0, "layer": 2}
-        except requests.ConnectionError as e:
+        except httpx.ConnectError as e:
             logger.error(f"Layer 2 connection error: {e}")
             return {"is_spam": False, "reason": "Layer 2 connection failed", "confidence": 0.0, "layer": 2}
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Layer 2 communication error: {e}")
             return {"is_spam": False, "reason": "Layer 2 communication failed", "confidence": 0.0, "layer": 2}
         except Exception as e:
@@ -125,11 +150,7 @@ class ServerCommunicator:
                 "top_k": 5
             }
             
-            response = requests.post(
-                f"{self.rag_server_url}/get_user_information", 
-                json=payload, 
-                timeout=10
-            )
+            response = await self._post(f"{self.rag_server_url}/get_user_information", payload)
             
             if response.status_code == 200:
                 return response.json()
@@ -137,7 +158,7 @@ class ServerCommunicator:
                 logger.error(f"RAG get_user_information error: {response.status_code} - {response.text}")
                 return {"results": [], "query": query, "count": 0}
                 
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"RAG get_user_information communication error: {e}")
             return {"results": [], "query": query, "count": 0}
     
@@ -150,11 +171,7 @@ class ServerCommunicator:
                 "top_k": 10
             }
             
-            response = requests.post(
-                f"{self.rag_server_url}/get_call_history", 
-                json=payload, 
-                timeout=10
-            )
+            response = await self._post(f"{self.rag_server_url}/get_call_history", payload)
             
             if response.status_code == 200:
                 return response.json()
@@ -162,7 +179,7 @@ class ServerCommunicator:
                 logger.error(f"RAG get_call_history error: {response.status_code} - {response.text}")
                 return {"results": [], "query": query, "count": 0}
                 
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"RAG get_call_history communication error: {e}")
             return {"results": [], "query": query, "count": 0}
     
@@ -178,11 +195,7 @@ class ServerCommunicator:
                 "metadata": metadata
             }
             
-            response = requests.post(
-                f"{self.rag_server_url}/post_suspect_information", 
-                json=payload, 
-                timeout=10
-            )
+            response = await self._post(f"{self.rag_server_url}/post_suspect_information", payload)
             
             if response.status_code == 200:
                 return response.json()
@@ -190,6 +203,6 @@ class ServerCommunicator:
                 logger.error(f"RAG post_suspect_information error: {response.status_code} - {response.text}")
                 return {"success": False, "message": "Server error"}
                 
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"RAG post_suspect_information communication error: {e}")
             return {"success": False, "message": "Communication failed"}
\ No newline at end of file
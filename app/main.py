@@ -3,7 +3,9 @@ from fastapi.responses import HTMLResponse, JSONResponse, Response, PlainTextRes
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import uvicorn
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
 from .twilio_handler import TwilioHandler
 from .ai_engine import ServerCommunicator
@@ -22,8 +24,10 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Spam Detection Gateway starting up...")
+    await server_communicator.start()
     yield
     # Shutdown
+    await server_communicator.close()
     logger.info("Spam Detection Gateway shutting down")
 
 app = FastAPI(title="Spam Detection Gateway", version="2.0.0", lifespan=lifespan)
@@ -63,6 +67,40 @@ def save_call_purposes(purposes):
 
 call_purposes = load_call_purposes()
 
+async def _timed(coro):
+    """Await coro, returning its result and how long it took in ms"""
+    start = time.perf_counter()
+    result = await coro
+    return result, (time.perf_counter() - start) * 1000
+
+async def run_spam_checks(from_number, to_number, form_data):
+    """
+    Run Layer 1 and Layer 2 concurrently
+    
+    A call waits for the slower of the two checks instead of both back to back.
+    If Layer 1 reports spam, Layer 2 is cancelled and its result ignored.
+    
+    Returns:
+        (layer1_result, layer2_result) - layer2_result is None when Layer 1 found spam
+    """
+    start = time.perf_counter()
+    layer1_task = asyncio.create_task(_timed(server_communicator.layer1_spam_check(from_number, to_number, form_data)))
+    layer2_task = asyncio.create_task(_timed(server_communicator.layer2_ml_check(from_number, to_number, form_data)))
+    
+    try:
+        layer1_result, layer1_ms = await layer1_task
+        if layer1_result.get('is_spam', False):
+            layer2_result, layer2_timing = None, "cancelled"
+        else:
+            layer2_result, layer2_ms = await layer2_task
+            layer2_timing = f"{layer2_ms:.0f} ms"
+    finally:
+        layer2_task.cancel()  # No-op once Layer 2 has finished
+    
+    total_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"⏱️ Spam checks for {from_number}: L1 {layer1_ms:.0f} ms, L2 {layer2_timing}, total {total_ms:.0f} ms")
+    return layer1_result, layer2_result
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "spam-detection-gateway"}
@@ -79,8 +117,8 @@ async def handle_incoming_call(request: Request):
     
     logger.info(f"📞 Incoming call: {from_number} -> {to_number} (SID: {call_sid})")
     
-    # Layer 1: Basic call number scan
-    layer1_result = await server_communicator.layer1_spam_check(from_number, to_number, form_data)
+    # Layer 1 (basic call number scan) and Layer 2 (pretrained spam ML model) run concurrently
+    layer1_result, layer2_result = await run_spam_checks(from_number, to_number, form_data)
     
     # Layer 1 returns binary results: confidence is 1.0 if spam, 0.0 if not
     if layer1_result.get('is_spam', False):
@@ -88,9 +126,6 @@ async def handle_incoming_call(request: Request):
         twiml_response = twilio_handler.reject_call("Known spam number")
         return PlainTextResponse(content=twiml_response, media_type="text/xml")
     
-    # Layer 2: Pretrained spam ML model
-    layer2_result = await server_communicator.layer2_ml_check(from_number, to_number, form_data)
-    
     # Calculate combined confidence from both layers
     # Layer 1: Binary (passed if we reach here, so confidence = 0.0)
     # Layer 2: Stochastic confidence (0.0-1.0 range from ML model)
@@ -381,8 +416,8 @@ async def handle_root_post(request: Request):
     
     logger.info(f"📞 Vapi call: {from_number} -> {to_number} (SID: {call_sid})")
     
-    # Layer 1: Check spam database (binary result)
-    layer1_result = await server_communicator.layer1_spam_check(from_number, to_number, form_data)
+    # Layer 1 (spam database, binary result) and Layer 2 (ML model) run concurrently
+    layer1_result, layer2_result = await run_spam_checks(from_number, to_number, form_data)
     
     # Layer 1 returns binary results: if spam detected, reject immediately
     if layer1_result.get('is_spam', False):
@@ -394,7 +429,6 @@ async def handle_root_post(request: Request):
     logger.info(f"✅ Layer 1 passed: {from_number} - Not in spam database")
     
     # Layer 2: ML model analysis
-    layer2_result = await server_communicator.layer2_ml_check(from_number, to_number, form_data)
     layer2_conf = layer2_result.get('confidence', 0.0) if layer2_result.get('is_spam', False) else 0.0
     
     # Route based on Layer 2 confidence
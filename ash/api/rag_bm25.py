@@ -0,0 +1,301 @@
+import heapq
+import math
+import os
+import pickle
+import re
+from array import array
+from bisect import bisect_left
+from typing import List, Dict, Any, Tuple, Iterable
+
+import numpy as np
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+# Configuration
+RAG_BM25_K1 = float(os.getenv('RAG_BM25_K1', 1.2))
+RAG_BM25_B = float(os.getenv('RAG_BM25_B', 0.75))
+
+# Postings are rewritten without deleted rows once this share of rows is deleted
+RAG_BM25_PURGE_RATIO = float(os.getenv('RAG_BM25_PURGE_RATIO', 0.2))
+
+# Words, numbers and phone numbers ("+15551234567") are kept whole
+TOKEN_PATTERN = re.compile(r'\+?\w+')
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase and split text into terms, dropping English stop words"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in ENGLISH_STOP_WORDS]
+
+class BM25Index:
+    """
+    Inverted index with BM25 scoring
+
+    Every term maps to a postings list of (row, term frequency) pairs kept in
+    ascending row order, so rows must be added in increasing order (they are
+    the document's position in LocalRAGStorage.documents). There is no
+    vocabulary cap and adding a document only touches its own terms.
+
+    Deleted rows are tombstoned and skipped at query time; postings are purged
+    of them once RAG_BM25_PURGE_RATIO of the rows are deleted.
+
+    Top-k retrieval uses MaxScore: query terms whose combined score upper
+    bound cannot lift a document into the current top k are only probed for
+    candidates found through the other terms, never scanned.
+    """
+
+    def __init__(self, k1: float = RAG_BM25_K1, b: float = RAG_BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}   # term -> (rows array, tfs array)
+        self.max_tf = {}     # term -> highest frequency ever posted, for score upper bounds
+        self.doc_freq = {}   # term -> number of live documents containing it
+        self.doc_lengths = array('I')
+        self.categories = []
+        self.deleted = set()
+        self.purged = 0      # tombstones already purged from the postings
+        self.total_length = 0
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.doc_lengths)
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lengths) - len(self.deleted)
+
+    def add(self, row: int, text: str, category: str = None):
+        """
+        Index one document
+
+        Args:
+            row: Row number of the document; must equal num_rows
+            text: Document text
+            category: Optional category used to filter searches
+        """
+        if row != self.num_rows:
+            raise ValueError(f'BM25 rows must be added in order (expected {self.num_rows}, got {row})')
+
+        tokens = tokenize(text)
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        for term, tf in frequencies.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = (array('I'), array('I'))
+                self.postings[term] = postings
+            postings[0].append(row)
+            postings[1].append(tf)
+            self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+            if tf > self.max_tf.get(term, 0):
+                self.max_tf[term] = tf
+
+        self.doc_lengths.append(len(tokens))
+        self.categories.append(category)
+        self.total_length += len(tokens)
+
+    def add_many(self, rows_and_docs: Iterable[Tuple[int, Dict[str, Any]]]):
+        """Index (row, document) pairs in row order"""
+        for row, doc in rows_and_docs:
+            self.add(row, doc['content'], doc.get('category'))
+
+    def delete(self, row: int, text: str):
+        """
+        Remove a document from search results and corpus statistics
+
+        Args:
+            row: Row number of the document
+            text: The text it was indexed with
+        """
+        if row >= self.num_rows or row in self.deleted:
+            return
+        self.deleted.add(row)
+        self.total_length -= self.doc_lengths[row]
+        for term in set(tokenize(text)):
+            if term in self.doc_freq:
+                self.doc_freq[term] -= 1
+
+        if len(self.deleted) - self.purged > RAG_BM25_PURGE_RATIO * max(1, self.num_rows):
+            self._purge_deleted()
+
+    def _purge_deleted(self):
+        """Rewrite postings lists without tombstoned rows"""
+        deleted = self.deleted
+        for term, (rows, tfs) in list(self.postings.items()):
+            kept = [(row, tf) for row, tf in zip(rows, tfs) if row not in deleted]
+            if not kept:
+                del self.postings[term]
+                self.doc_freq.pop(term, None)
+                self.max_tf.pop(term, None)
+                continue
+            self.postings[term] = (array('I', (row for row, _ in kept)), array('I', (tf for _, tf in kept)))
+        # Rows stay tombstoned so they are never returned again; their
+        # postings are gone, so only the set lookups remain
+        self.purged = len(deleted)
+
+    def search(self, query: str, top_k: int = 5, category: str = None,
+               min_score: float = 0.0, num_rows: int = None) -> List[Tuple[int, float]]:
+        """
+        Return the top_k (row, score) pairs for a query, best first
+
+        Args:
+            query: Query text
+            top_k: Number of results
+            category: Only return documents of this category
+            min_score: Only return documents scoring above this
+            num_rows: Only consider rows below this (the caller's view); rows
+                      still being added are never returned
+        """
+        num_docs = self.num_docs
+        if num_docs <= 0 or top_k <= 0:
+            return []
+
+        avg_length = self.total_length / num_docs or 1.0
+        k1, b = self.k1, self.b
+
+        # Query terms with their idf and score upper bound
+        terms = []
+        for term in set(tokenize(query)):
+            df = self.doc_freq.get(term, 0)
+            if df <= 0:
+                continue
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            rows, tfs = postings
+            max_tf = self.max_tf.get(term, 1)
+            # Document length only ever grows the denominator beyond k1 * (1 - b)
+            upper_bound = idf * max_tf * (k1 + 1) / (max_tf + k1 * (1 - b))
+            terms.append((upper_bound, idf, rows, tfs))
+        if not terms:
+            return []
+
+        # Lowest upper bound first; cumulative[i] bounds the score from terms[0..i]
+        terms.sort(key=lambda t: t[0])
+        cumulative = []
+        total = 0.0
+        for upper_bound, *_ in terms:
+            total += upper_bound
+            cumulative.append(total)
+
+        doc_lengths = self.doc_lengths
+        deleted = self.deleted
+        categories = self.categories
+        # Ignore rows added mid-query: postings are appended before the row's length and category
+        num_rows = self.num_rows if num_rows is None else min(num_rows, self.num_rows)
+        ends = [bisect_left(rows, num_rows) for _, _, rows, _ in terms]
+        positions = [0] * len(terms)
+
+        heap = []
+        threshold = min_score
+        # terms[first_essential:] must be scanned; the rest only probed
+        first_essential = 0
+        while first_essential < len(terms) and cumulative[first_essential] <= threshold:
+            first_essential += 1
+
+        while first_essential < len(terms):
+            # Next candidate: smallest current row over the essential lists
+            candidate = None
+            for i in range(first_essential, len(terms)):
+                if positions[i] < ends[i]:
+                    row = terms[i][2][positions[i]]
+                    if candidate is None or row < candidate:
+                        candidate = row
+            if candidate is None:
+                break
+
+            length_norm = k1 * (1 - b + b * doc_lengths[candidate] / avg_length)
+            score = 0.0
+            for i in range(first_essential, len(terms)):
+                if positions[i] < ends[i] and terms[i][2][positions[i]] == candidate:
+                    tf = terms[i][3][positions[i]]
+                    score += terms[i][1] * tf * (k1 + 1) / (tf + length_norm)
+                    positions[i] += 1
+
+            if candidate in deleted or (category is not None and categories[candidate] != category):
+                continue
+
+            # Probe non-essential lists, highest bound first, while they can still matter
+            for i in range(first_essential - 1, -1, -1):
+                if score + cumulative[i] <= threshold:
+                    break
+                _, idf, rows, tfs = terms[i]
+                j = bisect_left(rows, candidate, positions[i], ends[i])
+                positions[i] = j
+                if j < ends[i] and rows[j] == candidate:
+                    tf = tfs[j]
+                    score += idf * tf * (k1 + 1) / (tf + length_norm)
+
+            if score <= threshold:
+                continue
+            if len(heap) < top_k:
+                heapq.heappush(heap, (score, candidate))
+            else:
+                heapq.heapreplace(heap, (score, candidate))
+            if len(heap) == top_k:
+                threshold = max(min_score, heap[0][0])
+                while first_essential < len(terms) and cumulative[first_essential] <= threshold:
+                    first_essential += 1
+
+        return [(row, score) for score, row in sorted(heap, key=lambda item: (-item[0], item[1]))]
+
+    def score_rows(self, query: str, rows) -> np.ndarray:
+        """
+        BM25 scores of a query for specific rows (e.g. a metadata-filtered set)
+
+        Looks each ascending row up in the query terms' postings by binary
+        search, so the cost depends on the number of rows, not the corpus.
+        """
+        num_docs = self.num_docs
+        scores = np.zeros(len(rows))
+        if num_docs <= 0 or len(rows) == 0:
+            return scores
+
+        avg_length = self.total_length / num_docs or 1.0
+        k1, b = self.k1, self.b
+        for term in set(tokenize(query)):
+            df = self.doc_freq.get(term, 0)
+            if df <= 0:
+                continue
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings_rows, tfs = postings
+            position = 0
+            for i, row in enumerate(rows):
+                position = bisect_left(postings_rows, row, position)
+                if position == len(postings_rows):
+                    break
+                if postings_rows[position] == row and row not in self.deleted:
+                    tf = tfs[position]
+                    scores[i] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * self.doc_lengths[row] / avg_length))
+        return scores
+
+    def stats(self) -> Dict[str, Any]:
+        """Index size statistics"""
+        return {
+            'documents': self.num_docs,
+            'deleted': len(self.deleted),
+            'terms': len(self.postings),
+            'postings': sum(len(rows) for rows, _ in self.postings.values()),
+            'avg_length': self.total_length / self.num_docs if self.num_docs else 0.0
+        }
+
+    def save(self, path: str):
+        """Write the index atomically"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'BM25Index':
+        """Read an index written by save(), or return None"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        index = cls()
+        index.__dict__.update(state)
+        return index
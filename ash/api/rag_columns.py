@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+import tempfile
+import threading
+from array import array
+from typing import List, Dict, Any, Iterator
+
+# Configuration
+RAG_BLOB_DIR = os.getenv('RAG_BLOB_DIR', '') or None  # None = system temp directory
+
+class DocumentColumns:
+    """
+    Columnar, append-only table of RAG documents
+
+    Fixed-size fields live in packed arrays: ids, timestamps and interned
+    category codes. Title, content and compact JSON metadata of every
+    document are appended to one blob file that is read through mmap, with
+    three offsets per document. RAM per document is the array entries only;
+    the text is paged in from the blob when a row is materialized.
+
+    Rows are appended under the store's write lock and the offsets array is
+    extended last, so len() never counts a partially written row and readers
+    need no lock.
+    """
+
+    FIELDS_PER_DOC = 3  # title, content, metadata
+
+    def __init__(self, blob_dir: str = RAG_BLOB_DIR):
+        # Anonymous file: private to this instance and removed on close
+        self._blob = tempfile.TemporaryFile(prefix='rag_blob_', dir=blob_dir)
+        self._blob_size = 0
+        self._mmap = None
+        self._map_lock = threading.Lock()
+
+        self.offsets = array('Q', [0])
+        self.ids = array('q')
+        self.timestamps = array('d')
+        self.category_codes = array('I')
+        self.category_names = []
+        self._category_lookup = {}
+
+    def __len__(self) -> int:
+        return (len(self.offsets) - 1) // self.FIELDS_PER_DOC
+
+    def __getitem__(self, row: int) -> Dict[str, Any]:
+        return self.get(row)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for row in range(len(self)):
+            yield self.get(row)
+
+    def category_code(self, category: str):
+        """Interned code of a category, or None if no document has it"""
+        return self._category_lookup.get(category)
+
+    def _intern_category(self, category: str) -> int:
+        code = self._category_lookup.get(category)
+        if code is None:
+            code = len(self.category_names)
+            self.category_names.append(category)
+            self._category_lookup[category] = code
+        return code
+
+    def append_many(self, docs: List[Dict[str, Any]]):
+        """
+        Append documents with one blob write
+
+        Args:
+            docs: Dicts with id, title, content, category, metadata and timestamp
+        """
+        if not docs:
+            return
+
+        chunks = []
+        offsets = []
+        position = self._blob_size
+        for doc in docs:
+            metadata = doc.get('metadata')
+            for chunk in (
+                (doc.get('title') or '').encode('utf-8'),
+                doc['content'].encode('utf-8'),
+                json.dumps(metadata, separators=(',', ':')).encode('utf-8') if metadata else b''
+            ):
+                chunks.append(chunk)
+                position += len(chunk)
+                offsets.append(position)
+
+        self._blob.seek(self._blob_size)
+        self._blob.write(b''.join(chunks))
+        self._blob.flush()
+        self._blob_size = position
+
+        self.ids.extend(int(doc['id']) for doc in docs)
+        self.timestamps.extend(float(doc.get('timestamp') or 0.0) for doc in docs)
+        self.category_codes.extend(self._intern_category(doc.get('category') or 'general') for doc in docs)
+        # Publishes the rows
+        self.offsets.extend(offsets)
+
+    def _read(self, start: int, end: int) -> bytes:
+        """Read a byte range of the blob, remapping it if it has grown"""
+        if start == end:
+            return b''
+        mapped = self._mmap
+        if mapped is None or end > len(mapped):
+            with self._map_lock:
+                mapped = self._mmap
+                if mapped is None or end > len(mapped):
+                    # The old map stays valid for readers still holding it
+                    mapped = mmap.mmap(self._blob.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._mmap = mapped
+        return mapped[start:end]
+
+    def _field(self, row: int, field: int) -> bytes:
+        index = row * self.FIELDS_PER_DOC + field
+        return self._read(self.offsets[index], self.offsets[index + 1])
+
+    def title(self, row: int) -> str:
+        return self._field(row, 0).decode('utf-8')
+
+    def content(self, row: int) -> str:
+        return self._field(row, 1).decode('utf-8')
+
+    def metadata(self, row: int) -> Dict[str, Any]:
+        raw = self._field(row, 2)
+        return json.loads(raw) if raw else {}
+
+    def category(self, row: int) -> str:
+        return self.category_names[self.category_codes[row]]
+
+    def get(self, row: int) -> Dict[str, Any]:
+        """Materialize one row as a document dict"""
+        return {
+            'id': self.ids[row],
+            'title': self.title(row),
+            'content': self.content(row),
+            'category': self.category(row),
+            'metadata': self.metadata(row),
+            'timestamp': self.timestamps[row]
+        }
+
+    def iter_contents(self, start: int = 0, end: int = None) -> Iterator[str]:
+        """Content of rows [start, end) without materializing documents"""
+        end = len(self) if end is None else end
+        for row in range(start, end):
+            yield self.content(row)
+
+    def memory_stats(self) -> Dict[str, Any]:
+        """Resident array bytes and blob bytes, in total and per document"""
+        array_bytes = sum(
+            column.buffer_info()[1] * column.itemsize
+            for column in (self.offsets, self.ids, self.timestamps, self.category_codes)
+        )
+        count = len(self)
+        return {
+            'documents': count,
+            'array_bytes': array_bytes,
+            'blob_bytes': self._blob_size,
+            'array_bytes_per_doc': array_bytes / count if count else 0.0,
+            'blob_bytes_per_doc': self._blob_size / count if count else 0.0,
+            'categories': len(self.category_names)
+        }
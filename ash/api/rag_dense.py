@@ -0,0 +1,406 @@
+import json
+import os
+import sys
+import threading
+from typing import List, Dict, Any, Tuple, Callable
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'models'))
+from model_daemon import load_encoder
+
+# Configuration
+RAG_EMBEDDER = os.getenv('RAG_EMBEDDER', 'hashing')  # 'hashing' or a sentence-transformers model name
+RAG_DENSE_DIM = int(os.getenv('RAG_DENSE_DIM', 384))  # hashing embedder only
+RAG_DENSE_DTYPE = os.getenv('RAG_DENSE_DTYPE', 'float32').lower()  # 'float32' or 'int8'
+
+# Where the vectors live: 'memmap' (DenseIndex, a matrix file) or 'qdrant'
+# (QdrantDenseIndex, a collection of the shared vector store; see QDRANT_MODE)
+RAG_DENSE_STORE = os.getenv('RAG_DENSE_STORE', 'memmap').lower()
+
+# Brute force up to this many vectors, an IVF index above it
+RAG_DENSE_IVF_THRESHOLD = int(os.getenv('RAG_DENSE_IVF_THRESHOLD', 50000))
+RAG_DENSE_NPROBE = int(os.getenv('RAG_DENSE_NPROBE', 16))
+
+# Rows scored per chunk when brute forcing; small enough that an int8 chunk's
+# float32 copy stays in cache
+SCORE_CHUNK_ROWS = 8192
+INT8_SCALE = 127.0
+
+class HashingEmbedder:
+    """
+    Offline default embedder: hashed word uni/bigrams, L2-normalized
+
+    Needs no model download; similarity is lexical rather than semantic, but
+    it exercises the same dense index as a neural embedder.
+    """
+
+    def __init__(self, dim: int = RAG_DENSE_DIM):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+        self._vectorizer = HashingVectorizer(
+            n_features=dim, ngram_range=(1, 2), stop_words='english', alternate_sign=True, norm='l2'
+        )
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return self._vectorizer.transform(texts).toarray().astype(np.float32)
+
+class SentenceTransformerEmbedder:
+    """
+    Embedder backed by a sentence-transformers model (optional dependency)
+
+    The model daemon's copy is used when it serves model_name.
+    """
+
+    def __init__(self, model_name: str):
+        self.model = load_encoder(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=64, normalize_embeddings=True,
+                                 convert_to_numpy=True).astype(np.float32)
+
+def get_embedder(spec: str = RAG_EMBEDDER) -> Callable[[List[str]], np.ndarray]:
+    """
+    Build the embedding function named by spec
+
+    Any callable taking a list of texts and returning an (n, dim) float32
+    array of L2-normalized rows, with `dim` and `name` attributes, can be
+    passed to DenseIndex instead.
+    """
+    if spec and spec != 'hashing':
+        try:
+            return SentenceTransformerEmbedder(spec)
+        except Exception as e:
+            print(f"Warning: Could not load embedder '{spec}', using hashing embedder: {e}")
+    return HashingEmbedder()
+
+class DenseIndex:
+    """
+    Dense vector index over a memory-mapped matrix
+
+    Vectors are stored row-aligned with LocalRAGStorage documents in a
+    float32 or int8 (scalar quantized, x127) matrix file that grows by
+    doubling. Search is exact brute force until RAG_DENSE_IVF_THRESHOLD rows;
+    above it an IVF index (k-means coarse quantizer with sqrt(n)-ish lists)
+    is trained in the background and queries scan only the RAG_DENSE_NPROBE
+    nearest lists. New rows are assigned to their nearest list on insert and
+    the IVF is retrained once the corpus doubles.
+    """
+
+    def __init__(self, path: str, embedder=None, dtype: str = RAG_DENSE_DTYPE):
+        self.path = path
+        self.meta_path = path + '.json'
+        self.embedder = embedder or get_embedder()
+        self.dim = self.embedder.dim
+        self.dtype = np.int8 if dtype == 'int8' else np.float32
+        self.num_rows = 0
+        self.matrix = None
+        # Deleted rows, as a set (persisted in the metadata) and as a boolean
+        # mask that searches read without locking. Both change under
+        # _deleted_lock; a grown mask is filled in before it is published.
+        self.deleted = set()
+        self._deleted_mask = np.zeros(0, dtype=bool)
+        self._deleted_lock = threading.Lock()
+
+        # IVF state, replaced as one tuple: (centroids, lists, trained_rows).
+        # _swap_lock orders publishing new rows against swapping in a new IVF.
+        self._ivf = None
+        self._ivf_thread = None
+        self._ivf_lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+
+    # ---------- storage ----------
+
+    def _ensure_capacity(self, rows: int):
+        """Grow the matrix file (doubling) so it holds at least rows vectors"""
+        capacity = 0 if self.matrix is None else self.matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(1024, capacity)
+        while capacity < rows:
+            capacity *= 2
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        item_size = np.dtype(self.dtype).itemsize
+        with open(self.path, 'ab') as f:
+            f.truncate(capacity * self.dim * item_size)
+        # Readers holding the old map keep a valid view of the rows they know
+        self.matrix = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            return np.clip(np.rint(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors.astype(np.float32)
+
+    def load(self, total_rows: int) -> int:
+        """
+        Reuse the vectors of a previous run
+
+        Returns how many leading rows were reused; the caller embeds the rest.
+        """
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if meta.get('embedder') != self.embedder.name or meta.get('dim') != self.dim \
+                or meta.get('dtype') != np.dtype(self.dtype).name or meta.get('rows', 0) > total_rows \
+                or not os.path.exists(self.path):
+            return 0
+
+        rows = meta['rows']
+        item_size = np.dtype(self.dtype).itemsize
+        capacity = os.path.getsize(self.path) // (self.dim * item_size)
+        if capacity < rows:
+            return 0
+        self.matrix = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+        self.num_rows = rows
+        self._mark_deleted(meta.get('deleted', []))
+        return rows
+
+    def save(self):
+        """Flush the matrix and record how many rows it holds"""
+        if self.matrix is not None:
+            self.matrix.flush()
+        meta = {
+            'embedder': self.embedder.name,
+            'dim': self.dim,
+            'dtype': np.dtype(self.dtype).name,
+            'rows': self.num_rows,
+            'deleted': self._deleted_snapshot()
+        }
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def add(self, texts: List[str], categories: List[str] = None):
+        """Embed and append texts as the next rows (categories are only used by QdrantDenseIndex)"""
+        if texts:
+            self._append(self.embedder(texts))
+
+    def copy_rows(self, source: 'DenseIndex', rows: np.ndarray):
+        """Append stored vectors of another index (same embedder and dtype) as the next rows"""
+        if len(rows):
+            self._append(source._decode(source.matrix[rows]))
+
+    def _append(self, vectors: np.ndarray):
+        start = self.num_rows
+        self._ensure_capacity(start + len(vectors))
+        self.matrix[start:start + len(vectors)] = self._encode(vectors)
+
+        with self._swap_lock:
+            self.num_rows = start + len(vectors)
+            ivf = self._ivf
+            if ivf is not None:
+                centroids, lists, trained_rows = ivf
+                assignments = np.argmax(vectors @ centroids.T, axis=1)
+                lists = list(lists)
+                for cluster in np.unique(assignments):
+                    new_rows = start + np.flatnonzero(assignments == cluster)
+                    lists[cluster] = np.concatenate([lists[cluster], new_rows])
+                self._ivf = (centroids, lists, trained_rows)
+
+        if self.num_rows >= RAG_DENSE_IVF_THRESHOLD and (ivf is None or self.num_rows >= 2 * ivf[2]):
+            self._schedule_ivf()
+
+    def delete(self, row: int):
+        """Exclude a row from results"""
+        self._mark_deleted([row])
+
+    def delete_many(self, rows):
+        """Exclude rows from results"""
+        self._mark_deleted(rows)
+
+    def _mark_deleted(self, rows):
+        rows = np.asarray([int(row) for row in rows], dtype=np.int64)
+        if len(rows) == 0:
+            return
+        with self._deleted_lock:
+            self.deleted.update(rows.tolist())
+            mask = self._deleted_mask
+            if rows.max() >= len(mask):
+                grown = np.zeros(max(int(rows.max()) + 1, 2 * len(mask)), dtype=bool)
+                grown[:len(mask)] = mask
+                grown[rows] = True
+                self._deleted_mask = grown
+            else:
+                mask[rows] = True
+
+    def _deleted_snapshot(self) -> List[int]:
+        with self._deleted_lock:
+            return sorted(self.deleted)
+
+    def move(self, path: str):
+        """Rename the matrix file; open maps stay valid and the old metadata at path is dropped"""
+        if os.path.exists(path + '.json'):
+            os.remove(path + '.json')
+        os.replace(self.path, path)
+        self.path = path
+        self.meta_path = path + '.json'
+
+    # ---------- IVF ----------
+
+    def _schedule_ivf(self):
+        if self._ivf_thread is not None and self._ivf_thread.is_alive():
+            return
+        self._ivf_thread = threading.Thread(target=self.build_ivf, daemon=True)
+        self._ivf_thread.start()
+
+    def build_ivf(self, num_lists: int = None):
+        """Train the coarse quantizer over the current rows and swap the IVF in"""
+        from sklearn.cluster import MiniBatchKMeans
+
+        with self._ivf_lock:
+            try:
+                rows = self.num_rows
+                num_lists = num_lists or max(16, int(np.sqrt(rows)))
+                rng = np.random.default_rng(42)
+                sample = rng.choice(rows, size=min(rows, num_lists * 40), replace=False)
+                sample.sort()
+                kmeans = MiniBatchKMeans(n_clusters=num_lists, random_state=42, n_init=1, max_iter=20,
+                                         batch_size=4096).fit(self._decode(self.matrix[sample]))
+                centroids = kmeans.cluster_centers_.astype(np.float32)
+                centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+
+                assignments = np.empty(rows, dtype=np.int64)
+                for start in range(0, rows, SCORE_CHUNK_ROWS):
+                    chunk = self.matrix[start:min(rows, start + SCORE_CHUNK_ROWS)]
+                    assignments[start:start + len(chunk)] = np.argmax(self._score_block(chunk, centroids.T), axis=1)
+                order = np.argsort(assignments, kind='stable')
+                bounds = np.searchsorted(assignments[order], np.arange(num_lists + 1))
+                lists = [order[bounds[i]:bounds[i + 1]] for i in range(num_lists)]
+
+                with self._swap_lock:
+                    # Assign rows added while training, then swap
+                    if self.num_rows > rows:
+                        extra = np.arange(rows, self.num_rows)
+                        extra_assignments = np.argmax(
+                            self._score_block(self.matrix[rows:self.num_rows], centroids.T), axis=1
+                        )
+                        for cluster in np.unique(extra_assignments):
+                            lists[cluster] = np.concatenate([lists[cluster], extra[extra_assignments == cluster]])
+                    self._ivf = (centroids, lists, rows)
+                print(f"Dense IVF index built: {num_lists} lists over {rows} vectors")
+            except Exception as e:
+                print(f"Warning: Dense IVF build failed: {e}")
+
+    # ---------- search ----------
+
+    def _decode(self, block: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            return block.astype(np.float32) / INT8_SCALE
+        return np.asarray(block, dtype=np.float32)
+
+    def _score_block(self, block: np.ndarray, query) -> np.ndarray:
+        """Inner products of stored rows with query vector(s), dequantizing via the query"""
+        if self.dtype == np.int8:
+            return block.astype(np.float32) @ (query / INT8_SCALE)
+        return block @ query
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return self.embedder([query])[0]
+
+    def score_rows(self, query_vector: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Exact scores for specific rows"""
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._score_block(self.matrix[rows], query_vector)
+
+    def search(self, query: str, top_k: int = 5, num_rows: int = None, rows: np.ndarray = None,
+               min_score: float = 0.0, exact: bool = False, category: str = None) -> List[Tuple[int, float]]:
+        """
+        Return the top_k (row, score) pairs by inner product (cosine), best first
+
+        Args:
+            query: Query text
+            top_k: Number of results
+            num_rows: Only consider rows below this (the caller's view)
+            rows: Only consider these rows, sorted ascending. Scored exactly
+                below RAG_DENSE_IVF_THRESHOLD rows, else through the IVF probe
+            min_score: Only return rows scoring above this
+            exact: Skip the IVF index and scan every row
+            category: Category that rows were selected by (unused here)
+        """
+        num_rows = self.num_rows if num_rows is None else min(num_rows, self.num_rows)
+        matrix = self.matrix
+        if matrix is None or num_rows == 0 or top_k <= 0:
+            return []
+        query_vector = self.embed_query(query)
+        if not np.any(query_vector):
+            return []
+
+        ivf = self._ivf
+        if ivf is not None and not exact and (rows is None or len(rows) >= RAG_DENSE_IVF_THRESHOLD):
+            centroids, lists, _ = ivf
+            nprobe = min(RAG_DENSE_NPROBE, len(lists))
+            probe = np.argpartition(centroids @ query_vector, -nprobe)[-nprobe:]
+            probed = np.sort(np.concatenate([lists[i] for i in probe]))
+            probed = probed[:np.searchsorted(probed, num_rows)]
+            if rows is not None:
+                # Keep the probed rows that pass the filter
+                rows = np.asarray(rows, dtype=np.int64)
+                positions = np.minimum(np.searchsorted(rows, probed), len(rows) - 1)
+                probed = probed[rows[positions] == probed]
+                if len(probed) < top_k:
+                    probed = rows  # Too few filtered rows in the probed lists: score them all
+            rows = probed
+
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            candidate_rows = [rows]
+            candidate_scores = [self.score_rows(query_vector, rows)]
+        else:
+            candidate_rows, candidate_scores = [], []
+            for start in range(0, num_rows, SCORE_CHUNK_ROWS):
+                end = min(num_rows, start + SCORE_CHUNK_ROWS)
+                candidate_rows.append(np.arange(start, end))
+                candidate_scores.append(self._score_block(matrix[start:end], query_vector))
+
+        scores = np.concatenate(candidate_scores)
+        all_rows = np.concatenate(candidate_rows)
+        keep = scores > min_score
+        deleted_mask = self._deleted_mask
+        if len(deleted_mask):
+            known = all_rows < len(deleted_mask)
+            keep[known] &= ~deleted_mask[all_rows[known]]
+        scores, all_rows = scores[keep], all_rows[keep]
+        if len(scores) > top_k:
+            top = np.argpartition(scores, -top_k)[-top_k:]
+            scores, all_rows = scores[top], all_rows[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(all_rows[i]), float(scores[i])) for i in order]
+
+    def stats(self) -> Dict[str, Any]:
+        ivf = self._ivf
+        return {
+            'embedder': self.embedder.name,
+            'dim': self.dim,
+            'dtype': np.dtype(self.dtype).name,
+            'vectors': self.num_rows,
+            'deleted': len(self.deleted),
+            'ivf_lists': len(ivf[1]) if ivf else 0,
+            'ivf_trained_rows': ivf[2] if ivf else 0,
+            'ivf_building': self._ivf_thread is not None and self._ivf_thread.is_alive()
+        }
+
+def make_dense_index(path: str, embedder=None, dtype: str = RAG_DENSE_DTYPE, store: str = None):
+    """
+    Dense index for the configured vector store
+
+    Args:
+        path: Matrix file (memmap) or metadata path (qdrant)
+        embedder: Embedder to use (default from RAG_EMBEDDER)
+        dtype: Matrix dtype, memmap store only
+        store: 'memmap' or 'qdrant' (default RAG_DENSE_STORE)
+    """
+    store = store or RAG_DENSE_STORE
+    if store == 'qdrant':
+        # qdrant-client is only needed when selected
+        from api.rag_qdrant import QdrantDenseIndex
+        return QdrantDenseIndex(path, embedder=embedder)
+    if store != 'memmap':
+        raise ValueError(f"Unknown RAG_DENSE_STORE '{store}', expected 'memmap' or 'qdrant'")
+    return DenseIndex(path, embedder=embedder, dtype=dtype)
@@ -1,110 +1,1198 @@
 from flask import Blueprint, request, jsonify
+import fcntl
 import json
 import os
+import shutil
+import threading
 import time
-from typing import List, Dict, Any
+from collections import OrderedDict
+from typing import List, Dict, Any, NamedTuple
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import numpy as np
+from api.rag_bm25 import BM25Index
+from api.rag_columns import DocumentColumns
+from api.rag_dense import make_dense_index
 
 rag_bp = Blueprint('rag', __name__)
 
 # Configuration
 RAG_DATA_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'rag_storage.json')
 
+# Search backend: 'tfidf' (TF-IDF cosine similarity), 'bm25' (inverted index)
+# or 'dense' (embedding vectors, brute force or IVF)
+RAG_BACKEND = os.getenv('RAG_BACKEND', 'tfidf').lower()
+RAG_BACKENDS = ('tfidf', 'bm25', 'dense')
+
+# Incremental index: the vocabulary/IDF is kept stable and new documents are
+# only transformed. A full refit runs in the background when too many documents
+# were added since the last fit, too many of their terms are out of vocabulary,
+# or the refit interval has passed.
+RAG_REFIT_DOC_RATIO = float(os.getenv('RAG_REFIT_DOC_RATIO', 0.2))
+RAG_REFIT_OOV_RATIO = float(os.getenv('RAG_REFIT_OOV_RATIO', 0.3))
+RAG_REFIT_INTERVAL = float(os.getenv('RAG_REFIT_INTERVAL', 3600))
+
+# Documents per add_documents() call on the bulk ingest path
+RAG_BULK_BATCH_SIZE = int(os.getenv('RAG_BULK_BATCH_SIZE', 1000))
+
+# Results scoring at or below this cosine similarity are dropped
+RAG_MIN_SCORE = float(os.getenv('RAG_MIN_SCORE', 0.0))
+
+# Metadata fields with an exact-match hash index (value -> matrix rows)
+RAG_METADATA_INDEX_FIELDS = [
+    field.strip() for field in os.getenv('RAG_METADATA_INDEX_FIELDS', 'phone_number,user_id').split(',')
+    if field.strip()
+]
+
+# Query result cache entries (0 disables the cache)
+RAG_QUERY_CACHE_SIZE = int(os.getenv('RAG_QUERY_CACHE_SIZE', 1024))
+
+# Persistence: mutations are appended to a journal (one JSON line each) and
+# periodically compacted into the snapshot file. Compaction runs once the
+# journal holds more than RAG_COMPACT_MIN_ENTRIES entries and more than
+# RAG_COMPACT_RATIO times the snapshot's document count.
+RAG_COMPACT_MIN_ENTRIES = int(os.getenv('RAG_COMPACT_MIN_ENTRIES', 10000))
+RAG_COMPACT_RATIO = float(os.getenv('RAG_COMPACT_RATIO', 0.5))
+RAG_JOURNAL_FSYNC = os.getenv('RAG_JOURNAL_FSYNC', 'false').lower() in ('1', 'true', 'yes')
+
+# Deleted and replaced documents leave tombstoned rows behind; compaction
+# rebuilds the store without them once they exceed this share of the rows
+RAG_VACUUM_RATIO = float(os.getenv('RAG_VACUUM_RATIO', 0.2))
+
+# Retention per category in days, e.g. "call_history=30,suspects=365". Expired
+# documents are deleted on load and on adds at most every RAG_RETENTION_INTERVAL
+# seconds.
+RAG_RETENTION_DAYS = {
+    category.strip(): float(days)
+    for category, _, days in (item.partition('=') for item in os.getenv('RAG_RETENTION_DAYS', '').split(','))
+    if category.strip() and days.strip()
+}
+RAG_RETENTION_INTERVAL = float(os.getenv('RAG_RETENTION_INTERVAL', 3600))
+
+class QueryResultCache:
+    """
+    Bounded LRU cache of search results
+    
+    Every entry is tagged with the store generation it was computed at. The
+    store bumps its generation on every write, so an entry from an older
+    generation is treated as a miss and dropped rather than served.
+    """
+    
+    def __init__(self, max_size: int = RAG_QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, generation: int):
+        """Return cached results for key at this generation, or None"""
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+    
+    def put(self, key, generation: int, results: List[Dict[str, Any]]):
+        """Store results computed at a generation, evicting the least recently used"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generation, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+class SearchView(NamedTuple):
+    """
+    Index state a search runs against
+    
+    Writers build a new view and publish it with a single assignment. The
+    row count, vectorizer, matrix, category arrays and tombstones are
+    replaced, never mutated, once published, so a search that reads the
+    view once sees a matching set of them for its whole duration without
+    taking a lock. Compaction swaps in a whole new row layout the same way.
+    
+    The document columns, BM25/dense index, metadata_index and id_rows are
+    shared by every view of a layout and mutated in place by the writer:
+    rows are only appended to the first three, and id_rows always maps an
+    id to its newest row, possibly one not published yet. Readers therefore
+    bound every row they take from them by the view's num_rows and
+    deleted_rows.
+    """
+    generation: int
+    num_rows: int
+    vectorizer: Any
+    vectors: Any
+    category_rows: Dict[str, np.ndarray]            # live rows only
+    documents: DocumentColumns
+    index: Any                                      # BM25Index or dense index, None for tfidf
+    metadata_index: Dict[str, Dict[str, List[int]]] # shared; may list tombstoned or unpublished rows
+    id_rows: Dict[int, int]                         # shared; live document id -> newest row
+    deleted_rows: np.ndarray                        # sorted tombstoned rows
+
+class RAGStorageReadOnly(RuntimeError):
+    """Another process owns the store; writes must go to that process"""
+
 # In-memory storage for RAG documents
 class LocalRAGStorage:
-    def __init__(self):
-        self.documents = []
-        self.vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-        self.document_vectors = None
-        self.load_data()
+    """
+    Local document store with TF-IDF, BM25 or dense search
+    
+    Documents keep a stable id. Deleting one tombstones its row and updating
+    one tombstones the old row and appends the new version under the same id.
+    Searches skip tombstoned rows; compaction drops them by rebuilding the
+    documents, indexes and vectors from the live rows once they exceed
+    RAG_VACUUM_RATIO. Categories listed in RAG_RETENTION_DAYS are expired
+    through the same delete path.
+    
+    Concurrency: writers (adds, deletes, refit swaps, compaction hand-off)
+    serialize on _write_lock. Readers take no lock: within a layout rows are
+    only appended, so rows below a published view's num_rows are stable, and
+    every search pins the SearchView it started with. A refit or compaction
+    builds its index off-lock and only takes the lock to catch up and
+    publish it.
+    
+    Processes: each one searches its own in-memory copy and the BM25/dense
+    files are laid out by the process that writes them, so a store has a
+    single writer. The process holding an exclusive fcntl lock on
+    data_file + '.owner' for its lifetime owns the store; in any other
+    process writes raise RAGStorageReadOnly until the owner exits, at
+    which point the next write takes ownership and reloads from disk. The
+    app runs the store in one process (RAG_STORE_URL, rag-store.service).
+    Journal appends, rotation and snapshot writes additionally take a short
+    lock on data_file + '.lock', which also records the last sequence
+    number, so a new owner never interleaves with the old one's last writes.
+    """
+    
+    def __init__(self, data_file: str = None, backend: str = None):
+        self.data_file = data_file or RAG_DATA_FILE
+        self.journal_file = self.data_file + '.journal'
+        self.lock_file = self.data_file + '.lock'
+        self.owner_file = self.data_file + '.owner'
+        self.backend = backend or RAG_BACKEND
+        if self.backend not in RAG_BACKENDS:
+            raise ValueError(f"Unknown RAG backend '{self.backend}', expected one of {RAG_BACKENDS}")
+        self.bm25_file = self.data_file + '.bm25'
+        self.dense_file = self.data_file + '.dense'
+        
+        self.query_cache = QueryResultCache()
+        # Published search state; its generation is bumped by every change that
+        # can alter search results
+        self._view = self._empty_view()
+        self._next_id = 0
         
+        # Drift tracking since the last full fit
+        self._write_lock = threading.Lock()
+        self._refit_thread = None
+        self._last_refit = 0.0
+        self._docs_since_refit = 0
+        self._tokens_since_refit = 0
+        self._oov_tokens_since_refit = 0
+        self._last_retention = 0.0
+        
+        # Journal state: every mutation gets a sequence number; the snapshot
+        # records the last one it includes
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._snapshot_docs = 0
+        self._journal_entries = 0
+        self._compact_thread = None
+        self._bytes_written = 0
+        
+        # Held for as long as this process owns the store
+        self._owner = None
+        self._owner_lock = threading.Lock()
+        if not self._acquire_owner():
+            print(f"RAG storage {self.data_file} is owned by another process; this copy is read-only")
+        
+        self.load_data()
+    
+    @property
+    def documents(self) -> DocumentColumns:
+        """Rows of the current layout, tombstoned ones included"""
+        return self._view.documents
+    
+    @property
+    def document_count(self) -> int:
+        """Number of live documents"""
+        view = self._view
+        return view.num_rows - len(view.deleted_rows)
+    
+    @property
+    def vectorizer(self) -> TfidfVectorizer:
+        return self._view.vectorizer
+    
+    @property
+    def document_vectors(self):
+        return self._view.vectors
+    
+    @property
+    def generation(self) -> int:
+        return self._view.generation
+    
+    @staticmethod
+    def _empty_view() -> SearchView:
+        return SearchView(
+            generation=0,
+            num_rows=0,
+            vectorizer=TfidfVectorizer(max_features=1000, stop_words='english'),
+            vectors=None,
+            category_rows={},
+            documents=DocumentColumns(),
+            index=None,
+            metadata_index={field: {} for field in RAG_METADATA_INDEX_FIELDS},
+            id_rows={},
+            deleted_rows=np.empty(0, dtype=np.int64)
+        )
+    
+    def _publish(self, **changes):
+        """Swap in a new search view (call with the write lock held, or during load)"""
+        self._view = self._view._replace(generation=self._view.generation + 1, **changes)
+    
+    def _file_lock(self):
+        """Open and flock the sidecar lock file (close it to release the lock)"""
+        os.makedirs(os.path.dirname(self.lock_file) or '.', exist_ok=True)
+        lock = open(self.lock_file, 'a+')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+    
+    @staticmethod
+    def _locked_seq(lock) -> int:
+        """Last sequence number recorded in the lock file"""
+        lock.seek(0)
+        try:
+            return int(lock.read().strip() or 0)
+        except ValueError:
+            return 0
+    
+    @staticmethod
+    def _record_seq(lock, seq: int):
+        """Record the last sequence number handed out in the lock file"""
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(seq))
+        lock.flush()
+    
+    def _acquire_owner(self) -> bool:
+        """Take ownership of the store if no other process holds it"""
+        os.makedirs(os.path.dirname(self.owner_file) or '.', exist_ok=True)
+        owner = open(self.owner_file, 'a+')
+        try:
+            fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner.close()
+            return False
+        owner.seek(0)
+        owner.truncate()
+        owner.write(str(os.getpid()))
+        owner.flush()
+        self._owner = owner
+        return True
+    
+    @property
+    def is_owner(self) -> bool:
+        return self._owner is not None
+    
+    def _require_owner(self):
+        """Raise RAGStorageReadOnly unless this process owns the store, taking it over if it was released"""
+        if self._owner is not None:
+            return
+        with self._owner_lock:
+            if self._owner is not None:
+                return
+            if not self._acquire_owner():
+                raise RAGStorageReadOnly(
+                    f"RAG storage {self.data_file} is owned by another process; send writes to it "
+                    f"(RAG_STORE_URL) or run a single process"
+                )
+            # The previous owner may have written since this copy loaded
+            print(f"RAG storage {self.data_file}: took over ownership, reloading")
+            self.load_data()
+    
+    def close(self):
+        """Wait for background work and give up ownership of the store"""
+        for thread in (self._refit_thread, self._compact_thread):
+            if thread is not None:
+                thread.join()
+        with self._owner_lock:
+            if self._owner is not None:
+                self._owner.close()
+                self._owner = None
+    
     def load_data(self):
-        """Load existing data from file"""
+        """Load the snapshot and replay the journal on top of it"""
         try:
-            if os.path.exists(RAG_DATA_FILE):
-                with open(RAG_DATA_FILE, 'r') as f:
-                    data = json.load(f)
-                    self.documents = data.get('documents', [])
-                    if self.documents:
-                        self._update_vectors()
+            with self._file_lock() as lock:
+                # A compaction interrupted before it finished leaves its rotated journal behind
+                interrupted = os.path.exists(self.journal_file + '.compacting')
+                documents, id_rows, deleted, next_id = self._read_storage()
+                self._seq = max(self._seq, self._locked_seq(lock))
+                self._next_id = max([next_id] + [doc['id'] + 1 for doc in documents])
+                
+                columns = DocumentColumns()
+                columns.append_many(documents)
+                metadata_index = {field: {} for field in RAG_METADATA_INDEX_FIELDS}
+                self._index_metadata(metadata_index, documents, 0)
+                deleted_rows = np.array(sorted(deleted), dtype=np.int64)
+                self._publish(
+                    num_rows=len(documents),
+                    category_rows=self._live_category_rows(columns, deleted_rows),
+                    documents=columns,
+                    metadata_index=metadata_index,
+                    id_rows=id_rows,
+                    deleted_rows=deleted_rows
+                )
+                if interrupted and self.is_owner:
+                    # Fold it into a snapshot now; nothing else ever removes it
+                    print("RAG storage: folding an interrupted compaction into the snapshot")
+                    self._fold_journal()
+            # Only the columnar copy is kept
+            del documents
+            if self.backend == 'bm25':
+                self._publish(index=self._load_bm25())
+            elif self.backend == 'dense':
+                self._publish(index=self._load_dense())
+            elif self.documents:
+                self._update_vectors()
         except Exception as e:
             print(f"Warning: Could not load RAG data: {e}")
-            self.documents = []
+            self._view = self._empty_view()
+            if self.backend == 'bm25':
+                self._view = self._view._replace(index=BM25Index())
+            elif self.backend == 'dense':
+                self._view = self._view._replace(index=make_dense_index(self.dense_file))
+        
+        self.apply_retention()
+    
+    def _read_storage(self):
+        """
+        Read the snapshot and replay the journal into plain document lists (file lock held)
+        
+        Returns:
+            Documents, id -> row map, tombstoned rows and the snapshot's next id
+        """
+        documents = []
+        deleted = set()
+        next_id = 0
+        if os.path.exists(self.data_file):
+            with open(self.data_file, 'r') as f:
+                data = json.load(f)
+            documents = data.get('documents', [])
+            deleted = set(data.get('deleted_rows', []))
+            next_id = data.get('next_id', 0)
+            self._snapshot_seq = data.get('seq', 0)
+        self._snapshot_docs = len(documents)
+        self._seq = self._snapshot_seq
+        
+        # Deleted and replaced rows stay in place as tombstones, so rows
+        # line up with the persisted BM25/dense indexes
+        id_rows = {doc['id']: row for row, doc in enumerate(documents) if row not in deleted}
+        
+        self._journal_entries = 0
+        for path in (self.journal_file + '.compacting', self.journal_file):
+            for entry in self._read_journal(path):
+                if entry['seq'] <= self._snapshot_seq:
+                    continue
+                self._apply_entry(documents, id_rows, deleted, entry)
+                self._seq = entry['seq']
+                self._journal_entries += 1
+        return documents, id_rows, deleted, next_id
+    
+    def _load_bm25(self) -> BM25Index:
+        """Load the persisted BM25 index, index any documents it is missing and apply tombstones"""
+        documents = self.documents
+        index = None
+        try:
+            index = BM25Index.load(self.bm25_file)
+        except Exception as e:
+            print(f"Warning: Could not load BM25 index, rebuilding: {e}")
+        if index is None or index.num_rows > len(documents):
+            index = BM25Index()
+        for row in range(index.num_rows, len(documents)):
+            index.add(row, documents.content(row), documents.category(row))
+        for row in self._view.deleted_rows.tolist():
+            index.delete(row, documents.content(row))
+        return index
+    
+    def _load_dense(self):
+        """Reuse persisted dense vectors, embed any documents they are missing and apply tombstones"""
+        documents = self.documents
+        index = make_dense_index(self.dense_file)
+        start = index.load(len(documents))
+        for batch_start in range(start, len(documents), RAG_BULK_BATCH_SIZE):
+            batch_end = min(len(documents), batch_start + RAG_BULK_BATCH_SIZE)
+            index.add(list(documents.iter_contents(batch_start, batch_end)),
+                      [documents.category(row) for row in range(batch_start, batch_end)])
+        index.delete_many(self._view.deleted_rows.tolist())
+        return index
+    
+    def _save_indexes(self):
+        """Persist the BM25 or dense index (takes the write lock so it isn't mutated mid-write)"""
+        with self._write_lock:
+            index = self._view.index
+            if self.backend == 'bm25':
+                index.save(self.bm25_file)
+            elif self.backend == 'dense':
+                index.save()
+    
+    def _read_journal(self, path: str):
+        """Yield journal entries, truncating a torn final line left by a crash"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r+b') as f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('unterminated line')
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"Warning: Dropping incomplete journal entry in {path}")
+                    f.truncate(offset)
+                    return
+                offset += len(line)
+                yield entry
+    
+    def _apply_entry(self, documents: List[Dict[str, Any]], id_rows: Dict[int, int], deleted: set,
+                     entry: Dict[str, Any]):
+        """Apply one journal entry to a document list, tombstoning deleted and replaced rows"""
+        if entry['op'] in ('delete', 'update'):
+            doc_id = entry['id'] if entry['op'] == 'delete' else entry['doc']['id']
+            row = id_rows.pop(doc_id, None)
+            if row is not None:
+                deleted.add(row)
+        if entry['op'] in ('add', 'update'):
+            id_rows[entry['doc']['id']] = len(documents)
+            documents.append(entry['doc'])
+    
+    def _append_journal(self, entries: List[Dict[str, Any]]):
+        """Append mutations to the journal with one write (call with the write lock held)"""
+        try:
+            with self._file_lock() as lock:
+                # Sequence numbers continue from the last one any process handed out
+                self._seq = max(self._seq, self._locked_seq(lock))
+                lines = []
+                for entry in entries:
+                    self._seq += 1
+                    lines.append(json.dumps({'seq': self._seq, **entry}, separators=(',', ':')))
+                payload = '\n'.join(lines) + '\n'
+                with open(self.journal_file, 'a') as f:
+                    f.write(payload)
+                    if RAG_JOURNAL_FSYNC:
+                        f.flush()
+                        os.fsync(f.fileno())
+                self._record_seq(lock, self._seq)
+            self._journal_entries += len(entries)
+            self._bytes_written += len(payload)
+        except Exception as e:
+            print(f"Warning: Could not append to RAG journal: {e}")
+        
+        view = self._view
+        if self._journal_entries > max(RAG_COMPACT_MIN_ENTRIES, RAG_COMPACT_RATIO * self._snapshot_docs) or \
+                len(view.deleted_rows) > RAG_VACUUM_RATIO * max(1, view.num_rows):
+            self._schedule_compaction()
+    
+    def _schedule_compaction(self):
+        """Start a background compaction unless one is already running (write lock held)"""
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+        
+        # Rotate the journal so new writes go to a fresh file during compaction.
+        # A compaction that failed left its rotation behind; the journal is
+        # appended to it and this compaction covers both.
+        try:
+            with self._file_lock():
+                rotated = self.journal_file + '.compacting'
+                if not os.path.exists(rotated):
+                    os.replace(self.journal_file, rotated)
+                elif os.path.exists(self.journal_file):
+                    with open(self.journal_file, 'rb') as src, open(rotated, 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(self.journal_file)
+        except OSError as e:
+            print(f"Warning: Could not rotate RAG journal: {e}")
+            return
+        
+        # Rows are append-only within a layout, so the first `count` rows and
+        # the current tombstones are this snapshot. Past the vacuum ratio the
+        # tombstoned rows are dropped first instead of written out.
+        view = self._view
+        count = view.num_rows
+        vacuum = len(view.deleted_rows) > RAG_VACUUM_RATIO * max(1, count)
+        seq = self._seq
+        self._journal_entries = 0
+        self._compact_thread = threading.Thread(
+            target=self._compact, args=(count, seq, view.deleted_rows, vacuum), daemon=True
+        )
+        self._compact_thread.start()
+    
+    def _write_snapshot(self, count: int, seq: int, deleted_rows: np.ndarray):
+        """Write the first count rows and their tombstones as a compact snapshot, atomically via rename (file lock held)"""
+        os.makedirs(os.path.dirname(self.data_file) or '.', exist_ok=True)
+        tmp_path = self.data_file + '.tmp'
+        documents = self.documents
+        with open(tmp_path, 'w') as f:
+            # Streamed row by row so no full document list is materialized
+            f.write('{"seq":%d,"next_id":%d,"deleted_rows":%s,"documents":[' % (
+                seq, self._next_id, json.dumps(deleted_rows.tolist())
+            ))
+            for row in range(count):
+                if row:
+                    f.write(',')
+                f.write(json.dumps(documents.get(row), separators=(',', ':')))
+            f.write(']}')
+            f.flush()
+            os.fsync(f.fileno())
+            self._bytes_written += f.tell()
+        os.replace(tmp_path, self.data_file)
+        self._snapshot_seq = seq
+        self._snapshot_docs = count
+    
+    def _fold_journal(self):
+        """Write the whole published view as the snapshot and drop both journals (write and file locks held)"""
+        view = self._view
+        self._write_snapshot(view.num_rows, self._seq, view.deleted_rows)
+        for path in (self.journal_file + '.compacting', self.journal_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self._journal_entries = 0
+    
+    def _compact(self, count: int, seq: int, deleted_rows: np.ndarray, vacuum: bool = False):
+        """Fold the rotated journal into a new snapshot, dropping tombstoned rows first if asked"""
+        try:
+            if vacuum:
+                count, seq, deleted_rows = self._vacuum()
+            with self._file_lock():
+                self._write_snapshot(count, seq, deleted_rows)
+                os.remove(self.journal_file + '.compacting')
+            self._save_indexes()
+            print(f"RAG storage compacted: {count} documents")
+        except Exception as e:
+            print(f"Warning: RAG compaction failed: {e}")
+    
+    def _vacuum(self):
+        """
+        Rebuild the documents, indexes and vectors from the live rows and swap them in
+        
+        Live rows are copied off-lock. Under the write lock, rows added since
+        are copied too and rows deleted since are tombstoned in the new layout
+        before it is published. Readers holding the old view keep using the
+        old columns and indexes.
+        
+        Returns:
+            Row count, journal sequence and tombstoned rows of the new layout
+        """
+        view = self._view
+        base = view.num_rows
+        live = np.setdiff1d(np.arange(base), view.deleted_rows)
+        
+        documents = DocumentColumns()
+        metadata_index = {field: {} for field in RAG_METADATA_INDEX_FIELDS}
+        index = None
+        if self.backend == 'bm25':
+            index = BM25Index()
+        elif self.backend == 'dense':
+            index = make_dense_index(self.dense_file + '.compacting', embedder=view.index.embedder,
+                                     dtype=np.dtype(view.index.dtype).name)
+        self._copy_rows(view, live, documents, metadata_index, index)
+        
+        with self._write_lock:
+            current = self._view
+            tail = np.setdiff1d(np.arange(base, current.num_rows), current.deleted_rows)
+            self._copy_rows(current, tail, documents, metadata_index, index)
+            kept = np.concatenate([live, tail])
+            new_rows = np.full(current.num_rows, -1, dtype=np.int64)
+            new_rows[kept] = np.arange(len(kept))
+            
+            # The persisted index files describe the old layout
+            if self.backend == 'bm25' and os.path.exists(self.bm25_file):
+                os.remove(self.bm25_file)
+            elif self.backend == 'dense':
+                index.move(self.dense_file)
+            
+            vacuumed = current._replace(
+                generation=current.generation + 1,
+                num_rows=len(kept),
+                vectors=current.vectors[kept] if current.vectors is not None else None,
+                category_rows=self._live_category_rows(documents, np.empty(0, dtype=np.int64)),
+                documents=documents,
+                index=index,
+                metadata_index=metadata_index,
+                id_rows={doc_id: int(new_rows[row]) for doc_id, row in current.id_rows.items()},
+                deleted_rows=np.empty(0, dtype=np.int64)
+            )
+            # Rows deleted while copying
+            late = new_rows[current.deleted_rows]
+            late = late[late >= 0]
+            if len(late):
+                vacuumed = vacuumed._replace(**self._delete_rows(vacuumed, late))
+            self._view = vacuumed
+            seq = self._seq
+        
+        print(f"RAG storage vacuumed: {current.num_rows - len(kept)} tombstoned rows dropped")
+        return vacuumed.num_rows, seq, vacuumed.deleted_rows
+    
+    def _copy_rows(self, source: SearchView, rows: np.ndarray, documents: DocumentColumns,
+                   metadata_index: Dict[str, Dict[str, List[int]]], index):
+        """Append rows of a view to new document columns, metadata index and BM25/dense index"""
+        for start in range(0, len(rows), RAG_BULK_BATCH_SIZE):
+            batch = rows[start:start + RAG_BULK_BATCH_SIZE]
+            docs = [source.documents.get(row) for row in batch.tolist()]
+            first_row = len(documents)
+            documents.append_many(docs)
+            self._index_metadata(metadata_index, docs, first_row)
+            if self.backend == 'bm25':
+                index.add_many(enumerate(docs, start=first_row))
+            elif self.backend == 'dense':
+                index.copy_rows(source.index, batch)
     
     def save_data(self):
-        """Save data to file"""
+        """Compact everything into the snapshot now"""
+        self._require_owner()
         try:
-            os.makedirs(os.path.dirname(RAG_DATA_FILE), exist_ok=True)
-            with open(RAG_DATA_FILE, 'w') as f:
-                json.dump({'documents': self.documents}, f, indent=2)
+            if self._compact_thread is not None:
+                self._compact_thread.join()
+            with self._write_lock, self._file_lock():
+                self._fold_journal()
+            self._save_indexes()
         except Exception as e:
             print(f"Warning: Could not save RAG data: {e}")
     
+    def persistence_stats(self) -> Dict[str, Any]:
+        """Journal, snapshot, tombstone and retention status"""
+        view = self._view
+        return {
+            'snapshot_documents': self._snapshot_docs,
+            'snapshot_seq': self._snapshot_seq,
+            'journal_entries': self._journal_entries,
+            'seq': self._seq,
+            'bytes_written': self._bytes_written,
+            'compaction_running': self._compact_thread is not None and self._compact_thread.is_alive(),
+            'rows': view.num_rows,
+            'tombstones': len(view.deleted_rows),
+            'retention_days': RAG_RETENTION_DAYS,
+            'last_retention': self._last_retention
+        }
+    
+    def _index_categories(self, docs: List[Dict[str, Any]], first_row: int,
+                          category_rows: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Return a copy of category_rows with the rows of newly stored documents appended"""
+        category_rows = dict(category_rows)
+        new_rows = {}
+        for offset, doc in enumerate(docs):
+            new_rows.setdefault(doc.get('category'), []).append(first_row + offset)
+        for category, rows in new_rows.items():
+            existing = category_rows.get(category)
+            rows = np.asarray(rows, dtype=np.int64)
+            category_rows[category] = rows if existing is None else np.concatenate([existing, rows])
+        return category_rows
+    
+    @staticmethod
+    def _live_category_rows(documents: DocumentColumns, deleted_rows: np.ndarray) -> Dict[str, np.ndarray]:
+        """Ascending rows of every category, from the category codes, without tombstoned rows"""
+        codes = np.array(documents.category_codes, dtype=np.int64)
+        codes[deleted_rows] = -1
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(documents.category_names) + 1))
+        return {
+            category: order[bounds[code]:bounds[code + 1]]
+            for code, category in enumerate(documents.category_names)
+            if bounds[code + 1] > bounds[code]
+        }
+    
+    def _index_metadata(self, metadata_index: Dict[str, Dict[str, List[int]]],
+                        docs: List[Dict[str, Any]], first_row: int):
+        """Add the rows of newly stored documents to the metadata hash indexes"""
+        for field, index in metadata_index.items():
+            for offset, doc in enumerate(docs):
+                value = (doc.get('metadata') or {}).get(field)
+                if value is not None:
+                    index.setdefault(str(value), []).append(first_row + offset)
+    
+    def _filter_rows(self, view: SearchView, category: str = None, metadata: Dict[str, Any] = None):
+        """
+        Live rows of a view matching a category and exact metadata values
+        
+        Indexed metadata fields are resolved through their hash index and the
+        smallest candidate set is checked against the remaining conditions.
+        Returns None when there is nothing to filter on.
+        """
+        metadata = metadata or {}
+        if not category and not metadata:
+            return None
+        limit = view.num_rows
+        
+        candidates = None
+        for field, value in metadata.items():
+            if field in view.metadata_index:
+                rows = view.metadata_index[field].get(str(value), ())
+                if candidates is None or len(rows) < len(candidates):
+                    candidates = rows
+        
+        if candidates is None:
+            if category and category in view.category_rows:
+                rows = view.category_rows[category]
+                rows = rows[:np.searchsorted(rows, limit)]
+                if not metadata:
+                    return rows
+                candidates = rows
+            elif category:
+                return np.empty(0, dtype=np.int64)
+            else:
+                # No index covers the filter: scan
+                candidates = range(limit)
+        
+        documents = view.documents
+        category_code = documents.category_code(category) if category else None
+        if category and category_code is None:
+            return np.empty(0, dtype=np.int64)
+        matched = []
+        for row in candidates:
+            if row >= limit:
+                break
+            if category and documents.category_codes[row] != category_code:
+                continue
+            doc_metadata = documents.metadata(row)
+            if all(str(doc_metadata.get(field)) == str(value) for field, value in metadata.items()):
+                matched.append(row)
+        matched = np.asarray(matched, dtype=np.int64)
+        if len(view.deleted_rows):
+            matched = matched[~np.isin(matched, view.deleted_rows)]
+        return matched
+    
+    def lookup(self, metadata: Dict[str, Any], category: str = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Documents matching metadata values exactly, newest first
+        
+        Args:
+            metadata: Field/value pairs that must all match
+            category: Optional category filter
+            limit: Maximum documents returned
+        """
+        view = self._view
+        rows = self._filter_rows(view, category, metadata)
+        if rows is None:
+            return []
+        return [view.documents.get(row) for row in rows[::-1][:limit]]
+    
+    def get_document(self, doc_id: int) -> Dict[str, Any]:
+        """Current version of a document by id, or None"""
+        view = self._view
+        # The newest version, even if its row is not published yet: columns
+        # are appended before id_rows points at them, and a vacuum gives the
+        # new layout its own id_rows
+        row = view.id_rows.get(doc_id)
+        return None if row is None else view.documents.get(row)
+    
+    def _fit_index(self, texts: List[str]):
+        """Fit a new vectorizer and vectorize texts with it"""
+        vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
+        return vectorizer, vectorizer.fit_transform(texts)
+    
     def _update_vectors(self):
-        """Update document vectors for similarity search"""
+        """Refit the vocabulary/IDF over every stored document"""
         if self.documents:
-            texts = [doc['content'] for doc in self.documents]
-            self.document_vectors = self.vectorizer.fit_transform(texts)
+            texts = list(self.documents.iter_contents())
+            vectorizer, vectors = self._fit_index(texts)
+            self._publish(vectorizer=vectorizer, vectors=vectors)
+            self._reset_drift()
+    
+    def _reset_drift(self):
+        self._last_refit = time.time()
+        self._docs_since_refit = 0
+        self._tokens_since_refit = 0
+        self._oov_tokens_since_refit = 0
+    
+    def _needs_refit(self) -> bool:
+        """Check whether the stable vocabulary has drifted too far from the corpus"""
+        if self._docs_since_refit == 0:
+            return False
+        if self._docs_since_refit > RAG_REFIT_DOC_RATIO * max(1, len(self.documents)):
+            return True
+        if self._tokens_since_refit and \
+                self._oov_tokens_since_refit / self._tokens_since_refit > RAG_REFIT_OOV_RATIO:
+            return True
+        return time.time() - self._last_refit > RAG_REFIT_INTERVAL
+    
+    def _schedule_refit(self):
+        """Start a background full refit unless one is already running"""
+        if self._refit_thread is not None and self._refit_thread.is_alive():
+            return
+        self._refit_thread = threading.Thread(target=self._background_refit, daemon=True)
+        self._refit_thread.start()
+    
+    def _background_refit(self):
+        """
+        Refit the vocabulary/IDF off the request path
+        
+        Searches keep using the current vectorizer/matrix while the new one is
+        built. Documents added during the refit are transformed with the new
+        vectorizer before the pair is swapped in under the write lock. A refit
+        that overlapped a compaction is discarded, its rows no longer match.
+        """
+        try:
+            documents = self.documents
+            snapshot_size = len(documents)
+            texts = list(documents.iter_contents(0, snapshot_size))
+            vectorizer, vectors = self._fit_index(texts)
+            
+            with self._write_lock:
+                if self.documents is not documents:
+                    print("RAG index refit discarded: storage was compacted meanwhile")
+                    return
+                if len(documents) > snapshot_size:
+                    added = list(documents.iter_contents(snapshot_size))
+                    vectors = sparse.vstack([vectors, vectorizer.transform(added)], format='csr')
+                self._publish(vectorizer=vectorizer, vectors=vectors)
+                self._reset_drift()
+            print(f"RAG index refit over {vectors.shape[0]} documents")
+        except Exception as e:
+            print(f"Warning: RAG index refit failed: {e}")
+    
+    def index_stats(self) -> Dict[str, Any]:
+        """Drift and refit status of the incremental index"""
+        view = self._view
+        if self.backend in ('bm25', 'dense'):
+            return {
+                'backend': self.backend,
+                **view.index.stats(),
+                'categories': {category: len(rows) for category, rows in view.category_rows.items()},
+                'metadata_values': {field: len(values) for field, values in view.metadata_index.items()}
+            }
+        return {
+            'backend': 'tfidf',
+            'vocabulary_size': len(getattr(view.vectorizer, 'vocabulary_', {})),
+            'docs_since_refit': self._docs_since_refit,
+            'oov_ratio_since_refit': (self._oov_tokens_since_refit / self._tokens_since_refit
+                                      if self._tokens_since_refit else 0.0),
+            'last_refit': self._last_refit,
+            'categories': {category: len(rows) for category, rows in view.category_rows.items()},
+            'metadata_values': {field: len(values) for field, values in view.metadata_index.items()},
+            'refit_running': self._refit_thread is not None and self._refit_thread.is_alive()
+        }
     
     def add_document(self, title: str, content: str, category: str = 'general', metadata: Dict = None):
         """Add a document to the storage"""
-        doc = {
-            'id': len(self.documents),
+        return self.add_documents([{
             'title': title,
             'content': content,
             'category': category,
-            'metadata': metadata or {},
-            'timestamp': time.time()
+            'metadata': metadata
+        }])[0]
+    
+    def add_documents(self, documents: List[Dict[str, Any]]) -> List[int]:
+        """
+        Add a batch of documents with one vector update and one save
+        
+        Args:
+            documents: Dicts with content and optional title, category, metadata
+                       and timestamp (epoch seconds, defaults to now)
+        
+        Returns:
+            Ids of the added documents
+        """
+        if not documents:
+            return []
+        self._require_owner()
+        
+        with self._write_lock:
+            now = time.time()
+            docs = []
+            for document in documents:
+                docs.append({
+                    'id': self._next_id,
+                    'title': document.get('title', ''),
+                    'content': document['content'],
+                    'category': document.get('category') or 'general',
+                    'metadata': document.get('metadata') or {},
+                    'timestamp': float(document.get('timestamp') or now)
+                })
+                self._next_id += 1
+            
+            # Documents are stored before the view that exposes them is
+            # published; publishing also invalidates cached results
+            self._publish(**self._append_docs(self._view, docs))
+            
+            if self.backend == 'tfidf' and self._needs_refit():
+                self._schedule_refit()
+            
+            self._append_journal([{'op': 'add', 'doc': doc} for doc in docs])
+            
+            if RAG_RETENTION_DAYS and now - self._last_retention > RAG_RETENTION_INTERVAL:
+                self._expire(now)
+        
+        return [doc['id'] for doc in docs]
+    
+    def _append_docs(self, view: SearchView, docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Store and index documents, returning the view changes that expose them (write lock held)"""
+        documents = view.documents
+        vectorizer, vectors = view.vectorizer, view.vectors
+        first_row = len(documents)
+        if self.backend == 'bm25':
+            documents.append_many(docs)
+            view.index.add_many(enumerate(docs, start=first_row))
+        elif self.backend == 'dense':
+            documents.append_many(docs)
+            view.index.add([doc['content'] for doc in docs], [doc['category'] for doc in docs])
+        elif vectors is None:
+            # First documents: nothing to keep stable yet
+            documents.append_many(docs)
+            vectorizer, vectors = self._fit_index(list(documents.iter_contents()))
+            self._reset_drift()
+        else:
+            # Transform only, with the current vocabulary
+            contents = [doc['content'] for doc in docs]
+            vectors = sparse.vstack(
+                [vectors, vectorizer.transform(contents)], format='csr'
+            )
+            analyzer = vectorizer.build_analyzer()
+            vocabulary = vectorizer.vocabulary_
+            for content in contents:
+                tokens = analyzer(content)
+                self._tokens_since_refit += len(tokens)
+                self._oov_tokens_since_refit += sum(1 for token in tokens if token not in vocabulary)
+            self._docs_since_refit += len(docs)
+            
+            documents.append_many(docs)
+        
+        self._index_metadata(view.metadata_index, docs, first_row)
+        for offset, doc in enumerate(docs):
+            view.id_rows[doc['id']] = first_row + offset
+        return {
+            'num_rows': len(documents),
+            'vectorizer': vectorizer,
+            'vectors': vectors,
+            'category_rows': self._index_categories(docs, first_row, view.category_rows)
+        }
+    
+    def _delete_rows(self, view: SearchView, rows) -> Dict[str, Any]:
+        """Tombstone rows, returning the view changes that hide them (write lock held)"""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        documents = view.documents
+        category_rows = dict(view.category_rows)
+        for code in set(documents.category_codes[row] for row in rows.tolist()):
+            category = documents.category_names[code]
+            if category in category_rows:
+                category_rows[category] = np.setdiff1d(category_rows[category], rows, assume_unique=True)
+        if self.backend == 'bm25':
+            for row in rows.tolist():
+                view.index.delete(row, documents.content(row))
+        elif self.backend == 'dense':
+            view.index.delete_many(rows.tolist())
+        return {
+            'category_rows': category_rows,
+            'deleted_rows': np.union1d(view.deleted_rows, rows)
         }
-        self.documents.append(doc)
-        self._update_vectors()
-        self.save_data()
-        return doc['id']
-    
-    def search(self, query: str, top_k: int = 5, category: str = None):
-        """Search for similar documents"""
-        if not self.documents:
+    
+    def delete_documents(self, ids: List[int]) -> List[int]:
+        """
+        Delete documents by id
+        
+        Args:
+            ids: Document ids
+        
+        Returns:
+            The ids that existed and were deleted
+        """
+        self._require_owner()
+        with self._write_lock:
+            view = self._view
+            deleted_ids = []
+            rows = []
+            for doc_id in ids:
+                row = view.id_rows.pop(doc_id, None)
+                if row is not None:
+                    deleted_ids.append(doc_id)
+                    rows.append(row)
+            if rows:
+                self._publish(**self._delete_rows(view, rows))
+                self._append_journal([{'op': 'delete', 'id': doc_id} for doc_id in deleted_ids])
+        return deleted_ids
+    
+    def update_document(self, doc_id: int, title: str = None, content: str = None,
+                        category: str = None, metadata: Dict = None) -> bool:
+        """
+        Replace fields of a document, keeping its id
+        
+        The old row is tombstoned and the new version appended and indexed
+        like a new document, with a fresh timestamp.
+        
+        Returns:
+            False if no document has this id
+        """
+        self._require_owner()
+        with self._write_lock:
+            view = self._view
+            row = view.id_rows.get(doc_id)
+            if row is None:
+                return False
+            doc = view.documents.get(row)
+            for field, value in (('title', title), ('content', content),
+                                 ('category', category), ('metadata', metadata)):
+                if value is not None:
+                    doc[field] = value
+            doc['timestamp'] = time.time()
+            
+            # One publish: readers see either the old or the new version
+            changes = self._append_docs(view, [doc])
+            changes.update(self._delete_rows(view._replace(**changes), [row]))
+            self._publish(**changes)
+            self._append_journal([{'op': 'update', 'doc': doc}])
+        return True
+    
+    def apply_retention(self, now: float = None) -> int:
+        """
+        Delete documents older than their category's RAG_RETENTION_DAYS
+        
+        Runs on load and, at most every RAG_RETENTION_INTERVAL seconds, on adds.
+        
+        Returns:
+            Number of documents deleted
+        """
+        if not self.is_owner:
+            return 0  # the owner expires documents
+        with self._write_lock:
+            return self._expire(now or time.time())
+    
+    def _expire(self, now: float) -> int:
+        """Retention sweep (write lock held)"""
+        self._last_retention = now
+        view = self._view
+        if not RAG_RETENTION_DAYS or view.num_rows == 0:
+            return 0
+        
+        timestamps = np.array(view.documents.timestamps)
+        expired = []
+        for category, days in RAG_RETENTION_DAYS.items():
+            rows = view.category_rows.get(category)
+            if rows is not None and len(rows):
+                expired.append(rows[timestamps[rows] < now - days * 86400])
+        rows = np.concatenate(expired) if expired else np.empty(0, dtype=np.int64)
+        if len(rows) == 0:
+            return 0
+        
+        ids = [view.documents.ids[row] for row in rows.tolist()]
+        for doc_id in ids:
+            view.id_rows.pop(doc_id, None)
+        self._publish(**self._delete_rows(view, rows))
+        self._append_journal([{'op': 'delete', 'id': doc_id} for doc_id in ids])
+        print(f"RAG retention deleted {len(ids)} expired documents")
+        return len(ids)
+    
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int, min_score: float) -> np.ndarray:
+        """Positions of the top_k scores above min_score, best first"""
+        candidates = np.flatnonzero(scores > min_score)
+        if len(candidates) > top_k:
+            # O(n) partial selection, then sort only the winners
+            candidates = candidates[np.argpartition(scores[candidates], -top_k)[-top_k:]]
+        return candidates[np.argsort(scores[candidates])[::-1]]
+    
+    def search(self, query: str, top_k: int = 5, category: str = None, min_score: float = None,
+               metadata: Dict[str, Any] = None):
+        """
+        Search for similar documents, serving repeated queries from the result cache
+        
+        Args:
+            query: Query text
+            top_k: Number of results
+            category: Only search this category
+            min_score: Drop results scoring at or below this (default RAG_MIN_SCORE)
+            metadata: Only rank documents whose metadata matches these values exactly
+        """
+        min_score = RAG_MIN_SCORE if min_score is None else min_score
+        metadata_key = tuple(sorted((field, str(value)) for field, value in (metadata or {}).items()))
+        key = (query, category, top_k, min_score, metadata_key)
+        
+        # Pin the view: if a write lands mid-search the entry is tagged with
+        # the older generation and never served
+        view = self._view
+        results = self.query_cache.get(key, view.generation)
+        if results is None:
+            results = self._search(view, query, top_k, category, min_score, metadata)
+            self.query_cache.put(key, view.generation, results)
+        return list(results)
+    
+    def _search(self, view: SearchView, query: str, top_k: int, category: str, min_score: float,
+                metadata: Dict[str, Any] = None):
+        """Search for similar documents within a view"""
+        if view.num_rows == 0:
             return []
         
-        # Filter by category if specified
-        filtered_docs = self.documents
-        if category:
-            filtered_docs = [doc for doc in self.documents if doc.get('category') == category]
+        if self.backend == 'bm25':
+            if not metadata:
+                hits = view.index.search(query, top_k, category, min_score, num_rows=view.num_rows)
+            else:
+                rows = self._filter_rows(view, category, metadata)
+                scores = view.index.score_rows(query, rows)
+                hits = [(rows[idx], scores[idx]) for idx in self._top_k(scores, top_k, min_score)]
+            return [self._format_result(view, row, score) for row, score in hits]
         
-        if not filtered_docs:
+        if self.backend == 'dense':
+            rows = self._filter_rows(view, category, metadata)
+            if rows is not None and len(rows) == 0:
+                return []
+            hits = view.index.search(query, top_k, num_rows=view.num_rows, rows=rows, min_score=min_score,
+                                     category=category if not metadata else None)
+            return [self._format_result(view, row, score) for row, score in hits]
+        
+        vectorizer, document_vectors = view.vectorizer, view.vectors
+        if document_vectors is None:
             return []
         
+        # Filter by category/metadata if specified: slice the matching precomputed rows
+        rows = self._filter_rows(view, category, metadata)
+        if rows is not None:
+            if len(rows) == 0:
+                return []
+            document_vectors = document_vectors[rows]
+        
         # Vectorize query
-        query_vector = self.vectorizer.transform([query])
+        query_vector = vectorizer.transform([query])
+        if query_vector.nnz == 0 or top_k <= 0:
+            return []
         
-        # Calculate similarities
-        if len(filtered_docs) == len(self.documents):
-            similarities = cosine_similarity(query_vector, self.document_vectors)[0]
-        else:
-            # Re-vectorize filtered docs
-            filtered_texts = [doc['content'] for doc in filtered_docs]
-            filtered_vectors = self.vectorizer.transform(filtered_texts)
-            similarities = cosine_similarity(query_vector, filtered_vectors)[0]
+        # TF-IDF rows are L2-normalized, so cosine similarity is a sparse
+        # matrix-vector product
+        similarities = document_vectors.dot(query_vector.toarray().ravel())
+        if rows is None and len(view.deleted_rows):
+            # Tombstoned rows stay in the matrix until compaction
+            similarities[view.deleted_rows] = -np.inf
         
         # Get top results
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        results = []
-        
-        for idx in top_indices:
-            if similarities[idx] > 0:  # Only return if there's some similarity
-                doc = filtered_docs[idx]
-                results.append({
-                    'id': doc['id'],
-                    'title': doc['title'],
-                    'content': doc['content'],
-                    'category': doc['category'],
-                    'metadata': doc['metadata'],
-                    'similarity_score': float(similarities[idx])
-                })
+        top_indices = self._top_k(similarities, top_k, min_score)
         
-        return results
+        return [
+            self._format_result(view, rows[idx] if rows is not None else idx, similarities[idx])
+            for idx in top_indices
+        ]
+    
+    def _format_result(self, view: SearchView, row: int, score: float) -> Dict[str, Any]:
+        """Materialize a result row; only the returned top-k are ever built"""
+        doc = view.documents.get(int(row))
+        del doc['timestamp']
+        doc['similarity_score'] = float(score)
+        return doc
 
 # Global storage instance
 rag_storage = LocalRAGStorage()
@@ -125,7 +1213,8 @@ def get_user_information():
     Expected JSON payload:
     {
         "query": "search query about user",
-        "top_k": 5
+        "top_k": 5,
+        "metadata": {"phone_number": "+1555..."}   (optional exact-match filter)
     }
     
     Returns:
@@ -143,12 +1232,16 @@ def get_user_information():
         
         query = data.get('query', '')
         top_k = data.get('top_k', 5)
+        metadata = data.get('metadata') or None
         
         if not query:
             return jsonify({'error': 'Query is required'}), 400
         
+        if metadata is not None and not isinstance(metadata, dict):
+            return jsonify({'error': 'Metadata must be an object'}), 400
+        
         # Search in local storage for user information
-        results = rag_storage.search(query, top_k=top_k, category='user_information')
+        results = rag_storage.search(query, top_k=top_k, category='user_information', metadata=metadata)
         
         return jsonify({
             'success': True,
@@ -169,7 +1262,8 @@ def get_call_history():
     Expected JSON payload:
     {
         "query": "search query about calls",
-        "top_k": 10
+        "top_k": 10,
+        "metadata": {"phone_number": "+1555..."}   (optional exact-match filter)
     }
     
     Returns:
@@ -187,12 +1281,16 @@ def get_call_history():
         
         query = data.get('query', '')
         top_k = data.get('top_k', 10)
+        metadata = data.get('metadata') or None
         
         if not query:
             return jsonify({'error': 'Query is required'}), 400
         
+        if metadata is not None and not isinstance(metadata, dict):
+            return jsonify({'error': 'Metadata must be an object'}), 400
+        
         # Search in local storage for call history
-        results = rag_storage.search(query, top_k=top_k, category='call_history')
+        results = rag_storage.search(query, top_k=top_k, category='call_history', metadata=metadata)
         
         return jsonify({
             'success': True,
@@ -241,20 +1339,21 @@ def post_suspect_information():
         if not isinstance(documents, list):
             return jsonify({'error': 'Documents must be a list'}), 400
         
-        # Add documents to local storage
-        added_count = 0
+        # Add documents to local storage in one batch
+        batch = []
         for i, doc in enumerate(documents):
             title = f"Suspect Info {i+1}"
             if metadata.get('phone_number'):
                 title += f" - {metadata['phone_number']}"
             
-            rag_storage.add_document(
-                title=title,
-                content=doc,
-                category='suspects',
-                metadata=metadata
-            )
-            added_count += 1
+            batch.append({
+                'title': title,
+                'content': doc,
+                'category': 'suspects',
+                'metadata': metadata
+            })
+        
+        added_count = len(rag_storage.add_documents(batch))
         
         return jsonify({
             'success': True,
@@ -263,6 +1362,9 @@ def post_suspect_information():
             'count': added_count
         })
         
+    except RAGStorageReadOnly as e:
+        return jsonify({'error': str(e)}), 503
+        
     except Exception as e:
         return jsonify({'error': f'Post suspect information failed: {str(e)}'}), 500
 
@@ -301,20 +1403,21 @@ def add_user_documents():
         if not isinstance(documents, list):
             return jsonify({'error': 'Documents must be a list'}), 400
         
-        # Add documents to local storage
-        added_count = 0
+        # Add documents to local storage in one batch
+        batch = []
         for i, doc in enumerate(documents):
             title = f"User Info {i+1}"
             if metadata.get('user_id'):
                 title += f" - {metadata['user_id']}"
             
-            rag_storage.add_document(
-                title=title,
-                content=doc,
-                category='user_information',
-                metadata=metadata
-            )
-            added_count += 1
+            batch.append({
+                'title': title,
+                'content': doc,
+                'category': 'user_information',
+                'metadata': metadata
+            })
+        
+        added_count = len(rag_storage.add_documents(batch))
         
         return jsonify({
             'success': True,
@@ -323,9 +1426,113 @@ def add_user_documents():
             'count': added_count
         })
         
+    except RAGStorageReadOnly as e:
+        return jsonify({'error': str(e)}), 503
+        
     except Exception as e:
         return jsonify({'error': f'Add user documents failed: {str(e)}'}), 500
 
+def _parse_bulk_document(item: Any) -> Dict[str, Any]:
+    """Validate one bulk ingest item, returning the document dict"""
+    if isinstance(item, str):
+        item = {'content': item}
+    if not isinstance(item, dict) or not isinstance(item.get('content'), str) or not item['content'].strip():
+        raise ValueError('Each document needs a non-empty "content" string')
+    if item.get('metadata') is not None and not isinstance(item['metadata'], dict):
+        raise ValueError('"metadata" must be an object')
+    if item.get('timestamp') is not None and \
+            (isinstance(item['timestamp'], bool) or not isinstance(item['timestamp'], (int, float))):
+        raise ValueError('"timestamp" must be epoch seconds')
+    return item
+
+@rag_bp.route('/bulk_add', methods=['POST'])
+def bulk_add_documents():
+    """
+    Add many documents, one vector update and one save per batch
+    
+    Accepts either a streamed NDJSON body (Content-Type: application/x-ndjson),
+    one document per line:
+    {"title": "...", "content": "...", "category": "suspects", "metadata": {...}, "timestamp": 1700000000}
+    
+    or a JSON payload:
+    {
+        "documents": [{"title": "...", "content": "...", "category": "...", "metadata": {...}}, ...]
+    }
+    
+    Documents may also be plain strings. Category defaults to "general" and
+    timestamp (epoch seconds, used for retention) to now.
+    
+    Returns:
+    {
+        "success": true,
+        "count": 5000,
+        "batches": 5,
+        "seconds": 1.2,
+        "docs_per_second": 4166.7
+    }
+    """
+    try:
+        start = time.perf_counter()
+        added_count = 0
+        batches = 0
+        batch = []
+        
+        def flush():
+            nonlocal added_count, batches
+            if batch:
+                added_count += len(rag_storage.add_documents(batch))
+                batches += 1
+                batch.clear()
+        
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            for line_number, line in enumerate(request.stream, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(_parse_bulk_document(json.loads(line)))
+                except ValueError as e:
+                    flush()
+                    return jsonify({
+                        'error': f'Line {line_number}: {str(e)}',
+                        'line': line_number,
+                        'count': added_count
+                    }), 400
+                if len(batch) >= RAG_BULK_BATCH_SIZE:
+                    flush()
+        else:
+            data = request.get_json()
+            
+            if not data or not isinstance(data.get('documents'), list):
+                return jsonify({'error': 'Documents must be a list'}), 400
+            
+            try:
+                documents = [_parse_bulk_document(item) for item in data['documents']]
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            for i in range(0, len(documents), RAG_BULK_BATCH_SIZE):
+                batch.extend(documents[i:i + RAG_BULK_BATCH_SIZE])
+                flush()
+        
+        flush()
+        seconds = time.perf_counter() - start
+        
+        return jsonify({
+            'success': True,
+            'message': f'Added {added_count} documents',
+            'count': added_count,
+            'batches': batches,
+            'seconds': seconds,
+            'docs_per_second': added_count / seconds if seconds > 0 else 0.0
+        })
+        
+    except RAGStorageReadOnly as e:
+        return jsonify({'error': str(e)}), 503
+        
+    except Exception as e:
+        return jsonify({'error': f'Bulk add failed: {str(e)}'}), 500
+
 @rag_bp.route('/search_all', methods=['POST'])
 def search_all_categories():
     """
@@ -334,7 +1541,8 @@ def search_all_categories():
     Expected JSON payload:
     {
         "query": "search query",
-        "top_k": 5
+        "top_k": 5,
+        "metadata": {"phone_number": "+1555..."}   (optional exact-match filter)
     }
     
     Returns:
@@ -352,12 +1560,16 @@ def search_all_categories():
         
         query = data.get('query', '')
         top_k = data.get('top_k', 5)
+        metadata = data.get('metadata') or None
         
         if not query:
             return jsonify({'error': 'Query is required'}), 400
         
+        if metadata is not None and not isinstance(metadata, dict):
+            return jsonify({'error': 'Metadata must be an object'}), 400
+        
         # Search across all categories (no category filter)
-        results = rag_storage.search(query, top_k=top_k, category=None)
+        results = rag_storage.search(query, top_k=top_k, category=None, metadata=metadata)
         
         return jsonify({
             'success': True,
@@ -370,19 +1582,172 @@ def search_all_categories():
     except Exception as e:
         return jsonify({'error': f'Search all categories failed: {str(e)}'}), 500
 
+@rag_bp.route('/lookup', methods=['POST'])
+def lookup_documents():
+    """
+    Get documents by exact metadata match (e.g. everything about a phone number)
+    
+    Expected JSON payload:
+    {
+        "metadata": {"phone_number": "+15551234567"},
+        "category": "suspects",   (optional)
+        "limit": 100              (optional)
+    }
+    
+    Returns:
+    {
+        "results": [...],   (newest first)
+        "count": 3
+    }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+        
+        metadata = data.get('metadata')
+        category = data.get('category')
+        limit = data.get('limit', 100)
+        
+        if not metadata or not isinstance(metadata, dict):
+            return jsonify({'error': 'Metadata is required'}), 400
+        
+        results = rag_storage.lookup(metadata, category=category, limit=limit)
+        
+        return jsonify({
+            'success': True,
+            'results': results,
+            'metadata': metadata,
+            'count': len(results),
+            'indexed_fields': RAG_METADATA_INDEX_FIELDS
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Lookup failed: {str(e)}'}), 500
+
+@rag_bp.route('/delete_documents', methods=['POST'])
+def delete_documents():
+    """
+    Delete documents by id
+    
+    Expected JSON payload:
+    {
+        "ids": [12, 13]
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "deleted": [12, 13],
+        "count": 2
+    }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+        
+        ids = data.get('ids')
+        
+        if not isinstance(ids, list) or not all(isinstance(doc_id, int) for doc_id in ids):
+            return jsonify({'error': 'Ids must be a list of integers'}), 400
+        
+        deleted = rag_storage.delete_documents(ids)
+        
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'count': len(deleted),
+            'not_found': sorted(set(ids) - set(deleted))
+        })
+        
+    except RAGStorageReadOnly as e:
+        return jsonify({'error': str(e)}), 503
+        
+    except Exception as e:
+        return jsonify({'error': f'Delete documents failed: {str(e)}'}), 500
+
+@rag_bp.route('/update_document', methods=['POST'])
+def update_document():
+    """
+    Replace fields of a document, keeping its id
+    
+    Expected JSON payload:
+    {
+        "id": 12,
+        "content": "updated text",      (optional)
+        "title": "...",                 (optional)
+        "category": "suspects",         (optional)
+        "metadata": {...}               (optional, replaces the old metadata)
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "id": 12
+    }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+        
+        doc_id = data.get('id')
+        content = data.get('content')
+        metadata = data.get('metadata')
+        
+        if not isinstance(doc_id, int):
+            return jsonify({'error': 'Id must be an integer'}), 400
+        
+        if content is not None and (not isinstance(content, str) or not content.strip()):
+            return jsonify({'error': 'Content must be a non-empty string'}), 400
+        
+        if metadata is not None and not isinstance(metadata, dict):
+            return jsonify({'error': 'Metadata must be an object'}), 400
+        
+        updated = rag_storage.update_document(
+            doc_id,
+            title=data.get('title'),
+            content=content,
+            category=data.get('category'),
+            metadata=metadata
+        )
+        
+        if not updated:
+            return jsonify({'error': f'Document {doc_id} not found'}), 404
+        
+        return jsonify({
+            'success': True,
+            'id': doc_id,
+            'document': rag_storage.get_document(doc_id)
+        })
+        
+    except RAGStorageReadOnly as e:
+        return jsonify({'error': str(e)}), 503
+        
+    except Exception as e:
+        return jsonify({'error': f'Update document failed: {str(e)}'}), 500
+
 @rag_bp.route('/health', methods=['GET'])
 def health():
     """Health check for RAG functions"""
     try:
         # Check local RAG storage
-        doc_count = len(rag_storage.documents)
+        doc_count = rag_storage.document_count
         
         return jsonify({
             'status': 'healthy',
             'service': 'rag_functions',
             'storage_type': 'local_memory',
+            'owner': rag_storage.is_owner,
             'document_count': doc_count,
-            'vectorizer_ready': rag_storage.document_vectors is not None
+            'vectorizer_ready': rag_storage.document_vectors is not None,
+            'index': rag_storage.index_stats(),
+            'persistence': rag_storage.persistence_stats(),
+            'query_cache': {**rag_storage.query_cache.stats(), 'generation': rag_storage.generation}
         })
         
     except Exception as e:
@@ -0,0 +1,56 @@
+"""
+Forward /api/rag requests to the process that owns the RAG store
+
+The local RAG store keeps its documents in memory and has a single writer,
+so with several gunicorn workers each one would load its own copy and only
+the first could write. When RAG_STORE_URL is set, app.create_app() registers
+this blueprint instead of the RAG functions and every worker hands its RAG
+requests to that one process (rag-store.service, app:create_rag_app()).
+"""
+
+import os
+import threading
+
+import requests
+from flask import Blueprint, Response, jsonify, request
+
+# Configuration
+RAG_STORE_URL = os.getenv('RAG_STORE_URL', '').rstrip('/')  # e.g. http://127.0.0.1:5001
+RAG_STORE_TIMEOUT = float(os.getenv('RAG_STORE_TIMEOUT', 30))  # seconds per request
+
+rag_proxy_bp = Blueprint('rag_proxy', __name__)
+
+# One keep-alive session per worker thread
+_sessions = threading.local()
+
+
+def _session() -> requests.Session:
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    return session
+
+
+@rag_proxy_bp.route('/<path:endpoint>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def forward(endpoint):
+    """Send the request to the RAG store and return its response unchanged"""
+    headers = {}
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+
+    try:
+        # Bodies (e.g. NDJSON bulk uploads) are streamed through with chunked
+        # transfer encoding rather than buffered
+        upstream = _session().request(
+            request.method,
+            f"{RAG_STORE_URL}/api/rag/{endpoint}",
+            params=request.args,
+            data=request.stream if request.method in ('POST', 'PUT') else None,
+            headers=headers,
+            timeout=RAG_STORE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        return jsonify({'error': f'RAG store unavailable at {RAG_STORE_URL}: {str(e)}'}), 503
+
+    return Response(upstream.content, status=upstream.status_code,
+                    content_type=upstream.headers.get('Content-Type'))
@@ -0,0 +1,190 @@
+import json
+import os
+import uuid
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from api.rag_dense import get_embedder
+from rag.vector_store import QDRANT_MODE, QdrantVectorStore, collection_exists
+
+# Vectors fetched per request when copying rows during a vacuum
+COPY_BATCH_ROWS = 1024
+
+class QdrantDenseIndex:
+    """
+    Dense index over a Qdrant collection, a drop-in for DenseIndex
+
+    Rows are point ids in a collection of the shared vector store. With
+    QDRANT_MODE=local that is qdrant-client's embedded engine, so the Flask
+    app does dense retrieval in-process: QDRANT_LOCAL_PATH=:memory:
+    re-embeds the documents on startup, a directory keeps the vectors across
+    restarts. With QDRANT_MODE=remote the collection lives on the Qdrant
+    server. The collection name is recorded in the metadata file next to
+    path, so load() and move() behave as they do for the matrix file.
+    """
+
+    def __init__(self, path: str, embedder=None, dtype: str = None):
+        self.path = path
+        self.meta_path = path + '.json'
+        self.embedder = embedder or get_embedder()
+        self.dim = self.embedder.dim
+        # Vectors are float32 on the client side; quantization is a collection
+        # setting (QDRANT_QUANTIZATION) rather than RAG_DENSE_DTYPE
+        self.dtype = np.float32
+        self.num_rows = 0
+        self.deleted = set()
+        self.store = None
+        # Collections of replaced layouts, dropped on the next save
+        self._stale = []
+
+    def _collection(self) -> QdrantVectorStore:
+        if self.store is None:
+            self.store = QdrantVectorStore(f"rag_dense_{uuid.uuid4().hex}", self.dim, payload_index_fields=[])
+            # Recorded right away so a replaced collection is always found
+            # and dropped, even if this index was never saved
+            self._write_meta()
+        return self.store
+
+    @staticmethod
+    def _read_meta(path: str) -> Dict[str, Any]:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, total_rows: int) -> int:
+        """
+        Reuse the collection of a previous run
+
+        Returns how many leading rows were reused; the caller embeds the rest,
+        overwriting any points added after the last save. A collection with
+        more points than the store has rows is dropped and rebuilt.
+        """
+        meta = self._read_meta(self.meta_path)
+        name = meta.get('collection')
+        if not name or not collection_exists(name):
+            return 0
+        store = QdrantVectorStore(name, self.dim, payload_index_fields=[])
+        rows = meta.get('rows', 0)
+        deleted = set(meta.get('deleted', []))
+        if meta.get('embedder') != self.embedder.name or meta.get('dim') != self.dim \
+                or rows > total_rows or store.count() > total_rows:
+            store.drop()
+            return 0
+        self.store = store
+        self.num_rows = rows
+        self.deleted = deleted
+        return rows
+
+    def _write_meta(self):
+        meta = {
+            'embedder': self.embedder.name,
+            'dim': self.dim,
+            'collection': self._collection().collection_name,
+            'rows': self.num_rows,
+            'deleted': sorted(self.deleted)
+        }
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def save(self):
+        """Record the collection and how many rows it holds, then drop replaced collections"""
+        self._write_meta()
+        while self._stale:
+            name = self._stale.pop()
+            try:
+                if collection_exists(name):
+                    QdrantVectorStore(name, self.dim, payload_index_fields=[]).drop()
+            except Exception as e:
+                print(f"Warning: Could not drop replaced collection {name}: {e}")
+
+    def add(self, texts: List[str], categories: List[str] = None):
+        """Embed and append texts as the next rows, with their categories as payload"""
+        if texts:
+            categories = categories or [None] * len(texts)
+            self._append(self.embedder(texts), [{'category': category} for category in categories])
+
+    def copy_rows(self, source: 'QdrantDenseIndex', rows: np.ndarray):
+        """Append stored vectors and payloads of another index as the next rows"""
+        rows = np.asarray(rows, dtype=np.int64).tolist()
+        for start in range(0, len(rows), COPY_BATCH_ROWS):
+            self._append(*source.store.retrieve(rows[start:start + COPY_BATCH_ROWS]))
+
+    def _append(self, vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        start = self.num_rows
+        # Upserts wait for indexing: the row is searchable once the view exposing it is published
+        self._collection().upsert(list(range(start, start + len(vectors))), vectors, payloads)
+        self.num_rows = start + len(vectors)
+
+    def delete(self, row: int):
+        """Exclude a row from results"""
+        self.delete_many([row])
+
+    def delete_many(self, rows):
+        """Exclude rows from results with one request"""
+        rows = [int(row) for row in rows]
+        if rows:
+            self._collection().delete(rows)
+            self.deleted.update(rows)
+
+    def move(self, path: str):
+        """Take over path; the collection recorded there is dropped on the next save"""
+        previous = self._read_meta(path + '.json').get('collection')
+        if previous and previous != self._collection().collection_name:
+            self._stale.append(previous)
+        os.replace(self.meta_path, path + '.json')
+        self.path = path
+        self.meta_path = path + '.json'
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return self.embedder([query])[0]
+
+    def search(self, query: str, top_k: int = 5, num_rows: int = None, rows: np.ndarray = None,
+               min_score: float = 0.0, exact: bool = False, category: str = None) -> List[Tuple[int, float]]:
+        """
+        Return the top_k (row, score) pairs by cosine similarity, best first
+
+        Args:
+            query: Query text
+            top_k: Number of results
+            num_rows: Only consider rows below this (the caller's view)
+            rows: Only consider these rows
+            min_score: Only return rows scoring above this
+            exact: Unused, Qdrant decides between HNSW and a full scan
+            category: When rows are exactly the category's live rows, filter on
+                the category payload instead of listing every id
+        """
+        store = self.store
+        num_rows = self.num_rows if num_rows is None else min(num_rows, self.num_rows)
+        if store is None or num_rows == 0 or top_k <= 0:
+            return []
+        query_vector = self.embed_query(query)
+        if not np.any(query_vector):
+            return []
+
+        # Rows appended after the caller's view are filtered out afterwards;
+        # fetching that many extra keeps top_k exact
+        extra = self.num_rows - num_rows
+        if category:
+            filters, ids = {'category': category}, None
+        else:
+            filters, ids = None, np.asarray(rows, dtype=np.int64).tolist() if rows is not None else None
+        hits = store.search(query_vector, top_k=top_k + extra, filters=filters, ids=ids, min_score=min_score)
+        results = [(int(hit.id), float(hit.score)) for hit in hits
+                   if int(hit.id) < num_rows and hit.score > min_score]
+        return results[:top_k]
+
+    def stats(self) -> Dict[str, Any]:
+        store = self.store
+        return {
+            'embedder': self.embedder.name,
+            'dim': self.dim,
+            'store': 'qdrant',
+            'mode': QDRANT_MODE,
+            'collection': store.collection_name if store is not None else None,
+            'vectors': self.num_rows,
+            'deleted': len(self.deleted)
+        }
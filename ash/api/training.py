@@ -1,31 +1,137 @@
 from flask import Blueprint, request, jsonify, send_file
 import os
 import sys
+import shutil
 import pandas as pd
 from werkzeug.utils import secure_filename
 import tempfile
-from typing import Dict, Any
+from typing import Dict, Any, BinaryIO, Tuple
 
 # Add the models directory to the path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'models'))
 
 try:
     from spam_detection import SpamDetectionModel
+    from training_store import TrainingCorpusStore
+    from model_selection import load_leaderboard
 except ImportError:
     SpamDetectionModel = None
+    TrainingCorpusStore = None
+    load_leaderboard = None
     print("Warning: Could not import SpamDetectionModel")
 
+# Label normalization and chunk validation are shared with the corpus store
+from training_store import normalize_labels, validate_csv_chunk
+
+from api.training_jobs import (
+    MAX_PENDING_JOBS, init_jobs_db, submit_training_job, count_pending_jobs,
+    fail_stale_jobs, get_job, list_jobs, get_job_logs
+)
+
 training_bp = Blueprint('training', __name__)
 
+# Make sure the jobs tables exist before any endpoint queries them
+init_jobs_db()
+
 # Configuration
 UPLOAD_FOLDER = 'data/uploads'
 ALLOWED_EXTENSIONS = {'csv'}
+UPLOAD_CHUNK_ROWS = int(os.getenv('TRAINING_UPLOAD_CHUNK_ROWS', 50000))
+UPLOAD_COPY_BUFFER = 1024 * 1024
+
+# "train" fits the default model, "select" runs cross-validated model selection
+TRAINING_MODES = ('train', 'select')
+
+class CSVValidationError(Exception):
+    """Raised when a chunk of an uploaded CSV fails validation"""
+
+    def __init__(self, message: str, row_errors: list = None, details: Dict[str, Any] = None):
+        super().__init__(message)
+        self.row_errors = row_errors or []
+        self.details = details or {}
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_upload_stream(stream: BinaryIO, directory: str) -> Tuple[str, int]:
+    """
+    Copy an upload stream in fixed-size blocks to a new, uniquely named file
+
+    Concurrent uploads with the same filename each get their own file.
+
+    Returns:
+        (path of the file, number of bytes written)
+    """
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='upload_', suffix='.csv', delete=False) as out:
+        shutil.copyfileobj(stream, out, UPLOAD_COPY_BUFFER)
+        return out.name, out.tell()
+
+def ingest_csv_file(file_path: str, store, source: str = 'upload') -> Dict[str, Any]:
+    """
+    Validate a training CSV chunk by chunk and append it to the corpus store
+
+    Memory stays bounded by UPLOAD_CHUNK_ROWS. All rows are written in one
+    transaction, so a failing row leaves the store untouched.
+
+    Raises:
+        CSVValidationError: With the failing rows' numbers
+    """
+    columns = list(pd.read_csv(file_path, nrows=0).columns)
+    missing_columns = [col for col in ['text', 'label'] if col not in columns]
+    if missing_columns:
+        raise CSVValidationError(
+            f'Missing required columns: {missing_columns}',
+            details={'required_columns': ['text', 'label'], 'found_columns': columns}
+        )
+
+    result = {
+        'valid': True,
+        'issues': [],
+        'sample_count': 0,
+        'spam_count': 0,
+        'legitimate_count': 0,
+        'added': 0,
+        'duplicates': 0,
+        'chunks': 0,
+        'columns': columns
+    }
+
+    with store.bulk_writer(source) as write:
+        reader = pd.read_csv(
+            file_path,
+            usecols=['text', 'label'],
+            dtype={'text': str, 'label': str},
+            keep_default_na=False,
+            na_values=[''],
+            chunksize=UPLOAD_CHUNK_ROWS
+        )
+        for chunk in reader:
+            first_row = result['sample_count'] + 1
+            validated = validate_csv_chunk(chunk, first_row)
+
+            if validated['row_errors']:
+                first_error = validated['row_errors'][0]
+                raise CSVValidationError(
+                    f"Row {first_error['row']}: {first_error['error']}",
+                    row_errors=validated['row_errors']
+                )
+
+            df = validated['df']
+            counts = write(df)
+            result['sample_count'] += len(df)
+            result['spam_count'] += int((df['label'] == 1).sum())
+            result['legitimate_count'] += int((df['label'] == 0).sum())
+            result['added'] += counts['added']
+            result['duplicates'] += counts['duplicates']
+            result['chunks'] += 1
+
+    if result['sample_count'] == 0:
+        raise pd.errors.EmptyDataError('No data rows')
+
+    return result
+
 def validate_csv_format(df: pd.DataFrame) -> Dict[str, Any]:
     """
     Validate CSV format for training data
@@ -94,7 +200,8 @@ def retrain_model():
     """
     Retrain the spam detection model with new CSV data
     
-    Expects multipart/form-data with a CSV file
+    Expects multipart/form-data with a CSV file, or the raw CSV as the request
+    body with Content-Type: text/csv (optional ?filename=...)
     
     CSV format expected:
     text,label
@@ -103,11 +210,21 @@ def retrain_model():
     
     Labels can be: 0/1, spam/legitimate, ham/spam, True/False
     
-    Returns:
+    Optional form field or query parameter mode=select runs cross-validated
+    model selection instead of fitting the default model.
+    
+    The upload is streamed to a uniquely named file and only its header is
+    checked here. The training job validates it in chunks of UPLOAD_CHUNK_ROWS
+    rows and appends it to the training corpus store before training, so a
+    large upload never holds the request; poll /jobs/<job_id> for its status
+    (row errors are reported in the job's "validation" field).
+    
+    Returns (202):
     {
         "success": true,
-        "message": "Model retrained successfully",
-        "training_results": {...}
+        "message": "Retraining job queued",
+        "job_id": "...",
+        "status_url": "/api/training/jobs/..."
     }
     """
     try:
@@ -117,22 +234,41 @@ def retrain_model():
                 'error': 'SpamDetectionModel not available'
             }), 500
         
+        if count_pending_jobs() >= MAX_PENDING_JOBS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many pending training jobs (max {MAX_PENDING_JOBS}). Try again later.'
+            }), 429
+        
         # Check if file is in request
-        if 'file' not in request.files:
+        mode = request.args.get('mode', 'train')
+        if 'file' in request.files:
+            file = request.files['file']
+            upload_stream = file.stream
+            upload_name = file.filename
+            mode = request.form.get('mode', mode)
+        elif request.mimetype == 'text/csv':
+            upload_stream = request.stream
+            upload_name = request.args.get('filename', 'upload.csv')
+        else:
             return jsonify({
                 'success': False,
                 'error': 'No file provided. Please upload a CSV file.'
             }), 400
         
-        file = request.files['file']
-        
-        if file.filename == '':
+        if upload_name == '':
             return jsonify({
                 'success': False,
                 'error': 'No file selected'
             }), 400
         
-        if not allowed_file(file.filename):
+        if mode not in TRAINING_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid mode. Expected one of: {list(TRAINING_MODES)}'
+            }), 400
+        
+        if not allowed_file(upload_name):
             return jsonify({
                 'success': False,
                 'error': 'Invalid file type. Please upload a CSV file.'
@@ -141,62 +277,46 @@ def retrain_model():
         # Create upload directory
         os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
+        # Stream uploaded file to disk
+        filename = secure_filename(upload_name)
+        file_path, upload_bytes = save_upload_stream(upload_stream, UPLOAD_FOLDER)
         
+        queued = False
         try:
-            # Load and validate CSV
-            df = pd.read_csv(file_path)
-            validation_result = validate_csv_format(df)
-            
-            if not validation_result['valid']:
+            # Only the header is read here; the job validates the rows
+            columns = list(pd.read_csv(file_path, nrows=0).columns)
+            missing_columns = [col for col in ['text', 'label'] if col not in columns]
+            if missing_columns:
                 return jsonify({
                     'success': False,
                     'error': 'Invalid CSV format',
-                    'validation_details': validation_result
+                    'validation_details': {
+                        'valid': False,
+                        'issues': [f'Missing required columns: {missing_columns}'],
+                        'required_columns': ['text', 'label'],
+                        'found_columns': columns
+                    }
                 }), 400
             
-            # Convert labels to binary format
-            label_mapping = {
-                'spam': 1, 'legitimate': 0, 'ham': 0,
-                '1': 1, '0': 0, 1: 1, 0: 0,
-                True: 1, False: 0
-            }
-            
-            df['label'] = df['label'].map(label_mapping)
-            df = df.dropna()  # Remove any rows that couldn't be mapped
-            
-            # Save processed CSV
-            processed_file_path = file_path.replace('.csv', '_processed.csv')
-            df.to_csv(processed_file_path, index=False)
-            
-            # Initialize model and retrain
-            model = SpamDetectionModel("custom")
-            training_results = model.retrain_with_new_data(processed_file_path)
-            
-            if 'error' in training_results:
-                return jsonify({
-                    'success': False,
-                    'error': training_results['error'],
-                    'validation_details': validation_result
-                }), 500
-            
-            # Clean up uploaded files
-            try:
-                os.remove(file_path)
-                os.remove(processed_file_path)
-            except:
-                pass  # Don't fail if cleanup fails
+            # Queue ingest + retraining on the whole corpus; the job owns the file
+            job_id = submit_training_job(
+                'retrain_model',
+                cleanup_files=[file_path],
+                upload_path=file_path,
+                mode=mode,
+                filename=filename,
+                upload_bytes=upload_bytes
+            )
+            queued = True
             
             return jsonify({
                 'success': True,
-                'message': 'Model retrained successfully',
-                'training_results': training_results,
-                'validation_details': validation_result,
-                'filename': filename
-            })
+                'message': 'Retraining job queued',
+                'job_id': job_id,
+                'status_url': f'/api/training/jobs/{job_id}',
+                'filename': filename,
+                'upload_bytes': upload_bytes
+            }), 202
             
         except pd.errors.EmptyDataError:
             return jsonify({
@@ -209,20 +329,14 @@ def retrain_model():
                 'success': False,
                 'error': f'Error parsing CSV file: {str(e)}'
             }), 400
-            
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': f'Error processing CSV: {str(e)}'
-            }), 500
         
         finally:
-            # Clean up uploaded file if it still exists
-            try:
-                if os.path.exists(file_path):
+            # Clean up the uploaded file unless a job took it over
+            if not queued:
+                try:
                     os.remove(file_path)
-            except:
-                pass
+                except OSError:
+                    pass
         
     except Exception as e:
         return jsonify({
@@ -240,13 +354,17 @@ def add_training_samples():
         "samples": [
             {"text": "spam message", "label": 1},
             {"text": "legitimate message", "label": 0}
-        ]
+        ],
+        "mode": "train"  (optional, "select" for model selection)
     }
     
-    Returns:
+    Training runs as a background job; poll /jobs/<job_id> for its status.
+    
+    Returns (202):
     {
         "success": true,
-        "message": "Added N training samples"
+        "message": "Added N training samples",
+        "job_id": "..."
     }
     """
     try:
@@ -265,6 +383,13 @@ def add_training_samples():
             }), 400
         
         samples = data['samples']
+        mode = data.get('mode', 'train')
+        
+        if mode not in TRAINING_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid mode. Expected one of: {list(TRAINING_MODES)}'
+            }), 400
         
         if not isinstance(samples, list) or len(samples) == 0:
             return jsonify({
@@ -280,48 +405,43 @@ def add_training_samples():
                     'error': f'Sample {i} is invalid. Each sample must have "text" and "label" fields.'
                 }), 400
         
-        # Create temporary CSV file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as temp_file:
-            temp_csv_path = temp_file.name
-            
-            # Write samples to CSV
-            df = pd.DataFrame(samples)
-            df.to_csv(temp_csv_path, index=False)
+        if count_pending_jobs() >= MAX_PENDING_JOBS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many pending training jobs (max {MAX_PENDING_JOBS}). Try again later.'
+            }), 429
         
-        try:
-            # Validate CSV format
-            validation_result = validate_csv_format(df)
-            
-            if not validation_result['valid']:
-                return jsonify({
-                    'success': False,
-                    'error': 'Invalid sample format',
-                    'validation_details': validation_result
-                }), 400
-            
-            # Retrain model
-            model = SpamDetectionModel("custom")
-            training_results = model.retrain_with_new_data(temp_csv_path)
-            
-            if 'error' in training_results:
-                return jsonify({
-                    'success': False,
-                    'error': training_results['error']
-                }), 500
-            
+        df = pd.DataFrame(samples)
+        
+        # Validate CSV format
+        validation_result = validate_csv_format(df)
+        
+        if not validation_result['valid']:
             return jsonify({
-                'success': True,
-                'message': f'Added {len(samples)} training samples',
-                'training_results': training_results,
+                'success': False,
+                'error': 'Invalid sample format',
                 'validation_details': validation_result
-            })
-            
-        finally:
-            # Clean up temporary file
-            try:
-                os.remove(temp_csv_path)
-            except:
-                pass
+            }), 400
+        
+        # Append samples to the training corpus and queue retraining
+        df = pd.DataFrame({'text': df['text'].astype(str), 'label': normalize_labels(df['label'])})
+        ingest = TrainingCorpusStore().add_dataframe(df, source='api')
+        
+        job_id = submit_training_job(
+            'add_training_samples',
+            mode=mode,
+            sample_count=len(samples),
+            new_samples=ingest['added'],
+            duplicate_samples=ingest['duplicates']
+        )
+        
+        return jsonify({
+            'success': True,
+            'message': f'Added {len(samples)} training samples',
+            'job_id': job_id,
+            'status_url': f'/api/training/jobs/{job_id}',
+            'validation_details': validation_result
+        }), 202
         
     except Exception as e:
         return jsonify({
@@ -329,6 +449,122 @@ def add_training_samples():
             'error': f'Adding training samples failed: {str(e)}'
         }), 500
 
+@training_bp.route('/jobs', methods=['GET'])
+def training_jobs():
+    """
+    List recent training jobs
+    
+    Query parameters:
+        limit: Maximum number of jobs to return (default 20)
+    
+    Returns:
+    {
+        "jobs": [...],
+        "count": 2
+    }
+    """
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        fail_stale_jobs()
+        jobs = list_jobs(limit)
+        
+        return jsonify({
+            'jobs': jobs,
+            'count': len(jobs)
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'error': f'Could not list training jobs: {str(e)}'
+        }), 500
+
+@training_bp.route('/jobs/<job_id>', methods=['GET'])
+def training_job_status(job_id):
+    """
+    Get status, progress and metrics of a training job
+    
+    Returns:
+    {
+        "id": "...",
+        "status": "queued|running|completed|failed",
+        "progress": 0.5,
+        "stage": "Fitting model",
+        "metrics": {...},
+        "error": null
+    }
+    """
+    try:
+        fail_stale_jobs()
+        job = get_job(job_id)
+        
+        if job is None:
+            return jsonify({'error': f'Training job not found: {job_id}'}), 404
+        
+        return jsonify(job)
+        
+    except Exception as e:
+        return jsonify({
+            'error': f'Could not get training job: {str(e)}'
+        }), 500
+
+@training_bp.route('/jobs/<job_id>/logs', methods=['GET'])
+def training_job_logs(job_id):
+    """
+    Get log lines of a training job
+    
+    Query parameters:
+        after: Only return log lines with an id greater than this (for polling)
+    
+    Returns:
+    {
+        "job_id": "...",
+        "logs": [{"id": 1, "timestamp": ..., "message": "..."}],
+        "count": 1
+    }
+    """
+    try:
+        if get_job(job_id) is None:
+            return jsonify({'error': f'Training job not found: {job_id}'}), 404
+        
+        after_id = request.args.get('after', 0, type=int)
+        logs = get_job_logs(job_id, after_id)
+        
+        return jsonify({
+            'job_id': job_id,
+            'logs': logs,
+            'count': len(logs)
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'error': f'Could not get training job logs: {str(e)}'
+        }), 500
+
+@training_bp.route('/leaderboard', methods=['GET'])
+def model_leaderboard():
+    """
+    Get the leaderboard of the latest model selection run
+    
+    Returns:
+    {
+        "created_at": 1700000000.0,
+        "promoted": {...},
+        "leaderboard": [{"rank": 1, "model": "...", "f1_mean": ..., "single_ms_mean": ...}, ...]
+    }
+    """
+    try:
+        report = load_leaderboard() if load_leaderboard else None
+        
+        if report is None:
+            return jsonify({'error': 'No model selection run yet'}), 404
+        
+        return jsonify(report)
+        
+    except Exception as e:
+        return jsonify({
+            'error': f'Could not get leaderboard: {str(e)}'
+        }), 500
+
 @training_bp.route('/download_sample_csv', methods=['GET'])
 def download_sample_csv():
     """
@@ -391,7 +627,8 @@ def training_history():
                         'model_type': model.model_type,
                         'model_loaded': True,
                         'model_file_exists': os.path.exists(model.model_path),
-                        'vectorizer_file_exists': os.path.exists(model.vectorizer_path)
+                        'vectorizer_file_exists': os.path.exists(model.vectorizer_path),
+                        'training_corpus': model.get_training_store().stats()
                     }
                 else:
                     model_info = {'model_loaded': False}
@@ -414,6 +651,7 @@ def training_history():
         return jsonify({
             'model_info': model_info,
             'training_files': training_files,
+            'recent_jobs': list_jobs(10),
             'upload_folder': UPLOAD_FOLDER,
             'allowed_extensions': list(ALLOWED_EXTENSIONS)
         })
@@ -435,7 +673,9 @@ def training_health():
             'service': 'training',
             'model_available': model_available,
             'upload_folder_exists': upload_folder_exists,
-            'upload_folder': UPLOAD_FOLDER
+            'upload_folder': UPLOAD_FOLDER,
+            'pending_jobs': count_pending_jobs(),
+            'max_pending_jobs': MAX_PENDING_JOBS
         })
         
     except Exception as e:
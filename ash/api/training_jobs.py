@@ -0,0 +1,387 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from typing import Dict, Any, List, Optional
+
+# Add the models directory to the path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'models'))
+
+# Configuration
+JOBS_DB_PATH = os.getenv('TRAINING_JOBS_DB_PATH', 'data/training_jobs.db')
+MODEL_LOCK_PATH = os.getenv('TRAINING_LOCK_PATH', 'models/.training.lock')
+MAX_PENDING_JOBS = int(os.getenv('TRAINING_MAX_PENDING_JOBS', 4))
+
+# Job processes refresh heartbeat_at every TRAINING_JOB_HEARTBEAT_INTERVAL
+# seconds. A queued or running job whose process is gone, or whose heartbeat
+# is older than TRAINING_JOB_STALE_SECONDS, is marked failed.
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('TRAINING_JOB_HEARTBEAT_INTERVAL', 10))
+JOB_STALE_SECONDS = float(os.getenv('TRAINING_JOB_STALE_SECONDS', 120))
+
+JOB_STATUSES = ('queued', 'running', 'completed', 'failed')
+
+# Columns missing from databases created by older versions
+JOB_COLUMN_MIGRATIONS = {'validation': 'TEXT', 'pid': 'INTEGER', 'heartbeat_at': 'REAL'}
+
+def _connect() -> sqlite3.Connection:
+    """Open a connection to the jobs database"""
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_jobs_db():
+    """Initialize the training jobs database"""
+    os.makedirs(os.path.dirname(JOBS_DB_PATH) or '.', exist_ok=True)
+
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS training_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0.0,
+            stage TEXT DEFAULT '',
+            params TEXT DEFAULT '{}',
+            metrics TEXT,
+            error TEXT,
+            validation TEXT,
+            pid INTEGER,
+            heartbeat_at REAL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    # Columns added after the table was first created
+    existing = {row[1] for row in cursor.execute('PRAGMA table_info(training_jobs)')}
+    for column, column_type in JOB_COLUMN_MIGRATIONS.items():
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE training_jobs ADD COLUMN {column} {column_type}')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS training_job_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            message TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_logs_job ON training_job_logs (job_id, id)')
+    conn.commit()
+    conn.close()
+
+def _update_job(job_id: str, **fields):
+    """Update columns of a job row"""
+    for key in ('metrics', 'validation'):
+        if key in fields and fields[key] is not None:
+            fields[key] = json.dumps(fields[key], default=float)
+
+    assignments = ', '.join(f'{key} = ?' for key in fields)
+    conn = _connect()
+    conn.execute(f'UPDATE training_jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+def append_job_log(job_id: str, message: str):
+    """Append a log line to a job"""
+    conn = _connect()
+    conn.execute(
+        'INSERT INTO training_job_logs (job_id, timestamp, message) VALUES (?, ?, ?)',
+        (job_id, time.time(), message)
+    )
+    conn.commit()
+    conn.close()
+
+def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+    """Convert a job row to a JSON-serializable dict"""
+    job = dict(row)
+    job['params'] = json.loads(job['params'] or '{}')
+    job['metrics'] = json.loads(job['metrics']) if job['metrics'] else None
+    job['validation'] = json.loads(job['validation']) if job.get('validation') else None
+    return job
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Get a job by id"""
+    conn = _connect()
+    row = conn.execute('SELECT * FROM training_jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    return _row_to_job(row) if row else None
+
+def list_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    """List the most recent jobs"""
+    conn = _connect()
+    rows = conn.execute(
+        'SELECT * FROM training_jobs ORDER BY created_at DESC LIMIT ?', (limit,)
+    ).fetchall()
+    conn.close()
+    return [_row_to_job(row) for row in rows]
+
+def get_job_logs(job_id: str, after_id: int = 0) -> List[Dict[str, Any]]:
+    """Get log lines of a job, optionally only those after a log id"""
+    conn = _connect()
+    rows = conn.execute(
+        'SELECT id, timestamp, message FROM training_job_logs WHERE job_id = ? AND id > ? ORDER BY id',
+        (job_id, after_id)
+    ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def _process_alive(pid: int) -> bool:
+    """Whether a process with this pid exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by someone else
+    return True
+
+def fail_stale_jobs() -> int:
+    """
+    Mark queued or running jobs whose process died as failed
+
+    A job is dead when its process no longer exists, or when it has not
+    sent a heartbeat (or, before its first one, been created) within
+    JOB_STALE_SECONDS - which also covers jobs of a host that restarted.
+
+    Returns:
+        Number of jobs marked failed
+    """
+    # Reap this worker's finished job processes, so their pids disappear
+    multiprocessing.active_children()
+
+    now = time.time()
+    conn = _connect()
+    rows = conn.execute(
+        "SELECT id, pid, COALESCE(heartbeat_at, created_at) AS seen FROM training_jobs "
+        "WHERE status IN ('queued', 'running')"
+    ).fetchall()
+
+    failed = 0
+    for row in rows:
+        if row['pid'] is not None and not _process_alive(row['pid']):
+            error = f"Job process {row['pid']} exited unexpectedly"
+        elif now - row['seen'] > JOB_STALE_SECONDS:
+            error = f"No heartbeat from the job process for {now - row['seen']:.0f}s"
+        else:
+            continue
+        # Only if the job didn't finish meanwhile
+        cursor = conn.execute(
+            "UPDATE training_jobs SET status = 'failed', error = ?, finished_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'running')",
+            (error, now, row['id'])
+        )
+        if cursor.rowcount:
+            conn.execute(
+                'INSERT INTO training_job_logs (job_id, timestamp, message) VALUES (?, ?, ?)',
+                (row['id'], now, error)
+            )
+            failed += 1
+    conn.commit()
+    conn.close()
+    return failed
+
+def count_pending_jobs() -> int:
+    """Number of queued or running jobs (dead ones are marked failed first)"""
+    fail_stale_jobs()
+    conn = _connect()
+    count = conn.execute(
+        "SELECT COUNT(*) FROM training_jobs WHERE status IN ('queued', 'running')"
+    ).fetchone()[0]
+    conn.close()
+    return count
+
+class _JobLogWriter:
+    """File-like object that mirrors writes into the job log"""
+
+    def __init__(self, job_id: str, stream):
+        self.job_id = job_id
+        self.stream = stream
+        self.buffer = ''
+
+    def write(self, text: str):
+        self.stream.write(text)
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            if line.strip():
+                append_job_log(self.job_id, line)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def _run_job(job_id: str):
+    """
+    Job process entry point
+
+    Ingests the uploaded CSV if there is one, then waits for the model lock so
+    only one job writes models/spam_model.joblib at a time and retrains.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return
+
+    params = job['params']
+    sys.stdout = _JobLogWriter(job_id, sys.__stdout__)
+    _start_heartbeat(job_id)
+
+    try:
+        # Uploads are ingested before waiting for the model lock: the corpus
+        # store takes its own transaction
+        if params.get('upload_path') and not _ingest_upload(job_id, params):
+            return
+        _train(job_id, params)
+    finally:
+        # The job owns its input files
+        for path in params.get('cleanup_files', []):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _start_heartbeat(job_id: str):
+    """Record this process and refresh the job's heartbeat until the process exits"""
+    _update_job(job_id, pid=os.getpid(), heartbeat_at=time.time())
+
+    def beat():
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                _update_job(job_id, heartbeat_at=time.time())
+            except sqlite3.Error as e:
+                print(f"Warning: Could not record job heartbeat: {e}", file=sys.__stderr__)
+
+    threading.Thread(target=beat, daemon=True).start()
+
+def _ingest_upload(job_id: str, params: Dict[str, Any]) -> bool:
+    """
+    Validate an uploaded CSV in chunks and append it to the corpus store
+
+    Row errors and counts are recorded in the job's validation field.
+
+    Returns:
+        True if the upload was stored and training should go on
+    """
+    import pandas as pd
+    from api.training import ingest_csv_file, CSVValidationError
+    from training_store import TrainingCorpusStore
+
+    _update_job(job_id, status='running', started_at=time.time(), stage='Validating upload')
+    append_job_log(job_id, f"Validating upload {params.get('filename', '')}")
+    try:
+        validation = ingest_csv_file(params['upload_path'], TrainingCorpusStore())
+    except CSVValidationError as e:
+        error, validation = f'Invalid CSV format: {e}', {
+            'valid': False, 'issues': [str(e)], 'row_errors': e.row_errors, **e.details
+        }
+    except pd.errors.EmptyDataError:
+        error, validation = 'CSV file is empty', {'valid': False, 'issues': ['CSV file is empty']}
+    except pd.errors.ParserError as e:
+        error, validation = f'Error parsing CSV file: {e}', {'valid': False, 'issues': [str(e)]}
+    except Exception as e:
+        append_job_log(job_id, traceback.format_exc())
+        error, validation = f'Error processing CSV: {e}', None
+    else:
+        validation['upload_bytes'] = params.get('upload_bytes')
+        _update_job(job_id, validation=validation, stage='Upload stored')
+        append_job_log(job_id, f"Stored {validation['added']} new samples "
+                               f"({validation['duplicates']} duplicates) in {validation['chunks']} chunks")
+        params['new_samples'] = validation['added']
+        params['duplicate_samples'] = validation['duplicates']
+        return True
+
+    append_job_log(job_id, error)
+    _update_job(job_id, status='failed', error=error, validation=validation, finished_at=time.time())
+    return False
+
+def _train(job_id: str, params: Dict[str, Any]):
+    """Retrain under the model lock and record progress, metrics and logs"""
+    os.makedirs(os.path.dirname(MODEL_LOCK_PATH) or '.', exist_ok=True)
+    with open(MODEL_LOCK_PATH, 'w') as lock_file:
+        append_job_log(job_id, 'Waiting for model lock')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _update_job(job_id, status='running', stage='Starting')
+            if get_job(job_id)['started_at'] is None:
+                _update_job(job_id, started_at=time.time())
+
+            from spam_detection import SpamDetectionModel
+
+            def progress_callback(progress: float, message: str):
+                _update_job(job_id, progress=progress, stage=message)
+                append_job_log(job_id, message)
+
+            model = SpamDetectionModel("custom")
+            if params.get('mode') == 'select':
+                results = model.select_model(progress_callback=progress_callback)
+                results['new_samples'] = params.get('new_samples', 0)
+                results['duplicate_samples'] = params.get('duplicate_samples', 0)
+                results['total_samples'] = model.get_training_store().count()
+            elif params.get('csv_path'):
+                results = model.retrain_with_new_data(params['csv_path'], progress_callback=progress_callback)
+            else:
+                # Samples are already in the corpus store; train on all of it
+                results = model.train_custom_model(progress_callback=progress_callback)
+                results['new_samples'] = params.get('new_samples', 0)
+                results['duplicate_samples'] = params.get('duplicate_samples', 0)
+                results['total_samples'] = model.get_training_store().count()
+
+            if 'error' in results:
+                _update_job(job_id, status='failed', error=results['error'], finished_at=time.time())
+            else:
+                _update_job(job_id, status='completed', progress=1.0, stage='Done',
+                            metrics=results, finished_at=time.time())
+        except Exception as e:
+            append_job_log(job_id, traceback.format_exc())
+            _update_job(job_id, status='failed', error=str(e), finished_at=time.time())
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def submit_training_job(kind: str, csv_path: str = None, cleanup_files: List[str] = None, **params) -> str:
+    """
+    Queue a retraining job and start it in a separate process
+
+    Args:
+        kind: Job kind ('retrain_model' or 'add_training_samples')
+        csv_path: Optional CSV with text/label columns to add before training;
+                  without it the job trains on the corpus store as is
+        cleanup_files: Files to delete once the job finishes
+
+    Returns:
+        The job id
+    """
+    init_jobs_db()
+
+    job_id = uuid.uuid4().hex
+    params = {'csv_path': csv_path, 'cleanup_files': cleanup_files or [], **params}
+
+    conn = _connect()
+    conn.execute(
+        'INSERT INTO training_jobs (id, kind, status, params, created_at) VALUES (?, ?, ?, ?, ?)',
+        (job_id, kind, 'queued', json.dumps(params), time.time())
+    )
+    conn.commit()
+    conn.close()
+
+    # Reap finished job processes
+    multiprocessing.active_children()
+
+    # Spawn rather than fork so the job doesn't inherit the Flask worker's threads
+    process = multiprocessing.get_context('spawn').Process(target=_run_job, args=(job_id,), daemon=False)
+    try:
+        process.start()
+    except Exception as e:
+        _update_job(job_id, status='failed', error=f'Could not start job process: {e}', finished_at=time.time())
+        raise
+    # Recorded right away so a child that dies before its first heartbeat is noticed
+    _update_job(job_id, pid=process.pid)
+
+    return job_id
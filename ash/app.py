@@ -9,9 +9,22 @@ load_dotenv()
 # Import blueprints
 from api.layer1 import layer1_bp
 from api.layer2 import layer2_bp
-from api.rag_functions import rag_bp
+from api.rag_proxy import RAG_STORE_URL, rag_proxy_bp
 from api.training import training_bp
 
+def create_rag_app():
+    """App serving only the RAG store, run as a single process (rag-store.service)"""
+    from api.rag_functions import rag_bp
+    
+    app = Flask(__name__)
+    app.register_blueprint(rag_bp, url_prefix='/api/rag')
+    
+    @app.route('/health', methods=['GET'])
+    def health_check():
+        return jsonify({'status': 'healthy', 'service': 'rag-store'})
+    
+    return app
+
 def create_app():
     app = Flask(__name__)
     
@@ -32,7 +45,13 @@ def create_app():
     # Register blueprints
     app.register_blueprint(layer1_bp, url_prefix='/api/layer1')
     app.register_blueprint(layer2_bp, url_prefix='/api/layer2')
-    app.register_blueprint(rag_bp, url_prefix='/api/rag')
+    if RAG_STORE_URL:
+        # The store runs in its own process; workers forward to it
+        app.register_blueprint(rag_proxy_bp, url_prefix='/api/rag')
+    else:
+        # The store lives in this process, which must be the only one
+        from api.rag_functions import rag_bp
+        app.register_blueprint(rag_bp, url_prefix='/api/rag')
     app.register_blueprint(training_bp, url_prefix='/api/training')
     
     # Add headers for external access
@@ -89,13 +108,21 @@ def create_app():
                     'get_call_history': '/api/rag/get_call_history',
                     'post_suspect_info': '/api/rag/post_suspect_information',
                     'add_user_docs': '/api/rag/add_user_documents',
-                    'search_all': '/api/rag/search_all'
+                    'bulk_add': '/api/rag/bulk_add',
+                    'search_all': '/api/rag/search_all',
+                    'lookup': '/api/rag/lookup',
+                    'delete_documents': '/api/rag/delete_documents',
+                    'update_document': '/api/rag/update_document'
                 },
                 'training': {
                     'retrain_model': '/api/training/retrain_model',
                     'add_samples': '/api/training/add_training_samples',
                     'download_sample': '/api/training/download_sample_csv',
                     'history': '/api/training/training_history',
+                    'leaderboard': '/api/training/leaderboard',
+                    'jobs': '/api/training/jobs',
+                    'job_status': '/api/training/jobs/<job_id>',
+                    'job_logs': '/api/training/jobs/<job_id>/logs',
                     'health': '/api/training/health'
                 }
             }
@@ -127,4 +154,5 @@ if __name__ == '__main__':
         print(f"Server configured for external access on port 5000")
         print(f"=" * 50)
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # No reloader: its watcher process would load the RAG store too and own it
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
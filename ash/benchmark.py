@@ -0,0 +1,827 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Spam Detection Functions Server
+Run from the ash directory: python benchmark.py <benchmark>
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'models'))
+
+def _percentiles(samples):
+    """Return p50/p95 of a list of latencies in milliseconds"""
+    samples = np.asarray(samples) * 1000
+    return {
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95))
+    }
+
+def _print_table(rows, columns):
+    """Print a list of dicts as a fixed-width table"""
+    print(" | ".join(f"{col:>14}" for col in columns))
+    print("-" * (17 * len(columns)))
+    for row in rows:
+        print(" | ".join(
+            f"{row[col]:>14.3f}" if isinstance(row[col], float) else f"{str(row[col]):>14}"
+            for col in columns
+        ))
+
+def benchmark_quantization(args):
+    """Compare latency, memory and accuracy of the fp32 and int8 Hugging Face models"""
+    import torch
+    from spam_detection import SpamDetectionModel
+
+    texts_df = SpamDetectionModel("custom").create_sample_dataset()
+    samples = args.samples or 200
+    texts = texts_df['text'].tolist()[:samples]
+    labels = texts_df['label'].tolist()[:samples]
+
+    def model_bytes(pipe):
+        buffer = io.BytesIO()
+        torch.save(pipe.model.state_dict(), buffer)
+        return buffer.tell()
+
+    rows = []
+    predictions = {}
+    for name, quantize in (('fp32', False), ('int8', True)):
+        model = SpamDetectionModel("huggingface", quantize=quantize)
+        if getattr(model, 'model_name', 'rule-based') == 'rule-based':
+            print("Hugging Face model not available, skipping quantization benchmark")
+            return
+
+        # Warm up
+        model.predict(texts[0])
+
+        latencies = []
+        results = []
+        for text in texts:
+            start = time.perf_counter()
+            results.append(model.predict(text))
+            latencies.append(time.perf_counter() - start)
+
+        predictions[name] = results
+        accuracy = np.mean([int(r['is_spam']) == label for r, label in zip(results, labels)])
+        rows.append({
+            'model': name,
+            **_percentiles(latencies),
+            'size_mb': model_bytes(model.model) / 1e6,
+            'accuracy': float(accuracy)
+        })
+
+    _print_table(rows, ['model', 'p50_ms', 'p95_ms', 'size_mb', 'accuracy'])
+
+    fp32_conf = np.array([r['confidence'] for r in predictions['fp32']])
+    int8_conf = np.array([r['confidence'] for r in predictions['int8']])
+    agreement = np.mean([a['is_spam'] == b['is_spam'] for a, b in zip(predictions['fp32'], predictions['int8'])])
+    print()
+    print(f"Prediction agreement: {agreement:.3f}")
+    print(f"Mean |confidence drift|: {np.mean(np.abs(fp32_conf - int8_conf)):.4f}")
+    print(f"Max |confidence drift|: {np.max(np.abs(fp32_conf - int8_conf)):.4f}")
+
+def _synthetic_documents(count, start=0):
+    """Generate call-history style documents for RAG benchmarks"""
+    scams = ['irs warrant', 'car warranty', 'lottery winnings', 'medicare card', 'tech support',
+             'social security', 'student loan', 'gift card', 'bank fraud', 'utility shutoff']
+    categories = ['call_history', 'suspects', 'user_information']
+    for i in range(start, start + count):
+        yield {
+            'title': f'Call {i}',
+            'content': f'Caller +1555{i % 100000:05d} talked about {scams[i % len(scams)]} '
+                       f'and asked for payment number {i % 997} reference {i}',
+            'category': categories[i % len(categories)],
+            'metadata': {'phone_number': f'+1555{i % 100000:05d}', 'source': 'benchmark'}
+        }
+
+def benchmark_rag_persistence(args):
+    """Measure journal write amplification, compaction and startup time of the local RAG store"""
+    import json
+    import shutil
+    import tempfile
+    import api.rag_functions as rag_functions
+
+    count = args.samples or 100000
+    batch_size = 1000
+    data_dir = tempfile.mkdtemp(prefix='rag_persistence_')
+    data_file = os.path.join(data_dir, 'rag_storage.json')
+
+    try:
+        storage = rag_functions.LocalRAGStorage(data_file)
+        logical_bytes = 0
+        rewrite_bytes = 0
+        pretty_bytes_per_doc = None
+
+        start = time.perf_counter()
+        for batch_start in range(0, count, batch_size):
+            batch = list(_synthetic_documents(min(batch_size, count - batch_start), batch_start))
+            storage.add_documents(batch)
+            batch_bytes = sum(len(json.dumps(doc)) for doc in batch)
+            logical_bytes += batch_bytes
+            if pretty_bytes_per_doc is None:
+                pretty_bytes_per_doc = len(json.dumps({'documents': list(storage.documents)}, indent=2)) / len(storage.documents)
+            # The previous implementation rewrote the whole pretty-printed file per batch
+            rewrite_bytes += pretty_bytes_per_doc * len(storage.documents)
+        ingest_seconds = time.perf_counter() - start
+
+        if storage._compact_thread is not None:
+            storage._compact_thread.join()
+        journal_bytes = storage.persistence_stats()['bytes_written']
+
+        start = time.perf_counter()
+        storage.save_data()
+        compact_seconds = time.perf_counter() - start
+        single_writer = _check_single_writer(rag_functions, storage, data_file)
+        storage.close()
+
+        # Startup: replay only, then replay + vectorize
+        original_update = rag_functions.LocalRAGStorage._update_vectors
+        rag_functions.LocalRAGStorage._update_vectors = lambda self: None
+        start = time.perf_counter()
+        rag_functions.LocalRAGStorage(data_file).close()
+        load_seconds = time.perf_counter() - start
+        rag_functions.LocalRAGStorage._update_vectors = original_update
+
+        start = time.perf_counter()
+        reloaded = rag_functions.LocalRAGStorage(data_file)
+        startup_seconds = time.perf_counter() - start
+
+        print(f"Documents:                  {len(reloaded.documents)}")
+        print(f"Ingest time:                {ingest_seconds:.2f} s ({count / ingest_seconds:.0f} docs/s)")
+        print(f"Logical bytes:              {logical_bytes / 1e6:.1f} MB")
+        print(f"Journal + compaction bytes: {journal_bytes / 1e6:.1f} MB "
+              f"(write amplification {journal_bytes / logical_bytes:.2f}x)")
+        print(f"Full rewrite per batch:     {rewrite_bytes / 1e6:.1f} MB "
+              f"(write amplification {rewrite_bytes / logical_bytes:.0f}x, estimated)")
+        print(f"Final compaction:           {compact_seconds:.2f} s, snapshot {os.path.getsize(data_file) / 1e6:.1f} MB")
+        print(f"Startup (load + replay):    {load_seconds:.2f} s")
+        print(f"Startup (with vectorizing): {startup_seconds:.2f} s")
+        print(f"Single writer:              {single_writer}")
+        print(f"Compaction recovery:        {_check_compaction_recovery(rag_functions, reloaded, data_file)}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def _check_single_writer(rag_functions, storage, data_file):
+    """Check that a second process cannot write a store another one owns, and takes over once it exits"""
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    released = context.Event()
+    other = context.Process(target=_second_writer, args=(data_file, results, released))
+    other.start()
+    problems = []
+    try:
+        read_only = results.get(timeout=600)
+        if read_only != 'read-only':
+            problems.append(f"second process could write while another owned the store ({read_only})")
+        # Written after the other process loaded; it must see these once it takes over
+        storage.add_documents(list(_synthetic_documents(5, 10 ** 8)))
+        expected = storage.document_count
+        storage.close()
+        released.set()
+        took_over = results.get(timeout=600)
+        if took_over != expected + 1:
+            problems.append(f"after taking over expected {expected + 1} documents, found {took_over}")
+        other.join()
+        if not storage._acquire_owner():
+            problems.append("ownership was not released on exit")
+        else:
+            storage.load_data()
+    finally:
+        if other.is_alive():
+            other.terminate()
+    return '; '.join(problems) if problems else 'ok'
+
+def _second_writer(data_file, results, released):
+    """Second process for _check_single_writer"""
+    import api.rag_functions as rag_functions
+
+    storage = rag_functions.LocalRAGStorage(data_file)
+    try:
+        storage.add_documents(list(_synthetic_documents(1, 10 ** 8 + 100)))
+        results.put('wrote')
+    except rag_functions.RAGStorageReadOnly:
+        results.put('read-only')
+    released.wait()
+    try:
+        storage.add_documents(list(_synthetic_documents(1, 10 ** 8 + 100)))
+        results.put(storage.document_count)
+    except rag_functions.RAGStorageReadOnly as e:
+        results.put(str(e))
+    storage.close()
+
+def _check_compaction_recovery(rag_functions, storage, data_file):
+    """Check that a failed compaction is retried and a crashed one is folded in on startup"""
+    rotated = storage.journal_file + '.compacting'
+    min_entries, ratio = rag_functions.RAG_COMPACT_MIN_ENTRIES, rag_functions.RAG_COMPACT_RATIO
+    rag_functions.RAG_COMPACT_MIN_ENTRIES, rag_functions.RAG_COMPACT_RATIO = 5, 0.0
+    problems = []
+    try:
+        # A compaction that fails (e.g. disk error) leaves its rotation behind...
+        write_snapshot = storage._write_snapshot
+
+        def failing_snapshot(*args):
+            raise OSError("simulated disk error")
+
+        storage._write_snapshot = failing_snapshot
+        storage.add_documents(list(_synthetic_documents(10, 10 ** 7)))
+        storage._compact_thread.join()
+        storage._write_snapshot = write_snapshot
+        if not os.path.exists(rotated):
+            problems.append("failed compaction left no rotation")
+
+        # ... which the next compaction folds in together with the new journal
+        storage.add_documents(list(_synthetic_documents(10, 10 ** 7 + 10)))
+        if storage._compact_thread is not None:
+            storage._compact_thread.join()
+        if os.path.exists(rotated) or storage.persistence_stats()['journal_entries'] > 5:
+            problems.append("compaction did not retry after a failure")
+
+        # A crash mid-compaction leaves a rotation that startup folds into the snapshot
+        storage.add_documents(list(_synthetic_documents(3, 10 ** 7 + 20)))
+        os.replace(storage.journal_file, rotated)
+        expected = storage.document_count
+        storage.close()
+        restarted = rag_functions.LocalRAGStorage(data_file)
+        if os.path.exists(rotated) or os.path.exists(storage.journal_file):
+            problems.append("startup did not fold the interrupted compaction")
+        if restarted.document_count != expected:
+            problems.append(f"expected {expected} documents after restart, found {restarted.document_count}")
+        restarted.close()
+    finally:
+        rag_functions.RAG_COMPACT_MIN_ENTRIES, rag_functions.RAG_COMPACT_RATIO = min_entries, ratio
+    return '; '.join(problems) if problems else 'ok'
+
+def benchmark_rag_search(args):
+    """Compare the sparse dot-product/argpartition search kernel with cosine_similarity/argsort"""
+    import tracemalloc
+    from scipy import sparse
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    from api.rag_functions import LocalRAGStorage
+
+    max_docs = args.samples or 1000000
+    sizes = [n for n in (1000, 10000, 100000, 1000000, 5000000) if n <= max_docs]
+    queries = ['car warranty expired', 'irs warrant payment', 'gift card reference', 'bank fraud caller']
+    top_k = 5
+
+    # Vectorize a base block once and tile it up to the largest corpus size
+    base_size = min(100000, sizes[-1])
+    vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
+    base = vectorizer.fit_transform(doc['content'] for doc in _synthetic_documents(base_size)).tocsr()
+    query_vectors = [vectorizer.transform([q]) for q in queries]
+
+    def sparse_kernel(matrix, query_vector):
+        scores = matrix.dot(query_vector.toarray().ravel())
+        return LocalRAGStorage._top_k(scores, top_k, 0.0)
+
+    def dense_kernel(matrix, query_vector):
+        scores = cosine_similarity(query_vector, matrix)[0]
+        return np.argsort(scores)[::-1][:top_k]
+
+    rows = []
+    for size in sizes:
+        reps = -(-size // base_size)
+        matrix = sparse.vstack([base] * reps, format='csr')[:size]
+        matrix_mb = (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 1e6
+
+        for name, kernel in (('sparse_top_k', sparse_kernel), ('cosine_argsort', dense_kernel)):
+            kernel(matrix, query_vectors[0])
+            repeats = max(3, min(50, 10000000 // size))
+            latencies = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                kernel(matrix, query_vectors[i % len(query_vectors)])
+                latencies.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            kernel(matrix, query_vectors[0])
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            rows.append({
+                'docs': size,
+                'kernel': name,
+                **_percentiles(latencies),
+                'matrix_mb': matrix_mb,
+                'query_peak_mb': peak / 1e6
+            })
+        del matrix
+
+    _print_table(rows, ['docs', 'kernel', 'p50_ms', 'p95_ms', 'matrix_mb', 'query_peak_mb'])
+
+def benchmark_rag_concurrency(args):
+    """Stress the local RAG store with parallel adds, deletes, updates, vacuums and searches and check every result"""
+    import random
+    import re
+    import shutil
+    import tempfile
+    import threading
+    import api.rag_functions as rag_functions
+
+    total_docs = args.samples or 50000
+    writers, readers, mutators, batch_size = 4, 8, 2, 250
+    docs_per_writer = total_docs // writers
+    categories = ['call_history', 'suspects', 'user_information']
+    # Low enough that deletes and updates trigger several vacuums mid-run
+    vacuum_ratio, min_vacuums = rag_functions.RAG_VACUUM_RATIO, 2
+    rag_functions.RAG_VACUUM_RATIO = 0.05
+
+    rows = []
+    for backend in rag_functions.RAG_BACKENDS:
+        data_dir = tempfile.mkdtemp(prefix='rag_concurrency_')
+        data_file = os.path.join(data_dir, 'rag_storage.json')
+        storage = rag_functions.LocalRAGStorage(data_file, backend=backend)
+        added_ids = list(storage.add_documents(list(_synthetic_documents(1000))))
+
+        errors = []
+        latencies = []
+        writers_done = threading.Event()
+        done = threading.Event()
+        # Ids whose delete started, completion times of deletes and versions
+        # (with completion times) of finished updates
+        deleting = set()
+        deleted_at = {}
+        versions = {}
+        vacuums = []
+        vacuum = storage._vacuum
+
+        def counting_vacuum():
+            result = vacuum()
+            vacuums.append(time.perf_counter())
+            return result
+
+        storage._vacuum = counting_vacuum
+
+        def check(results, started, category=None, phone=None):
+            for result in results:
+                doc_id = result['id']
+                # Every field must come from the same row
+                number = re.search(r'reference (\d+)', result['content']).group(1)
+                if result['title'] != f'Call {number}' or \
+                        result['metadata'].get('phone_number') != f'+1555{int(number) % 100000:05d}':
+                    errors.append(f"result {doc_id} mixes fields of different documents")
+                if deleted_at.get(doc_id, float('inf')) < started:
+                    errors.append(f"result {doc_id} was deleted before the search started")
+                version, finished = versions.get(doc_id, (0, float('inf')))
+                if result['metadata'].get('version', 0) < version and finished < started:
+                    errors.append(f"result {doc_id} is older than an update finished before the search")
+                doc = storage.get_document(doc_id)
+                if doc is None:
+                    if doc_id not in deleting:
+                        errors.append(f"result {doc_id} has no document")
+                elif doc['title'] != result['title']:
+                    errors.append(f"result {doc_id} does not match its document")
+                if category and result['category'] != category:
+                    errors.append(f"result {doc_id} outside category {category}")
+                if phone and result['metadata'].get('phone_number') != phone:
+                    errors.append(f"result {doc_id} does not match phone {phone}")
+
+        def writer(index):
+            try:
+                start = 1000 + index * docs_per_writer
+                for offset in range(0, docs_per_writer, batch_size):
+                    added_ids.extend(storage.add_documents(list(_synthetic_documents(
+                        min(batch_size, docs_per_writer - offset), start + offset))))
+            except Exception as e:
+                errors.append(f"writer {index}: {e!r}")
+
+        def mutator(index):
+            # Each mutator owns the ids congruent to its index, so versions only grow
+            rng = random.Random(100 + index)
+            live = []
+            seen = 0
+            try:
+                while not (writers_done.is_set() and len(vacuums) >= min_vacuums):
+                    live.extend(doc_id for doc_id in added_ids[seen:] if doc_id % mutators == index)
+                    seen = len(added_ids)
+                    if not live:
+                        time.sleep(0.01)
+                        continue
+                    position = rng.randrange(len(live))
+                    doc_id = live[position]
+                    if rng.random() < 0.4:
+                        live[position] = live[-1]
+                        live.pop()
+                        deleting.add(doc_id)
+                        if storage.delete_documents([doc_id]) != [doc_id]:
+                            errors.append(f"mutator {index}: delete of live document {doc_id} failed")
+                        deleted_at[doc_id] = time.perf_counter()
+                    else:
+                        version = versions.get(doc_id, (0, 0))[0] + 1
+                        doc = storage.get_document(doc_id)
+                        metadata = dict(doc['metadata'], version=version)
+                        if not storage.update_document(doc_id, content=doc['content'] + ' updated',
+                                                       metadata=metadata):
+                            errors.append(f"mutator {index}: update of live document {doc_id} failed")
+                        versions[doc_id] = (version, time.perf_counter())
+            except Exception as e:
+                errors.append(f"mutator {index}: {e!r}")
+
+        def reader(index):
+            rng = random.Random(index)
+            words = ['warranty', 'irs warrant', 'gift card', 'payment', 'medicare', 'reference 42', 'updated']
+            try:
+                while not done.is_set():
+                    query = rng.choice(words) + f' {rng.randrange(997)}'
+                    category = rng.choice(categories + [None])
+                    phone = f'+1555{rng.randrange(min(100000, len(storage.documents))):05d}' \
+                        if rng.random() < 0.3 else None
+                    metadata = {'phone_number': phone} if phone else None
+
+                    start = time.perf_counter()
+                    results = storage.search(query, top_k=5, category=category, metadata=metadata)
+                    latencies.append(time.perf_counter() - start)
+                    check(results, start, category, phone)
+                    if phone:
+                        lookup_start = time.perf_counter()
+                        check(storage.lookup(metadata, category=category), lookup_start, category, phone)
+            except Exception as e:
+                errors.append(f"reader {index}: {e!r}")
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+        mutate_threads = [threading.Thread(target=mutator, args=(i,)) for i in range(mutators)]
+        write_threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+        start = time.perf_counter()
+        for thread in threads + mutate_threads + write_threads:
+            thread.start()
+        for thread in write_threads:
+            thread.join()
+        write_seconds = time.perf_counter() - start
+        writers_done.set()
+        for thread in mutate_threads:
+            thread.join()
+        done.set()
+        for thread in threads:
+            thread.join()
+        if storage._compact_thread is not None:
+            storage._compact_thread.join()
+
+        # Final state: live count, id -> row map and the latest versions, in
+        # memory and after reloading the snapshot and journal
+        expected = len(added_ids) - len(deleted_at)
+        view = storage._view
+        if storage.document_count != expected or len(view.id_rows) != expected:
+            errors.append(f"expected {expected} live documents, found {storage.document_count} "
+                          f"({len(view.id_rows)} ids)")
+        deleted_rows = set(view.deleted_rows.tolist())
+        if any(view.documents.ids[row] != doc_id or row in deleted_rows for doc_id, row in view.id_rows.items()):
+            errors.append("id -> row map does not match the documents")
+        storage.save_data()
+        storage.close()
+        reloaded = rag_functions.LocalRAGStorage(data_file, backend=backend)
+        for label, store in (('memory', storage), ('reload', reloaded)):
+            if store.document_count != expected:
+                errors.append(f"{label}: expected {expected} live documents, found {store.document_count}")
+            if any(store.get_document(doc_id) is not None for doc_id in deleted_at):
+                errors.append(f"{label}: deleted documents are still stored")
+            stale = [doc_id for doc_id, (version, _) in versions.items() if doc_id not in deleted_at and
+                     store.get_document(doc_id)['metadata'].get('version') != version]
+            if stale:
+                errors.append(f"{label}: {len(stale)} documents lost their latest update")
+
+        rows.append({
+            'backend': backend,
+            'docs_per_s': writers * docs_per_writer / write_seconds,
+            'deletes': len(deleted_at),
+            'updates': sum(version for version, _ in versions.values()),
+            'vacuums': len(vacuums),
+            'searches': len(latencies),
+            **_percentiles(latencies),
+            'errors': len(errors)
+        })
+        for error in errors[:10]:
+            print(f"  {backend}: {error}")
+        reloaded.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    rag_functions.RAG_VACUUM_RATIO = vacuum_ratio
+    _print_table(rows, ['backend', 'docs_per_s', 'deletes', 'updates', 'vacuums', 'searches',
+                        'p50_ms', 'p95_ms', 'errors'])
+
+def benchmark_rag_memory(args):
+    """Bytes per document of the list-of-dicts representation vs the columnar store"""
+    import gc
+    import json
+    import tracemalloc
+    from api.rag_columns import DocumentColumns
+
+    count = args.samples or 200000
+    batch_size = 10000
+    now = time.time()
+
+    def batches():
+        for start in range(0, count, batch_size):
+            batch = list(_synthetic_documents(min(batch_size, count - start), start))
+            for offset, doc in enumerate(batch):
+                doc.update({'id': start + offset, 'timestamp': now})
+            yield batch
+
+    # Before: documents as loaded from the JSON snapshot
+    gc.collect()
+    tracemalloc.start()
+    documents = []
+    for batch in batches():
+        documents.extend(json.loads(json.dumps(batch)))
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del documents
+    gc.collect()
+
+    # After: packed arrays in RAM, text and metadata in the mmap'd blob
+    tracemalloc.start()
+    columns = DocumentColumns()
+    for batch in batches():
+        columns.append_many(batch)
+    column_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    stats = columns.memory_stats()
+
+    _print_table([
+        {'layout': 'list_of_dicts', 'ram_per_doc': dict_bytes / count, 'blob_per_doc': 0.0},
+        {'layout': 'columnar', 'ram_per_doc': column_bytes / count, 'blob_per_doc': stats['blob_bytes_per_doc']},
+    ], ['layout', 'ram_per_doc', 'blob_per_doc'])
+    print()
+    print(f"Documents: {count}, RAM reduction: {dict_bytes / max(1, column_bytes):.1f}x")
+
+def benchmark_rag_dense(args):
+    """Latency and recall@10 of the dense index: exact vs IVF, float32 vs int8"""
+    import random
+    import shutil
+    import tempfile
+    import api.rag_dense as rag_dense
+
+    max_docs = args.samples or 200000
+    sizes = [n for n in (10000, 100000, 1000000) if n < max_docs] + [max_docs]
+    top_k = 10
+    rag_dense.RAG_DENSE_IVF_THRESHOLD = float('inf')  # build the IVF explicitly below
+
+    rng = random.Random(42)
+    rows = []
+    for size in sizes:
+        contents = [doc['content'] for doc in _synthetic_documents(size)]
+        queries = [' '.join(rng.choice(contents).split()[2:8]) for _ in range(100)]
+        # float32 exact search is the ground truth; the corpus has many tied
+        # scores, so a hit counts if its true score reaches the k-th true score
+        reference = None
+        data_dirs = []
+
+        for dtype in ('float32', 'int8'):
+            data_dir = tempfile.mkdtemp(prefix='rag_dense_')
+            data_dirs.append(data_dir)
+            index = rag_dense.DenseIndex(os.path.join(data_dir, 'vectors.dense'), dtype=dtype)
+            start = time.perf_counter()
+            for batch_start in range(0, size, 10000):
+                index.add(contents[batch_start:batch_start + 10000])
+            embed_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            index.build_ivf()
+            ivf_seconds = time.perf_counter() - start
+
+            for mode in ('exact', 'ivf'):
+                latencies = []
+                results = []
+                exact_hits = []
+                for query in queries:
+                    start = time.perf_counter()
+                    hits = index.search(query, top_k, exact=(mode == 'exact'))
+                    latencies.append(time.perf_counter() - start)
+                    results.append({row for row, _ in hits})
+                    exact_hits.append(hits)
+                if reference is None:
+                    reference = (index, [min(score for _, score in hits) if hits else 0.0
+                                         for hits in exact_hits])
+                reference_index, kth_scores = reference
+                recall = np.mean([
+                    np.sum(reference_index.score_rows(reference_index.embed_query(query), np.array(sorted(found)))
+                           >= kth - 1e-5) / top_k if found else 0.0
+                    for query, found, kth in zip(queries, results, kth_scores)
+                ])
+                rows.append({
+                    'docs': size,
+                    'dtype': dtype,
+                    'mode': mode,
+                    **_percentiles(latencies),
+                    'recall@10': float(recall),
+                    'matrix_mb': index.num_rows * index.dim * np.dtype(index.dtype).itemsize / 1e6,
+                    'build_s': embed_seconds + (ivf_seconds if mode == 'ivf' else 0.0)
+                })
+        for data_dir in data_dirs:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    _print_table(rows, ['docs', 'dtype', 'mode', 'p50_ms', 'p95_ms', 'recall@10', 'matrix_mb', 'build_s'])
+
+def benchmark_rag_retention(args):
+    """Rows and search latency over simulated months of call-history ingest, with and without retention"""
+    import shutil
+    import tempfile
+    import api.rag_functions as rag_functions
+
+    per_day = args.samples or 1000
+    days, retention_days = 180, 30
+    queries = ['irs warrant payment', 'car warranty', 'gift card reference', 'medicare card number']
+    start_time = time.time() - days * 86400
+    # Sweeps are driven by the simulated clock below
+    rag_functions.RAG_RETENTION_INTERVAL = float('inf')
+
+    rows = []
+    for retention in (None, retention_days):
+        rag_functions.RAG_RETENTION_DAYS = {'call_history': retention} if retention else {}
+        data_dir = tempfile.mkdtemp(prefix='rag_retention_')
+        storage = rag_functions.LocalRAGStorage(os.path.join(data_dir, 'rag_storage.json'))
+        for day in range(days):
+            now = start_time + day * 86400
+            docs = list(_synthetic_documents(per_day, day * per_day))
+            for doc in docs:
+                doc['category'] = 'call_history'
+                doc['timestamp'] = now
+            storage.add_documents(docs)
+            storage.apply_retention(now=now)
+
+            if (day + 1) % 30 == 0:
+                if storage._compact_thread is not None:
+                    storage._compact_thread.join()
+                latencies = []
+                for i in range(200):
+                    start = time.perf_counter()
+                    storage.search(f'{queries[i % len(queries)]} {i}', top_k=5, category='call_history')
+                    latencies.append(time.perf_counter() - start)
+                rows.append({
+                    'retention': f'{retention}d' if retention else 'none',
+                    'day': day + 1,
+                    'live_docs': storage.document_count,
+                    'rows': len(storage.documents),
+                    'tombstones': storage.persistence_stats()['tombstones'],
+                    **_percentiles(latencies)
+                })
+        if storage._refit_thread is not None:
+            storage._refit_thread.join()
+        if storage._compact_thread is not None:
+            storage._compact_thread.join()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    rag_functions.RAG_RETENTION_DAYS = {}
+
+    _print_table(rows, ['retention', 'day', 'live_docs', 'rows', 'tombstones', 'p50_ms', 'p95_ms'])
+
+def benchmark_qdrant_ingest(args):
+    """Ingest throughput and peak memory of QdrantRAGServer.add_documents vs per-document encoding"""
+    import tracemalloc
+    import uuid
+    try:
+        from qdrant_client.models import PointStruct
+        from rag.qdrant_rag_server import QdrantRAGServer
+        from rag.vector_store import QdrantVectorStore
+    except ImportError as e:
+        print(f"Qdrant client or sentence-transformers not available, skipping ingest benchmark: {e}")
+        return
+
+    count = args.samples or 20000
+    # QDRANT_MODE=local measures the embedded engine instead of a server
+    server = QdrantRAGServer()
+    server.store = QdrantVectorStore('benchmark_ingest', server.vector_size, client=server.client)
+    server.collection_name = server.store.collection_name
+    texts = [doc['content'] for doc in _synthetic_documents(count)]
+
+    def measure(path, docs, ingest):
+        tracemalloc.start()
+        start = time.perf_counter()
+        ingest()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {'path': path, 'docs': docs, 'docs_per_s': docs / seconds, 'peak_mb': peak / 1e6}
+
+    def per_document(batch):
+        # The previous add_documents: one encode call per document, one upsert
+        points = [
+            PointStruct(id=str(uuid.uuid4()), vector=server.encoder.encode(text).tolist(),
+                        payload={'text': text, 'category': 'call_history', 'doc_index': i})
+            for i, text in enumerate(batch)
+        ]
+        server.client.upsert(collection_name=server.collection_name, points=points)
+
+    rows = []
+    try:
+        baseline = texts[:min(count, 2000)]  # the slow path is capped
+        rows.append(measure('per_document', len(baseline), lambda: per_document(baseline)))
+        for size in sorted({max(1, count // 4), count}):
+            # A generator, so the batched path never holds the whole input
+            rows.append(measure('batched', size, lambda: server.add_documents(
+                (text for text in texts[:size]), 'call_history')))
+    finally:
+        server.store.drop()
+
+    _print_table(rows, ['path', 'docs', 'docs_per_s', 'peak_mb'])
+
+def benchmark_qdrant_filtered(args):
+    """Filtered search latency and vector RAM of a legacy collection before and after the in-place migration"""
+    import uuid
+    try:
+        from qdrant_client.models import Distance, VectorParams, PointStruct
+        from qdrant_client.models import Filter, FieldCondition, MatchValue
+        from qdrant_client.models import SearchParams, QuantizationSearchParams
+        from rag import vector_store
+    except ImportError as e:
+        print(f"Qdrant client not available, skipping filtered search benchmark: {e}")
+        return
+
+    count = args.samples or 100000
+    dim = 384
+    name = 'benchmark_filtered'
+    # Payload indexes and quantization need a Qdrant server (QDRANT_MODE=remote)
+    client = vector_store.get_qdrant_client()
+
+    rng = np.random.default_rng(0)
+    categories = ['user_information', 'suspects', 'call_history']
+    phones = [f"+1555{i:07d}" for i in range(1000)]
+    queries = rng.standard_normal((200, dim)).astype(np.float32)
+
+    def wait_green():
+        while str(client.get_collection(name).status).lower().endswith('yellow'):
+            time.sleep(0.5)
+
+    def measure(layout, quantized):
+        params = SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)) if quantized else None
+        info = client.get_collection(name)
+        latencies = []
+        for i, query in enumerate(queries):
+            conditions = [FieldCondition(key='category', match=MatchValue(value=categories[i % 3]))]
+            if i % 2:
+                conditions.append(FieldCondition(key='phone_number', match=MatchValue(value=phones[i % len(phones)])))
+            start = time.perf_counter()
+            client.search(collection_name=name, query_vector=query.tolist(),
+                          query_filter=Filter(must=conditions), search_params=params, limit=5)
+            latencies.append(time.perf_counter() - start)
+        # Vectors Qdrant keeps in RAM: float32 originals unless moved to disk, plus int8 codes
+        ram = 0 if info.config.params.vectors.on_disk else count * dim * 4
+        ram += count * dim if quantized else 0
+        return {'layout': layout, 'points': count, **_percentiles(latencies), 'vector_ram_mb': ram / 1e6,
+                'indexes': len(info.payload_schema or {})}
+
+    rows = []
+    try:
+        if any(col.name == name for col in client.get_collections().collections):
+            client.delete_collection(name)
+        # The layout _setup_collection used to create: plain float vectors, no payload index
+        client.create_collection(collection_name=name,
+                                 vectors_config=VectorParams(size=dim, distance=Distance.COSINE))
+        for start in range(0, count, 1000):
+            size = min(1000, count - start)
+            vectors = rng.standard_normal((size, dim)).astype(np.float32)
+            client.upsert(collection_name=name, wait=True, points=[
+                PointStruct(id=str(uuid.uuid4()), vector=vector.tolist(), payload={
+                    'text': f"document {start + i}",
+                    'category': categories[(start + i) % 3],
+                    'phone_number': phones[(start + i) % len(phones)]
+                })
+                for i, vector in enumerate(vectors)
+            ])
+        wait_green()
+        rows.append(measure('legacy', False))
+
+        # Opening the store migrates the existing collection in place
+        vector_store.QDRANT_QUANTIZATION = 'none'
+        vector_store.QDRANT_ON_DISK_VECTORS = False
+        store = vector_store.QdrantVectorStore(name, dim, client=client)
+        wait_green()
+        rows.append(measure('indexed', False))
+
+        vector_store.QDRANT_QUANTIZATION = 'int8'
+        vector_store.QDRANT_ON_DISK_VECTORS = True
+        store.setup()
+        wait_green()
+        rows.append(measure('indexed_int8', True))
+    finally:
+        client.delete_collection(name)
+
+    _print_table(rows, ['layout', 'points', 'p50_ms', 'p95_ms', 'vector_ram_mb', 'indexes'])
+
+BENCHMARKS = {
+    'quantization': benchmark_quantization,
+    'rag_persistence': benchmark_rag_persistence,
+    'rag_search': benchmark_rag_search,
+    'rag_concurrency': benchmark_rag_concurrency,
+    'rag_memory': benchmark_rag_memory,
+    'rag_dense': benchmark_rag_dense,
+    'rag_retention': benchmark_rag_retention,
+    'qdrant_ingest': benchmark_qdrant_ingest,
+    'qdrant_filtered': benchmark_qdrant_filtered,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Spam Detection Functions Server benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--samples', type=int, default=None, help="Number of samples/documents to use")
+    args = parser.parse_args()
+
+    print(f"Running {args.benchmark} benchmark")
+    print("=" * 60)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+"""
+Local model-serving daemon
+
+Hosts the sentence-transformers encoder(s) and the Hugging Face spam
+classifier once per machine and serves every local process over a Unix
+domain socket, instead of each gunicorn worker and the Qdrant RAG server
+loading their own copy of torch and the weights. Requests for the same
+model from all connections are micro-batched into one forward pass.
+
+Run it before the app: python models/model_daemon.py. The socket is
+bound before the models load; requests wait until they have, and under
+systemd (Type=notify) the unit only counts as started once they are.
+
+Clients use load_encoder() / DaemonClassifier, which talk to the daemon
+and load the model in-process only while its socket doesn't answer.
+"""
+
+import base64
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+# Configuration
+# The socket lives in a directory only the service user can write (systemd's
+# RuntimeDirectory=ash), never a world-writable one like /tmp where another
+# local user could bind the path first and answer in the daemon's place
+MODEL_DAEMON_SOCKET = os.getenv('MODEL_DAEMON_SOCKET', '/run/ash/model_daemon.sock')
+MODEL_DAEMON = os.getenv('MODEL_DAEMON', 'auto').lower()  # auto (use if running) | off
+MODEL_DAEMON_TIMEOUT = float(os.getenv('MODEL_DAEMON_TIMEOUT', 30))  # seconds per request
+# After falling back to an in-process model, try the daemon again this often
+MODEL_DAEMON_RETRY_SECONDS = float(os.getenv('MODEL_DAEMON_RETRY_SECONDS', 30))
+
+# Daemon side: models loaded at startup, and how requests are batched. A
+# batch runs once MODEL_DAEMON_MAX_BATCH texts are queued or the oldest has
+# waited MODEL_DAEMON_BATCH_WAIT_MS.
+MODEL_DAEMON_ENCODERS = [
+    name.strip() for name in os.getenv('MODEL_DAEMON_ENCODERS', 'all-MiniLM-L6-v2').split(',') if name.strip()
+]
+MODEL_DAEMON_CLASSIFIER = os.getenv('MODEL_DAEMON_CLASSIFIER', 'true').lower() in ('1', 'true', 'yes')
+MODEL_DAEMON_MAX_BATCH = int(os.getenv('MODEL_DAEMON_MAX_BATCH', 64))
+MODEL_DAEMON_BATCH_WAIT_MS = float(os.getenv('MODEL_DAEMON_BATCH_WAIT_MS', 5))
+
+# Messages are a 4-byte big-endian length followed by that many bytes of JSON
+_HEADER = struct.Struct('>I')
+
+class ModelDaemonUnavailable(ConnectionError):
+    """The daemon could not be reached or timed out"""
+
+class ModelDaemonError(RuntimeError):
+    """The daemon answered with an error (bad request, input the model rejected)"""
+
+def _send(sock: socket.socket, message: Dict[str, Any]):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _recv(sock: socket.socket) -> Dict[str, Any]:
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, size))
+
+def _pack_array(array: np.ndarray) -> Dict[str, Any]:
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {'data': base64.b64encode(array.tobytes()).decode('ascii'), 'shape': list(array.shape)}
+
+def _unpack_array(packed: Dict[str, Any]) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(packed['data']), dtype=np.float32).reshape(packed['shape'])
+
+# ---------- daemon ----------
+
+def _sd_notify(state: str):
+    """Send a state change to systemd when started by a Type=notify unit"""
+    address = os.getenv('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        address = '\0' + address[1:]  # abstract namespace
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode('ascii'), address)
+    except OSError as e:
+        print(f"Model daemon: could not notify systemd: {e}")
+
+class _Pending:
+    __slots__ = ('texts', 'done', 'result', 'error')
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class _Batcher:
+    """Runs one model over requests from all connections, in batches"""
+
+    def __init__(self, run: Callable[[List[str]], List[Any]], max_batch: int = MODEL_DAEMON_MAX_BATCH,
+                 wait_ms: float = MODEL_DAEMON_BATCH_WAIT_MS):
+        self.run = run
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000.0
+        self.batches = 0
+        self.texts = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, texts: List[str]) -> List[Any]:
+        """Outputs for texts, in order (blocks until their batch has run)"""
+        pending = _Pending(texts)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0].texts)
+            deadline = time.monotonic() + self.wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                size += len(pending.texts)
+
+            texts = [text for pending in batch for text in pending.texts]
+            try:
+                outputs = self.run(texts)
+                start = 0
+                for pending in batch:
+                    pending.result = outputs[start:start + len(pending.texts)]
+                    start += len(pending.texts)
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            self.batches += 1
+            self.texts += len(texts)
+            for pending in batch:
+                pending.done.set()
+
+class ModelDaemon:
+    """Loads the models once and answers encode/classify requests on a Unix socket"""
+
+    def __init__(self, socket_path: str = MODEL_DAEMON_SOCKET):
+        self.socket_path = socket_path
+        self.encoders = {}  # model name -> (batcher, dim)
+        self.classifier = None  # batcher
+        self.classifier_name = None
+        self.classifier_quantized = False
+        self._load_lock = threading.Lock()
+        # Set once the configured models have loaded (or failed to)
+        self._loaded = threading.Event()
+
+    def load_encoder(self, name: str):
+        with self._load_lock:
+            if name not in self.encoders:
+                from sentence_transformers import SentenceTransformer
+
+                model = SentenceTransformer(name)
+                batcher = _Batcher(lambda texts: model.encode(
+                    texts, batch_size=MODEL_DAEMON_MAX_BATCH, convert_to_numpy=True, show_progress_bar=False
+                ))
+                self.encoders[name] = (batcher, model.get_sentence_embedding_dimension())
+                print(f"Model daemon: loaded encoder {name}")
+            return self.encoders[name]
+
+    def load_classifier(self):
+        with self._load_lock:
+            if self.classifier is None:
+                from spam_detection import SpamDetectionModel
+
+                # use_daemon=False: this process is the daemon
+                model = SpamDetectionModel("huggingface", use_daemon=False)
+                pipeline = model.model
+                if getattr(model, 'model_name', 'rule-based') == 'rule-based':
+                    # The rule-based fallback takes one text at a time
+                    run = lambda texts: [pipeline(text) for text in texts]
+                else:
+                    run = lambda texts: pipeline(texts, batch_size=MODEL_DAEMON_MAX_BATCH)
+                self.classifier = _Batcher(run)
+                self.classifier_name = model.model_name
+                self.classifier_quantized = bool(model.quantize)
+                print(f"Model daemon: loaded classifier {self.classifier_name}")
+            return self.classifier
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'pid': os.getpid(),
+            'loading': not self._loaded.is_set(),
+            'encoders': {name: dim for name, (_, dim) in self.encoders.items()},
+            'classifier': self.classifier_name,
+            'quantized': self.classifier_quantized,
+            'batches': sum(batcher.batches for batcher, _ in self.encoders.values()) +
+                       (self.classifier.batches if self.classifier else 0),
+            'texts': sum(batcher.texts for batcher, _ in self.encoders.values()) +
+                     (self.classifier.texts if self.classifier else 0)
+        }
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer one request"""
+        op = request.get('op') if isinstance(request, dict) else None
+        if op == 'info':
+            return self.info()
+        if op not in ('encode', 'classify'):
+            return {'error': f"Unknown op '{op}'"}
+
+        texts = request.get('texts')
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return {'error': "'texts' must be a list of strings"}
+        # Requests that arrive during startup wait for the models
+        self._loaded.wait()
+        if op == 'encode':
+            # Only the configured models: clients can't make the daemon load others
+            if request.get('model') not in self.encoders:
+                return {'error': f"Encoder '{request.get('model')}' is not served by this daemon"}
+            batcher, _ = self.encoders[request['model']]
+            vectors = np.asarray(batcher.submit(texts), dtype=np.float32)
+            return {'vectors': _pack_array(vectors)}
+        if self.classifier is None:
+            return {'error': 'Classifier is not hosted by this daemon'}
+        return {'results': self.classifier.submit(texts)}
+
+    def preload(self):
+        """Load the configured models, then tell systemd the daemon is ready"""
+        for name in MODEL_DAEMON_ENCODERS:
+            try:
+                self.load_encoder(name)
+            except Exception as e:
+                print(f"Model daemon: could not load encoder {name}: {e}")
+        if MODEL_DAEMON_CLASSIFIER:
+            try:
+                self.load_classifier()
+            except Exception as e:
+                print(f"Model daemon: could not load classifier: {e}")
+        self._loaded.set()
+        _sd_notify('READY=1')
+        print("Model daemon: models loaded")
+
+    def serve_forever(self):
+        """Listen right away, load the models in the background and serve until interrupted"""
+        socket_dir = os.path.dirname(self.socket_path) or '.'
+        if not os.path.isdir(socket_dir):
+            # Normally created by systemd; owner and group only
+            os.makedirs(socket_dir, mode=0o750)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by a previous run
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                # One connection carries many requests
+                while True:
+                    try:
+                        request = _recv(self.request)
+                    except (ConnectionError, OSError, ValueError):
+                        return
+                    try:
+                        response = daemon.handle(request)
+                    except Exception as e:
+                        response = {'error': str(e)}
+                    _send(self.request, response)
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+            request_queue_size = 128  # every worker may connect at once
+
+        # Owner and group only from the moment the socket exists: anyone who
+        # can connect can run the models
+        previous_umask = os.umask(0o117)
+        try:
+            server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(previous_umask)
+        with server:
+            os.chmod(self.socket_path, 0o660)
+            print(f"Model daemon listening on {self.socket_path}")
+            # Bound first, so clients starting meanwhile find the socket and
+            # wait for the models instead of loading their own copies
+            threading.Thread(target=self.preload, daemon=True).start()
+            # systemd stops with SIGTERM: exit through the finally below
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(self.socket_path)
+
+# ---------- client ----------
+
+class ModelDaemonClient:
+    """Client for the model daemon; keeps one connection per thread"""
+
+    def __init__(self, socket_path: str = MODEL_DAEMON_SOCKET, timeout: float = MODEL_DAEMON_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Blocking connect: with a timeout set, a full accept backlog fails
+        # with EAGAIN instead of waiting for the daemon to accept
+        sock.connect(self.socket_path)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def request(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Send one request, reconnecting once if the connection went stale"""
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                _send(sock, message)
+                response = _recv(sock)
+                break
+            except (OSError, ConnectionError, ValueError) as e:
+                if sock is not None:
+                    sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise ModelDaemonUnavailable(f"Model daemon at {self.socket_path} unavailable: {e}")
+        if 'error' in response:
+            # The daemon is up: not a reason to load the model in-process
+            raise ModelDaemonError(f"Model daemon error: {response['error']}")
+        return response
+
+    def info(self) -> Dict[str, Any]:
+        return self.request({'op': 'info'})
+
+    def encode(self, texts: List[str], model: str) -> np.ndarray:
+        return _unpack_array(self.request({'op': 'encode', 'model': model, 'texts': list(texts)})['vectors'])
+
+    def classify(self, texts: List[str]) -> List[Any]:
+        return self.request({'op': 'classify', 'texts': list(texts)})['results']
+
+def get_daemon_client() -> ModelDaemonClient:
+    """A client when the daemon is enabled, else None; the daemon may not be up yet"""
+    if MODEL_DAEMON == 'off':
+        return None
+    return ModelDaemonClient()
+
+def get_daemon_info(client: ModelDaemonClient) -> Dict[str, Any]:
+    """The daemon's info reply, or None while it can't be reached"""
+    try:
+        return client.info()
+    except ModelDaemonUnavailable as e:
+        print(f"Model daemon not reachable yet, will retry: {e}")
+        return None
+
+class _DaemonFallback:
+    """
+    In-process fallback for a model served by the daemon
+
+    When the daemon can't be reached, the model is loaded locally and used
+    while the daemon is retried every MODEL_DAEMON_RETRY_SECONDS; once it
+    answers again the local copy is dropped. Errors the daemon answers with
+    are raised to the caller and never trigger a fallback.
+    """
+
+    def __init__(self, description: str, load_local: Callable[[], Any]):
+        self.description = description
+        self.load_local = load_local
+        self.local = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def call(self, daemon_call: Callable[[], Any], local_call: Callable[[Any], Any]) -> Any:
+        """
+        Run daemon_call, or local_call with the local model while the daemon is unreachable
+
+        The local model is read once per call, so a concurrent release only
+        affects later calls.
+        """
+        local = self.local
+        if local is None or time.monotonic() >= self._retry_at:
+            try:
+                result = daemon_call()
+            except ModelDaemonUnavailable as e:
+                local = self._failed(e)
+            else:
+                self._succeeded()
+                return result
+        return local_call(local)
+
+    def use_local(self, reason: str) -> Any:
+        """Serve every call from the local model from now on (the daemon doesn't host it)"""
+        with self._lock:
+            self._retry_at = float('inf')
+            if self.local is None:
+                print(f"{reason}; loading {self.description} in-process")
+                self.local = self.load_local()
+            return self.local
+
+    def _failed(self, error: ModelDaemonUnavailable) -> Any:
+        """The daemon couldn't be reached: return the local model, loading it if needed"""
+        with self._lock:
+            self._retry_at = time.monotonic() + MODEL_DAEMON_RETRY_SECONDS
+            if self.local is None:
+                print(f"{error}; loading {self.description} in-process")
+                self.local = self.load_local()
+            return self.local
+
+    def _succeeded(self):
+        """The daemon answered: drop the local model"""
+        if self.local is not None:
+            with self._lock:
+                if self.local is not None and self._retry_at != float('inf'):
+                    print(f"Model daemon is back; releasing the in-process {self.description}")
+                    self.local = None
+
+class DaemonEncoder:
+    """
+    SentenceTransformer stand-in that encodes through the model daemon
+
+    Args:
+        model_name: sentence-transformers model id
+        client: Daemon client
+        info: The daemon's info reply, None if it wasn't reachable yet
+    """
+
+    def __init__(self, model_name: str, client: ModelDaemonClient, info: Dict[str, Any] = None):
+        self.model_name = model_name
+        self.client = client
+        self._dim = None
+        self._checked = False
+        self._fallback = _DaemonFallback(model_name, self._load_local)
+        if info is not None:
+            self._check(info)
+
+    def _load_local(self):
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(self.model_name)
+
+    def _check(self, info: Dict[str, Any]):
+        """Switch to the local model for good if the loaded daemon doesn't serve this one"""
+        if info.get('loading'):
+            return
+        self._checked = True
+        dim = info.get('encoders', {}).get(self.model_name)
+        if dim is None:
+            self._fallback.use_local(f"Model daemon does not serve encoder {self.model_name}")
+        else:
+            self._dim = dim
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dim is None:
+            self._dim = self.encode(['dimension probe']).shape[1]
+        return self._dim
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False, normalize_embeddings: bool = False, **kwargs):
+        """Same call as SentenceTransformer.encode (the daemon picks its own batch size)"""
+        if not self._checked:
+            try:
+                self._check(self.client.info())
+            except ModelDaemonUnavailable:
+                pass  # the call below falls back
+        single = isinstance(sentences, str)
+
+        def daemon_call():
+            vectors = self.client.encode([sentences] if single else list(sentences), self.model_name)
+            if normalize_embeddings:
+                vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+            return vectors[0] if single else vectors
+
+        return self._fallback.call(daemon_call, lambda local: local.encode(
+            sentences, batch_size=batch_size, convert_to_numpy=convert_to_numpy,
+            show_progress_bar=show_progress_bar, normalize_embeddings=normalize_embeddings, **kwargs
+        ))
+
+def load_encoder(model_name: str):
+    """
+    A sentence-transformers model served by the daemon, else a local one
+
+    While the daemon is enabled but not reachable yet, the returned encoder
+    falls back to a local copy and keeps retrying the daemon.
+    """
+    client = get_daemon_client()
+    if client is not None:
+        info = get_daemon_info(client)
+        if info is None or info.get('loading') or model_name in info.get('encoders', {}):
+            print(f"Using encoder {model_name} from the model daemon")
+            return DaemonEncoder(model_name, client, info)
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+class DaemonClassifier:
+    """
+    Text-classification pipeline stand-in served by the model daemon
+
+    Called like the pipeline with one text; returns its list of label scores.
+
+    Args:
+        client: Daemon client
+        info: The daemon's info reply, None if it wasn't reachable yet
+        load_local: Loads the classifier in this process when the daemon
+            can't be reached or doesn't host one; returns an object with
+            `model` (the pipeline), `model_name` and `quantize`
+    """
+
+    def __init__(self, client: ModelDaemonClient, info: Dict[str, Any], load_local: Callable[[], Any]):
+        self.client = client
+        self.daemon_model_name = None
+        self.daemon_quantized = False
+        self._checked = False
+        self._fallback = _DaemonFallback('classifier', load_local)
+        if info is not None:
+            self._check(info)
+
+    def _check(self, info: Dict[str, Any]):
+        """Record the daemon's classifier, or switch to the local one for good if it has none"""
+        if info.get('loading'):
+            return
+        self._checked = True
+        if info.get('classifier') in (None, 'rule-based'):
+            # A rule-based daemon has nothing worth sharing
+            self._fallback.use_local("Model daemon does not host a Hugging Face classifier")
+        else:
+            self.daemon_model_name = info['classifier']
+            self.daemon_quantized = info.get('quantized', False)
+
+    @property
+    def model_name(self) -> str:
+        local = self._fallback.local
+        return local.model_name if local is not None else (self.daemon_model_name or 'model-daemon')
+
+    @property
+    def quantized(self) -> bool:
+        local = self._fallback.local
+        return bool(local.quantize) if local is not None else self.daemon_quantized
+
+    def __call__(self, text):
+        if not self._checked:
+            try:
+                self._check(self.client.info())
+            except ModelDaemonUnavailable:
+                pass  # the call below falls back
+        return self._fallback.call(lambda: self.client.classify([text])[0],
+                                   lambda local: local.model(text))
+
+if __name__ == "__main__":
+    ModelDaemon().serve_forever()
@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import List, Dict, Any, Callable
+
+import joblib
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.naive_bayes import MultinomialNB
+
+# Configuration
+MODEL_SELECTION_GRID_PATH = os.getenv('MODEL_SELECTION_GRID_PATH', '')
+MODEL_SELECTION_FOLDS = int(os.getenv('MODEL_SELECTION_FOLDS', 5))
+MODEL_SELECTION_JOBS = int(os.getenv('MODEL_SELECTION_JOBS', -1))  # -1 = all cores
+LEADERBOARD_PATH = os.getenv('MODEL_LEADERBOARD_PATH', 'models/leaderboard.json')
+
+# Classifiers must support predict_proba
+MODEL_TYPES = {
+    'logistic_regression': LogisticRegression,
+    'random_forest': RandomForestClassifier,
+    'naive_bayes': MultinomialNB,
+    'sgd': SGDClassifier,
+}
+
+DEFAULT_VECTORIZER_GRID = [
+    {'max_features': 5000, 'ngram_range': [1, 2], 'stop_words': 'english', 'sublinear_tf': False},
+    {'max_features': 20000, 'ngram_range': [1, 2], 'stop_words': 'english', 'sublinear_tf': True},
+    {'max_features': 20000, 'ngram_range': [1, 1], 'stop_words': None, 'sublinear_tf': True},
+]
+
+DEFAULT_MODEL_GRID = [
+    {'name': 'logreg_c1', 'type': 'logistic_regression', 'params': {'C': 1.0, 'max_iter': 1000, 'random_state': 42}},
+    {'name': 'logreg_c4', 'type': 'logistic_regression', 'params': {'C': 4.0, 'max_iter': 1000, 'random_state': 42}},
+    {'name': 'random_forest', 'type': 'random_forest', 'params': {'n_estimators': 200, 'n_jobs': 1, 'random_state': 42}},
+    {'name': 'naive_bayes', 'type': 'naive_bayes', 'params': {'alpha': 0.1}},
+    {'name': 'sgd_log', 'type': 'sgd', 'params': {'loss': 'log_loss', 'alpha': 1e-5, 'random_state': 42}},
+]
+
+def load_grid() -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Load the model/vectorizer grid
+
+    Uses the JSON file at MODEL_SELECTION_GRID_PATH when set, shaped like
+    {"vectorizers": [...], "models": [...]}, and the defaults otherwise.
+    """
+    grid = {'vectorizers': DEFAULT_VECTORIZER_GRID, 'models': DEFAULT_MODEL_GRID}
+    if MODEL_SELECTION_GRID_PATH and os.path.exists(MODEL_SELECTION_GRID_PATH):
+        with open(MODEL_SELECTION_GRID_PATH, 'r') as f:
+            grid.update(json.load(f))
+    return grid
+
+def build_vectorizer(settings: Dict[str, Any]) -> TfidfVectorizer:
+    """Create a TF-IDF vectorizer from grid settings"""
+    settings = dict(settings)
+    if 'ngram_range' in settings:
+        settings['ngram_range'] = tuple(settings['ngram_range'])
+    return TfidfVectorizer(lowercase=True, **settings)
+
+def build_model(spec: Dict[str, Any]):
+    """Create a classifier from a grid entry"""
+    return MODEL_TYPES[spec['type']](**spec.get('params', {}))
+
+def _vectorize_fold(texts: np.ndarray, train_idx: np.ndarray, val_idx: np.ndarray,
+                    settings: Dict[str, Any], cache_path: str) -> str:
+    """Fit a vectorizer on one fold and cache the fold matrices to disk"""
+    vectorizer = build_vectorizer(settings)
+    X_train = vectorizer.fit_transform(texts[train_idx])
+    X_val = vectorizer.transform(texts[val_idx])
+    joblib.dump({'X_train': X_train, 'X_val': X_val}, cache_path)
+    return cache_path
+
+def _evaluate_candidate(cache_path: str, y_train: np.ndarray, y_val: np.ndarray,
+                        spec: Dict[str, Any]) -> Dict[str, float]:
+    """Fit one candidate on a cached fold and score it"""
+    fold = joblib.load(cache_path, mmap_mode='r')
+    model = build_model(spec)
+
+    start = time.perf_counter()
+    model.fit(fold['X_train'], y_train)
+    fit_seconds = time.perf_counter() - start
+
+    X_val = fold['X_val']
+    start = time.perf_counter()
+    y_pred = model.predict(X_val)
+    batch_seconds = time.perf_counter() - start
+
+    # Single-row latency, as seen by the /ml_check_spam endpoint
+    single = []
+    for i in range(min(50, X_val.shape[0])):
+        start = time.perf_counter()
+        model.predict_proba(X_val[i:i + 1])
+        single.append(time.perf_counter() - start)
+
+    return {
+        'accuracy': accuracy_score(y_val, y_pred),
+        'f1': f1_score(y_val, y_pred, zero_division=0),
+        'fit_seconds': fit_seconds,
+        'batch_ms_per_sample': batch_seconds * 1000 / max(1, X_val.shape[0]),
+        'single_ms': float(np.median(single)) * 1000 if single else 0.0
+    }
+
+def run_model_selection(texts: List[str], labels: List[int], folds: int = MODEL_SELECTION_FOLDS,
+                        n_jobs: int = MODEL_SELECTION_JOBS, grid: Dict[str, Any] = None,
+                        progress_callback: Callable[[float, str], None] = None) -> List[Dict[str, Any]]:
+    """
+    K-fold cross-validate every vectorizer x model combination in a process pool
+
+    Each vectorizer is fit once per fold and its fold matrices are cached on
+    disk, then every model candidate reuses (memory-maps) those matrices.
+
+    Returns:
+        Leaderboard rows sorted best first (by F1, then accuracy, then latency)
+    """
+    def report(progress: float, message: str):
+        if progress_callback:
+            progress_callback(progress, message)
+
+    grid = grid or load_grid()
+    texts = np.asarray(texts, dtype=object)
+    labels = np.asarray(labels)
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=42).split(texts, labels))
+
+    cache_dir = tempfile.mkdtemp(prefix='spam_model_selection_')
+    try:
+        with Parallel(n_jobs=n_jobs, backend='loky') as parallel:
+            report(0.2, f"Vectorizing {len(grid['vectorizers'])} settings x {folds} folds")
+            vector_tasks = [
+                (v, f) for v in range(len(grid['vectorizers'])) for f in range(folds)
+            ]
+            cache_paths = parallel(
+                delayed(_vectorize_fold)(
+                    texts, splits[f][0], splits[f][1], grid['vectorizers'][v],
+                    os.path.join(cache_dir, f'vec{v}_fold{f}.joblib')
+                )
+                for v, f in vector_tasks
+            )
+            fold_cache = dict(zip(vector_tasks, cache_paths))
+
+            report(0.4, f"Cross-validating {len(grid['vectorizers']) * len(grid['models'])} candidates")
+            eval_tasks = [
+                (v, m, f)
+                for v in range(len(grid['vectorizers']))
+                for m in range(len(grid['models']))
+                for f in range(folds)
+            ]
+            scores = parallel(
+                delayed(_evaluate_candidate)(
+                    fold_cache[(v, f)], labels[splits[f][0]], labels[splits[f][1]], grid['models'][m]
+                )
+                for v, m, f in eval_tasks
+            )
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    # Average fold scores per candidate
+    per_candidate = {}
+    for (v, m, _), score in zip(eval_tasks, scores):
+        per_candidate.setdefault((v, m), []).append(score)
+
+    leaderboard = []
+    for (v, m), fold_scores in per_candidate.items():
+        row = {
+            'model': grid['models'][m]['name'],
+            'model_spec': grid['models'][m],
+            'vectorizer': grid['vectorizers'][v],
+            'folds': len(fold_scores)
+        }
+        for key in fold_scores[0]:
+            values = [score[key] for score in fold_scores]
+            row[f'{key}_mean'] = float(np.mean(values))
+            if key in ('accuracy', 'f1'):
+                row[f'{key}_std'] = float(np.std(values))
+        leaderboard.append(row)
+
+    leaderboard.sort(key=lambda row: (-row['f1_mean'], -row['accuracy_mean'], row['single_ms_mean']))
+    for rank, row in enumerate(leaderboard, start=1):
+        row['rank'] = rank
+
+    return leaderboard
+
+def save_leaderboard(report: Dict[str, Any], path: str = LEADERBOARD_PATH):
+    """Write the leaderboard report atomically"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    os.replace(path + '.tmp', path)
+
+def load_leaderboard(path: str = LEADERBOARD_PATH) -> Dict[str, Any]:
+    """Read the latest leaderboard report, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
@@ -7,24 +7,61 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
 import joblib
 import os
+import time
 import requests
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Callable
 import warnings
 warnings.filterwarnings('ignore')
 
+from training_store import TrainingCorpusStore
+import model_selection
+from model_daemon import DaemonClassifier, get_daemon_client, get_daemon_info
+
+# Dynamic int8 quantization for the CPU transformer path
+HF_QUANTIZE = os.getenv('HF_QUANTIZE', 'false').lower() in ('1', 'true', 'yes', 'int8')
+QUANTIZED_CACHE_DIR = os.getenv('HF_QUANTIZED_CACHE_DIR', 'models/quantized')
+
+def configure_torch_threads() -> int:
+    """
+    Set torch intra-op threads for this worker
+    
+    Uses TORCH_NUM_THREADS when set, otherwise splits the cores evenly
+    between the gunicorn workers (WEB_CONCURRENCY) so they don't oversubscribe.
+    
+    Returns:
+        Number of threads configured
+    """
+    import torch
+    
+    num_threads = os.getenv('TORCH_NUM_THREADS')
+    if num_threads:
+        num_threads = int(num_threads)
+    else:
+        workers = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+    
+    torch.set_num_threads(num_threads)
+    return num_threads
+
 class SpamDetectionModel:
-    def __init__(self, model_type: str = "custom"):
+    def __init__(self, model_type: str = "custom", quantize: bool = None, use_daemon: bool = True):
         """
         Initialize spam detection model
         
         Args:
             model_type: "custom" for training custom model, "huggingface" for pre-trained
+            quantize: Apply dynamic int8 quantization to the Hugging Face model
+                      (defaults to the HF_QUANTIZE environment setting)
+            use_daemon: Classify through the model daemon when it is running
+                        instead of loading the Hugging Face model in this process
         """
         self.model_type = model_type
         self.model = None
         self.vectorizer = None
         self.model_path = "models/spam_model.joblib"
         self.vectorizer_path = "models/vectorizer.joblib"
+        self.quantize = HF_QUANTIZE if quantize is None else quantize
+        self.use_daemon = use_daemon
         
         if model_type == "huggingface":
             self._load_huggingface_model()
@@ -32,6 +69,22 @@ class SpamDetectionModel:
             self.load_model()
     
     def _load_huggingface_model(self):
+        """Use the model daemon's classifier, or load the model in this process"""
+        client = get_daemon_client() if self.use_daemon else None
+        if client is not None:
+            # Also while the daemon isn't up yet: calls fall back to an
+            # in-process model until it answers
+            self.model = DaemonClassifier(client, get_daemon_info(client), self._load_local_fallback)
+            self.model_name = self.model.model_name
+            print(f"Classifying through the model daemon ({self.model_name})")
+            return
+        self._load_local_huggingface_model()
+    
+    def _load_local_fallback(self) -> 'SpamDetectionModel':
+        """The classifier loaded in this process, for when the daemon can't be reached"""
+        return SpamDetectionModel("huggingface", quantize=self.quantize, use_daemon=False)
+    
+    def _load_local_huggingface_model(self):
         """Load pre-trained model from Hugging Face"""
         try:
             # Try to import transformers
@@ -43,15 +96,23 @@ class SpamDetectionModel:
                 "unitary/toxic-bert"
             ]
             
+            try:
+                print(f"Using {configure_torch_threads()} torch threads")
+            except Exception as thread_error:
+                print(f"Could not configure torch threads: {thread_error}")
+            
             for model_name in models_to_try:
                 try:
                     print(f"Trying to load model: {model_name}")
-                    self.model = pipeline(
-                        "text-classification",
-                        model=model_name,
-                        device=-1,  # Use CPU
-                        return_all_scores=True
-                    )
+                    if self.quantize:
+                        self.model = self._load_quantized_pipeline(model_name)
+                    else:
+                        self.model = pipeline(
+                            "text-classification",
+                            model=model_name,
+                            device=-1,  # Use CPU
+                            return_all_scores=True
+                        )
                     print(f"Successfully loaded Hugging Face model: {model_name}")
                     self.model_name = model_name
                     return
@@ -74,6 +135,89 @@ class SpamDetectionModel:
             self.model = self._create_rule_based_classifier()
             self.model_name = "rule-based"
     
+    def _quantized_cache_path(self, model_name: str, revision: str, torch_version: str) -> str:
+        """Path of the cached int8 weights for one revision of a Hugging Face model and torch version"""
+        name = f"{model_name.replace('/', '__')}@{revision}.torch-{torch_version}.int8.pt"
+        return os.path.join(QUANTIZED_CACHE_DIR, name.replace(os.sep, '_'))
+    
+    def _load_quantized_pipeline(self, model_name: str):
+        """
+        Load a text-classification pipeline with int8 dynamic quantization
+        
+        Linear layers are quantized with torch's dynamic quantization. The
+        quantized weights are cached on disk per model revision and torch
+        version, so later starts build the model from its config and load the
+        int8 state dict without the fp32 weights. The cache is written to a
+        temporary file and renamed into place, since every worker may
+        quantize at once; an unreadable cache is deleted and rebuilt.
+        
+        Args:
+            model_name: Hugging Face model id
+        
+        Returns:
+            Pipeline backed by the quantized model
+        """
+        import torch
+        from transformers import pipeline, AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+        
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        config = AutoConfig.from_pretrained(model_name)
+        # Commit the config resolved to; None for local paths, which are never cached
+        revision = getattr(config, '_commit_hash', None)
+        cache_path = self._quantized_cache_path(model_name, revision, torch.__version__) if revision else None
+        
+        quantized_model = None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                base_model = AutoModelForSequenceClassification.from_config(config)
+                quantized_model = torch.quantization.quantize_dynamic(
+                    base_model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+                quantized_model.load_state_dict(torch.load(cache_path))
+                print(f"Loaded cached int8 weights from {cache_path}")
+            except Exception as e:
+                print(f"Discarding unreadable int8 cache {cache_path}: {e}")
+                quantized_model = None
+                try:
+                    os.remove(cache_path)
+                except OSError:
+                    pass
+        
+        if quantized_model is None:
+            base_model = AutoModelForSequenceClassification.from_pretrained(model_name, revision=revision)
+            quantized_model = torch.quantization.quantize_dynamic(
+                base_model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            if cache_path:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                try:
+                    os.makedirs(QUANTIZED_CACHE_DIR, exist_ok=True)
+                    torch.save(quantized_model.state_dict(), tmp_path)
+                    os.replace(tmp_path, cache_path)
+                    print(f"Cached int8 weights to {cache_path}")
+                    # Weights of other revisions or torch versions are never loaded again
+                    prefix = os.path.basename(cache_path).split('@')[0] + '@'
+                    for name in os.listdir(QUANTIZED_CACHE_DIR):
+                        if name.startswith(prefix) and name.endswith('.int8.pt') and \
+                                name != os.path.basename(cache_path):
+                            try:
+                                os.remove(os.path.join(QUANTIZED_CACHE_DIR, name))
+                            except OSError:
+                                pass  # another worker pruned it first
+                except Exception as e:
+                    print(f"Could not cache quantized weights: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        
+        quantized_model.eval()
+        return pipeline(
+            "text-classification",
+            model=quantized_model,
+            tokenizer=tokenizer,
+            device=-1,  # Use CPU
+            return_all_scores=True
+        )
+    
     def _create_rule_based_classifier(self):
         """Create a simple rule-based spam classifier as fallback"""
         class RuleBasedClassifier:
@@ -388,23 +532,41 @@ class SpamDetectionModel:
         print("Creating sample dataset for training")
         return self.create_sample_dataset()
     
-    def train_custom_model(self, csv_path: str = None) -> Dict[str, float]:
-        """Train custom spam detection model"""
-        print("Training custom spam detection model...")
+    def get_training_store(self) -> TrainingCorpusStore:
+        """Open the training corpus store, seeding it with the sample dataset on first use"""
+        store = TrainingCorpusStore()
+        if store.count(source='sample_dataset') == 0:
+            print("Seeding training corpus with sample dataset")
+            store.add_dataframe(self.create_sample_dataset(), source='sample_dataset')
+        return store
+    
+    def train_custom_model(self, csv_path: str = None, progress_callback: Callable[[float, str], None] = None) -> Dict[str, float]:
+        """
+        Train custom spam detection model
+        
+        Args:
+            csv_path: Optional CSV with text/label columns (sample data otherwise)
+            progress_callback: Optional callable(progress, message), progress in 0-1
+        """
+        def report(progress: float, message: str):
+            if progress_callback:
+                progress_callback(progress, message)
         
-        # Load dataset
-        df = self.load_or_create_dataset(csv_path)
+        print("Training custom spam detection model...")
         
-        # Prepare data
-        X = df['text'].values
-        y = df['label'].values
+        # Add the CSV (if any) to the corpus store and train on everything stored
+        report(0.1, "Loading dataset")
+        store = self.get_training_store()
+        if csv_path and os.path.exists(csv_path):
+            ingest = store.add_csv(csv_path)
+            print(f"Added {ingest['added']} samples from {csv_path} ({ingest['duplicates']} duplicates, "
+                  f"{ingest['dropped']} rows dropped)")
         
-        # Split data
-        X_train, X_test, y_train, y_test = train_test_split(
-            X, y, test_size=0.2, random_state=42, stratify=y
-        )
+        y_train = []
+        y_test = []
         
         # Vectorize text
+        report(0.3, "Vectorizing text")
         self.vectorizer = TfidfVectorizer(
             max_features=5000,
             stop_words='english',
@@ -412,14 +574,19 @@ class SpamDetectionModel:
             lowercase=True
         )
         
-        X_train_vectorized = self.vectorizer.fit_transform(X_train)
-        X_test_vectorized = self.vectorizer.transform(X_test)
+        # Texts stream from the store; labels are collected in the same order
+        X_train_vectorized = self.vectorizer.fit_transform(store.stream_split('train', y_train))
+        X_test_vectorized = self.vectorizer.transform(store.stream_split('test', y_test))
+        y_train = np.asarray(y_train)
+        y_test = np.asarray(y_test)
         
         # Train model
+        report(0.5, "Fitting model")
         self.model = LogisticRegression(random_state=42, max_iter=1000)
         self.model.fit(X_train_vectorized, y_train)
         
         # Evaluate
+        report(0.8, "Evaluating model")
         y_pred = self.model.predict(X_test_vectorized)
         accuracy = accuracy_score(y_test, y_pred)
         
@@ -428,14 +595,93 @@ class SpamDetectionModel:
         print(classification_report(y_test, y_pred))
         
         # Save model
+        report(0.9, "Saving model")
         self.save_model()
         
         return {
             "accuracy": accuracy,
-            "train_samples": len(X_train),
-            "test_samples": len(X_test)
+            "train_samples": len(y_train),
+            "test_samples": len(y_test)
         }
     
+    def select_model(self, folds: int = None, n_jobs: int = None, grid: Dict[str, Any] = None,
+                     progress_callback: Callable[[float, str], None] = None) -> Dict[str, Any]:
+        """
+        Cross-validate a grid of models and vectorizer settings, then promote the best
+        
+        Candidates are scored with k-fold cross-validation on the training split
+        of the corpus store across a process pool. The winner is refit on the
+        whole training split, evaluated on the held-out test split and saved.
+        
+        Args:
+            folds: Number of CV folds (MODEL_SELECTION_FOLDS by default)
+            n_jobs: Worker processes, -1 for all cores (MODEL_SELECTION_JOBS by default)
+            grid: {"vectorizers": [...], "models": [...]} (load_grid() by default)
+            progress_callback: Optional callable(progress, message), progress in 0-1
+        
+        Returns:
+            Dictionary with the promoted model's metrics and the leaderboard
+        """
+        def report(progress: float, message: str):
+            if progress_callback:
+                progress_callback(progress, message)
+        
+        print("Running model selection...")
+        report(0.1, "Loading dataset")
+        store = self.get_training_store()
+        
+        y_train = []
+        X_train = list(store.stream_split('train', y_train))
+        
+        leaderboard = model_selection.run_model_selection(
+            X_train, y_train,
+            folds=folds or model_selection.MODEL_SELECTION_FOLDS,
+            n_jobs=n_jobs or model_selection.MODEL_SELECTION_JOBS,
+            grid=grid,
+            progress_callback=progress_callback
+        )
+        
+        best = leaderboard[0]
+        print(f"Best candidate: {best['model']} with {best['vectorizer']} "
+              f"(f1={best['f1_mean']:.3f}, accuracy={best['accuracy_mean']:.3f}, "
+              f"{best['single_ms_mean']:.3f} ms/prediction)")
+        
+        # Refit the winner on the full training split and check it on the test split
+        report(0.8, f"Promoting {best['model']}")
+        self.vectorizer = model_selection.build_vectorizer(best['vectorizer'])
+        X_train_vectorized = self.vectorizer.fit_transform(X_train)
+        self.model = model_selection.build_model(best['model_spec'])
+        self.model.fit(X_train_vectorized, np.asarray(y_train))
+        
+        y_test = []
+        X_test_vectorized = self.vectorizer.transform(store.stream_split('test', y_test))
+        y_pred = self.model.predict(X_test_vectorized)
+        accuracy = accuracy_score(y_test, y_pred)
+        print(f"Promoted model test accuracy: {accuracy:.3f}")
+        
+        report(0.9, "Saving model")
+        self.model_type = "custom"
+        self.save_model()
+        
+        results = {
+            "accuracy": accuracy,
+            "train_samples": len(y_train),
+            "test_samples": len(y_test),
+            "selected_model": best['model'],
+            "selected_vectorizer": best['vectorizer'],
+            "cv_f1": best['f1_mean'],
+            "cv_accuracy": best['accuracy_mean'],
+            "single_ms": best['single_ms_mean']
+        }
+        model_selection.save_leaderboard({
+            "created_at": time.time(),
+            "promoted": results,
+            "leaderboard": leaderboard
+        })
+        results["leaderboard"] = leaderboard
+        
+        return results
+    
     def predict(self, text: str, threshold: float = 0.5) -> Dict[str, Any]:
         """
         Predict if text is spam
@@ -449,6 +695,7 @@ class SpamDetectionModel:
         """
         if self.model_type == "huggingface" and self.model:
             try:
+                # A DaemonClassifier falls back to an in-process model by itself
                 result = self.model(text)
                 
                 # Handle different model output formats
@@ -467,13 +714,16 @@ class SpamDetectionModel:
                             spam_score = max(spam_score, score)
                 
                 is_spam = spam_score > threshold
+                daemon = isinstance(self.model, DaemonClassifier)
                 
                 return {
                     "is_spam": is_spam,
                     "confidence": spam_score,
                     "threshold": threshold,
                     "model_type": "huggingface",
-                    "model_name": getattr(self, 'model_name', 'unknown')
+                    # Reported by the DaemonClassifier: the daemon's model or its local fallback
+                    "model_name": self.model.model_name if daemon else getattr(self, 'model_name', 'unknown'),
+                    "quantized": bool(self.model.quantized if daemon else self.quantize)
                 }
                 
             except Exception as e:
@@ -536,8 +786,11 @@ class SpamDetectionModel:
             os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
             
             if self.model_type == "custom":
-                joblib.dump(self.model, self.model_path)
-                joblib.dump(self.vectorizer, self.vectorizer_path)
+                # Write to temp files and rename so readers never see a partial model
+                joblib.dump(self.model, self.model_path + ".tmp")
+                joblib.dump(self.vectorizer, self.vectorizer_path + ".tmp")
+                os.replace(self.model_path + ".tmp", self.model_path)
+                os.replace(self.vectorizer_path + ".tmp", self.vectorizer_path)
                 print(f"Model saved to {self.model_path}")
                 print(f"Vectorizer saved to {self.vectorizer_path}")
         except Exception as e:
@@ -556,33 +809,40 @@ class SpamDetectionModel:
             print(f"Error loading model: {e}")
         return False
     
-    def retrain_with_new_data(self, csv_path: str) -> Dict[str, Any]:
-        """Retrain model with new CSV data"""
+    def retrain_with_new_data(self, csv_path: str, progress_callback: Callable[[float, str], None] = None) -> Dict[str, Any]:
+        """
+        Retrain model with new CSV data
+        
+        Args:
+            csv_path: CSV with text/label columns
+            progress_callback: Optional callable(progress, message), progress in 0-1
+        """
         try:
             if not os.path.exists(csv_path):
                 return {"error": f"CSV file not found: {csv_path}"}
             
-            # Load new data
-            new_df = pd.read_csv(csv_path)
-            
             # Validate required columns
             required_columns = ['text', 'label']
-            if not all(col in new_df.columns for col in required_columns):
+            columns = pd.read_csv(csv_path, nrows=0).columns
+            if not all(col in columns for col in required_columns):
                 return {"error": f"CSV must contain columns: {required_columns}"}
             
-            # Load existing data if available
-            existing_df = self.load_or_create_dataset()
-            
-            # Combine datasets
-            combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-            combined_df = combined_df.drop_duplicates(subset=['text'])
-            
-            print(f"Retraining with {len(combined_df)} total samples")
-            
-            # Retrain model
-            results = self.train_custom_model()
-            results['new_samples'] = len(new_df)
-            results['total_samples'] = len(combined_df)
+            # Append new data to the corpus store in chunks, all or nothing
+            store = self.get_training_store()
+            ingest = store.add_csv(csv_path)
+            if ingest['dropped']:
+                print(f"Dropped {ingest['dropped']} rows without text or a valid label")
+            
+            total_samples = store.count()
+            print(f"Retraining with {total_samples} total samples")
+            
+            # Retrain model on the whole stored corpus
+            results = self.train_custom_model(progress_callback=progress_callback)
+            results['new_samples'] = ingest['added']
+            results['duplicate_samples'] = ingest['duplicates']
+            results['dropped_samples'] = ingest['dropped']
+            results['dropped_row_errors'] = ingest['row_errors']
+            results['total_samples'] = total_samples
             
             return results
             
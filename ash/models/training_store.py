@@ -0,0 +1,279 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Tuple, Dict, Any, List
+
+import pandas as pd
+
+# Configuration
+TRAINING_CORPUS_DB_PATH = os.getenv('TRAINING_CORPUS_DB_PATH', 'data/training_corpus.db')
+
+# Every 5th sample (by content hash) is held out for evaluation
+TEST_SPLIT_MODULUS = 5
+MAX_REPORTED_ROW_ERRORS = 20
+
+# Label values are matched after str().strip().lower()
+LABEL_MAPPING = {
+    'spam': 1, 'legitimate': 0, 'ham': 0,
+    '1': 1, '0': 0, '1.0': 1, '0.0': 0,
+    'true': 1, 'false': 0
+}
+
+def normalize_labels(labels: pd.Series) -> pd.Series:
+    """Map label values to 0/1, leaving NaN for values that can't be mapped"""
+    return labels.astype(str).str.strip().str.lower().map(LABEL_MAPPING)
+
+def validate_csv_chunk(chunk: pd.DataFrame, first_row: int) -> Dict[str, Any]:
+    """
+    Validate and normalize one chunk of a training CSV
+
+    Args:
+        chunk: Chunk with text and label columns (labels read as strings)
+        first_row: 1-based data row number of the chunk's first row
+
+    Returns:
+        Dict with the normalized dataframe, a boolean mask of its valid rows
+        and a list of row errors
+    """
+    labels = normalize_labels(chunk['label'])
+    missing_text = chunk['text'].isna() | (chunk['text'].astype(str).str.strip() == '')
+    missing_label = chunk['label'].isna()
+    invalid_label = labels.isna() & ~missing_label
+
+    row_errors = []
+    for mask, message in ((missing_text, 'Text is missing'),
+                          (missing_label, 'Label is missing'),
+                          (invalid_label, 'Invalid label')):
+        for position in mask.to_numpy().nonzero()[0][:MAX_REPORTED_ROW_ERRORS]:
+            row_errors.append({
+                'row': first_row + int(position),
+                'line': first_row + int(position) + 1,  # header is line 1
+                'error': message,
+                'value': None if message != 'Invalid label' else str(chunk['label'].iloc[position])
+            })
+
+    row_errors.sort(key=lambda error: error['row'])
+    return {
+        'df': pd.DataFrame({'text': chunk['text'], 'label': labels}),
+        'valid': ~(missing_text | missing_label | invalid_label),
+        'row_errors': row_errors[:MAX_REPORTED_ROW_ERRORS]
+    }
+
+def content_hash(text: str) -> str:
+    """Content hash used as the sample primary key"""
+    return hashlib.sha256(text.strip().encode('utf-8')).hexdigest()
+
+class TrainingCorpusStore:
+    """
+    Durable, deduplicated store of labeled training samples
+
+    Samples are keyed by the SHA-256 of their text, so appending is an
+    INSERT OR IGNORE and duplicates are dropped by the primary key index.
+    The train/test split is derived from the hash, which keeps it stable
+    as the corpus grows.
+    """
+
+    def __init__(self, db_path: str = TRAINING_CORPUS_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS samples (
+                hash TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                label INTEGER NOT NULL,
+                category TEXT,
+                source TEXT,
+                is_test INTEGER NOT NULL DEFAULT 0,
+                added_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def add_samples(self, samples: Iterable[Tuple[str, int]], source: str = 'upload',
+                    category: str = None) -> Dict[str, int]:
+        """
+        Append labeled samples, skipping any whose text is already stored
+
+        Args:
+            samples: Iterable of (text, label) pairs, label 0 or 1
+            source: Where the samples came from (e.g. 'upload', 'sample_dataset')
+            category: Optional category for all samples
+
+        Returns:
+            Dict with counts of added and duplicate samples
+        """
+        conn = self._connect()
+        try:
+            result = self._insert_samples(conn, samples, source, category)
+            conn.commit()
+        finally:
+            conn.close()
+        return result
+
+    def _insert_samples(self, conn: sqlite3.Connection, samples: Iterable[Tuple[str, int]],
+                        source: str, category: str = None) -> Dict[str, int]:
+        """Insert samples on an open connection without committing"""
+        now = time.time()
+        rows = []
+        for text, label in samples:
+            digest = content_hash(text)
+            is_test = int(int(digest[:8], 16) % TEST_SPLIT_MODULUS == 0)
+            rows.append((digest, text, int(label), category or ('spam' if int(label) == 1 else 'legitimate'),
+                         source, is_test, now))
+
+        before = conn.total_changes
+        conn.executemany(
+            'INSERT OR IGNORE INTO samples (hash, text, label, category, source, is_test, added_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        added = conn.total_changes - before
+
+        return {'added': added, 'duplicates': len(rows) - added}
+
+    @contextmanager
+    def bulk_writer(self, source: str = 'upload'):
+        """
+        Append many batches in one transaction
+
+        Yields a function taking a text/label dataframe and returning its
+        added/duplicate counts. Everything is committed when the block exits
+        normally and rolled back if it raises.
+        """
+        conn = self._connect()
+        try:
+            def write(df: pd.DataFrame) -> Dict[str, int]:
+                return self._insert_samples(conn, zip(df['text'].astype(str), df['label'].astype(int)), source)
+
+            yield write
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _write_valid(write, chunk: pd.DataFrame, first_row: int, totals: Dict[str, Any]):
+        """Normalize a chunk, write its valid rows and count the rest as dropped"""
+        validated = validate_csv_chunk(chunk, first_row)
+        valid = validated['valid']
+        counts = write(validated['df'][valid])
+        totals['added'] += counts['added']
+        totals['duplicates'] += counts['duplicates']
+        totals['dropped'] += int((~valid).sum())
+        remaining = MAX_REPORTED_ROW_ERRORS - len(totals['row_errors'])
+        totals['row_errors'].extend(validated['row_errors'][:remaining])
+
+    def add_dataframe(self, df: pd.DataFrame, source: str = 'upload') -> Dict[str, Any]:
+        """
+        Append the text/label columns of a dataframe
+
+        Labels are normalized like uploads (spam/ham, 1.0, true, ...); rows
+        with no text or an unrecognized label are skipped.
+
+        Returns:
+            Dict with added, duplicate and dropped counts and the first
+            dropped rows' errors
+        """
+        totals = {'added': 0, 'duplicates': 0, 'dropped': 0, 'row_errors': []}
+        with self.bulk_writer(source) as write:
+            self._write_valid(write, df, 1, totals)
+        return totals
+
+    def add_csv(self, csv_path: str, source: str = 'upload', chunksize: int = 50000) -> Dict[str, Any]:
+        """
+        Append a text/label CSV in fixed-size chunks
+
+        Rows are normalized and skipped as in add_dataframe. The whole file is
+        one transaction, so a CSV that fails part way adds nothing.
+
+        Returns:
+            Dict with added, duplicate and dropped counts and the first
+            dropped rows' errors
+        """
+        totals = {'added': 0, 'duplicates': 0, 'dropped': 0, 'row_errors': []}
+        with self.bulk_writer(source) as write:
+            reader = pd.read_csv(
+                csv_path,
+                usecols=['text', 'label'],
+                dtype={'text': str, 'label': str},
+                keep_default_na=False,
+                na_values=[''],
+                chunksize=chunksize
+            )
+            first_row = 1
+            for chunk in reader:
+                self._write_valid(write, chunk, first_row, totals)
+                first_row += len(chunk)
+        return totals
+
+    def count(self, source: str = None) -> int:
+        """Number of stored samples, optionally only those from one source"""
+        conn = self._connect()
+        if source:
+            total = conn.execute('SELECT COUNT(*) FROM samples WHERE source = ?', (source,)).fetchone()[0]
+        else:
+            total = conn.execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+        conn.close()
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        """Sample counts by label and split"""
+        conn = self._connect()
+        rows = conn.execute(
+            'SELECT label, is_test, COUNT(*) FROM samples GROUP BY label, is_test'
+        ).fetchall()
+        conn.close()
+
+        stats = {'total': 0, 'spam': 0, 'legitimate': 0, 'train': 0, 'test': 0}
+        for label, is_test, count in rows:
+            stats['total'] += count
+            stats['spam' if label == 1 else 'legitimate'] += count
+            stats['test' if is_test else 'train'] += count
+        return stats
+
+    def iter_samples(self, split: str = None, batch_size: int = 10000) -> Iterator[Tuple[str, int]]:
+        """
+        Stream (text, label) pairs from the store
+
+        Args:
+            split: 'train', 'test' or None for all samples
+            batch_size: Rows fetched per round trip
+        """
+        query = 'SELECT text, label FROM samples'
+        if split == 'train':
+            query += ' WHERE is_test = 0'
+        elif split == 'test':
+            query += ' WHERE is_test = 1'
+
+        conn = self._connect()
+        try:
+            cursor = conn.execute(query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def stream_split(self, split: str, labels: List[int]) -> Iterator[str]:
+        """
+        Stream texts of a split, appending each label to `labels` as it goes
+
+        Lets a vectorizer consume texts as a generator while the labels are
+        collected in the same order.
+        """
+        for text, label in self.iter_samples(split):
+            labels.append(label)
+            yield text
@@ -0,0 +1 @@
+# RAG server package
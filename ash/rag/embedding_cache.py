@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List
+
+import numpy as np
+
+# Configuration
+EMBEDDING_CACHE_PATH = os.getenv(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'data', 'embedding_cache.db')
+)  # empty = memory only
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 10000))  # in-memory entries
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_CHUNK = 500
+
+class EmbeddingCache:
+    """
+    Content-hash keyed embedding cache for one encoder model
+
+    An in-memory LRU sits in front of a SQLite table shared by every model;
+    rows are keyed by (model, sha1 of the text) and hold float16 vectors.
+    Fresh encodings are rounded through float16 as well, so a text gets the
+    same vector whether it came from the encoder, memory or disk.
+    """
+
+    def __init__(self, model_name: str, path: str = EMBEDDING_CACHE_PATH, max_size: int = EMBEDDING_CACHE_SIZE):
+        self.model_name = model_name
+        self.path = path
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('''
+                    CREATE TABLE IF NOT EXISTS embeddings (
+                        model TEXT NOT NULL,
+                        key BLOB NOT NULL,
+                        vector BLOB NOT NULL,
+                        PRIMARY KEY (model, key)
+                    ) WITHOUT ROWID
+                ''')
+                self._conn.commit()
+            except Exception as e:
+                print(f"Warning: Embedding cache database unavailable, caching in memory only: {e}")
+                self._conn = None
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        """Insert into the LRU (lock held)"""
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Read vectors from disk (lock held)"""
+        found = {}
+        if self._conn is None:
+            return found
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[start:start + LOOKUP_CHUNK]
+            rows = self._conn.execute(
+                f'SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({",".join("?" * len(chunk))})',
+                (self.model_name, *chunk)
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+        return found
+
+    def encode(self, texts: List[str], encoder: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Embeddings of texts, running the encoder only for texts never seen before
+
+        Args:
+            texts: Texts to embed
+            encoder: Batch encoder returning an (n, dim) array for a list of texts
+
+        Returns:
+            (len(texts), dim) float32 array
+        """
+        keys = [self._key(text) for text in texts]
+        vectors = {}
+
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    vectors[key] = vector
+
+            missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+            loaded = self._load(missing)
+            for key, vector in loaded.items():
+                self._remember(key, vector)
+            vectors.update(loaded)
+            disk_hits = sum(1 for key in keys if key in loaded)
+
+        # Encode each unseen text once, outside the lock
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                pending.setdefault(key, text)
+        if pending:
+            start = time.perf_counter()
+            encoded = np.asarray(encoder(list(pending.values())), dtype=np.float32)
+            elapsed = time.perf_counter() - start
+            half = encoded.astype(np.float16)
+            with self._lock:
+                self.encode_seconds += elapsed
+                for key, vector in zip(pending, half.astype(np.float32)):
+                    vectors[key] = vector
+                    self._remember(key, vector)
+                if self._conn is not None:
+                    try:
+                        self._conn.executemany(
+                            'INSERT OR IGNORE INTO embeddings (model, key, vector) VALUES (?, ?, ?)',
+                            [(self.model_name, key, row.tobytes()) for key, row in zip(pending, half)]
+                        )
+                        self._conn.commit()
+                    except Exception as e:
+                        print(f"Warning: Could not persist embeddings: {e}")
+
+        with self._lock:
+            # Repeats within one call were served from this call's encoding
+            self.memory_hits += len(keys) - disk_hits - len(pending)
+            self.disk_hits += disk_hits
+            self.misses += len(pending)
+
+        return np.stack([vectors[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit counts, hit rate and encoder time saved (estimated from the mean encode time per text)"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        seconds_per_text = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            'model': self.model_name,
+            'persistent': self._conn is not None,
+            'memory_entries': len(self._entries),
+            'max_size': self.max_size,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'encode_seconds': self.encode_seconds,
+            'saved_encode_seconds': hits * seconds_per_text
+        }
@@ -1,50 +1,78 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
-from qdrant_client.models import Filter, FieldCondition, Range, MatchValue
-from sentence_transformers import SentenceTransformer
 import uuid
 import os
-from typing import List, Dict, Any
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import List, Dict, Any, Iterable
 import json
+import numpy as np
+
+# Imported through the rag package, as api.rag_qdrant does, so the process
+# has one client registry whichever entry point loaded it first
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from rag.embedding_cache import EmbeddingCache
+from rag.vector_store import QdrantVectorStore, get_qdrant_client
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'models'))
+from model_daemon import load_encoder
+
+# Ingest: documents are encoded in chunks of QDRANT_UPSERT_BATCH_SIZE (the
+# encoder batches internally by QDRANT_ENCODE_BATCH_SIZE) and each chunk is
+# upserted without waiting for indexing on QDRANT_UPSERT_PARALLEL threads.
+# At most QDRANT_MAX_PENDING_UPSERTS chunks are in flight at a time.
+QDRANT_ENCODE_BATCH_SIZE = int(os.getenv('QDRANT_ENCODE_BATCH_SIZE', 64))
+QDRANT_UPSERT_BATCH_SIZE = int(os.getenv('QDRANT_UPSERT_BATCH_SIZE', 256))
+QDRANT_UPSERT_PARALLEL = int(os.getenv('QDRANT_UPSERT_PARALLEL', 4))
+QDRANT_MAX_PENDING_UPSERTS = int(os.getenv('QDRANT_MAX_PENDING_UPSERTS', 8))
+
+# Upper bound on the number of queries accepted by /search_batch
+QDRANT_MAX_BATCH_QUERIES = int(os.getenv('QDRANT_MAX_BATCH_QUERIES', 32))
 
 class QdrantRAGServer:
-    def __init__(self, host: str = "localhost", port: int = 6333):
-        self.client = QdrantClient(host=host, port=port)
-        self.encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, host: str = None, port: int = None, mode: str = None, path: str = None):
+        """
+        Args:
+            host, port: Qdrant server (QDRANT_MODE=remote)
+            mode: 'remote' or 'local' (default QDRANT_MODE)
+            path: Embedded storage directory or ':memory:' (QDRANT_MODE=local)
+        """
+        self.encoder_name = 'all-MiniLM-L6-v2'
+        # Shared copy from the model daemon when it is running, else loaded here
+        self.encoder = load_encoder(self.encoder_name)
+        # Repeated texts (scam scripts, common queries) skip the transformer
+        self.embedding_cache = EmbeddingCache(self.encoder_name)
         self.collection_name = "spam_detection_rag"
         self.vector_size = 384  # all-MiniLM-L6-v2 embedding size
         
-        # Initialize collection
-        self._setup_collection()
+        # Initialize collection (created or migrated to the configured layout)
+        self.store = QdrantVectorStore(
+            self.collection_name,
+            self.vector_size,
+            client=get_qdrant_client(mode=mode, host=host, port=port, path=path)
+        )
+        self.client = self.store.client
     
-    def _setup_collection(self):
-        """Setup Qdrant collection if it doesn't exist"""
-        try:
-            # Check if collection exists
-            collections = self.client.get_collections()
-            collection_exists = any(col.name == self.collection_name for col in collections.collections)
-            
-            if not collection_exists:
-                self.client.create_collection(
-                    collection_name=self.collection_name,
-                    vectors_config=VectorParams(
-                        size=self.vector_size,
-                        distance=Distance.COSINE
-                    )
-                )
-                print(f"Created collection: {self.collection_name}")
-            else:
-                print(f"Collection {self.collection_name} already exists")
-                
-        except Exception as e:
-            print(f"Error setting up collection: {e}")
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts through the embedding cache, in batched forward passes"""
+        return self.embedding_cache.encode(texts, lambda batch: self.encoder.encode(
+            batch,
+            batch_size=QDRANT_ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ))
     
-    def add_documents(self, documents: List[str], category: str, metadata: Dict[str, Any] = None) -> bool:
+    def add_documents(self, documents: Iterable[str], category: str, metadata: Dict[str, Any] = None) -> bool:
         """
         Add documents to the RAG database
         
+        Documents are consumed lazily and encoded a chunk at a time; each chunk
+        is upserted with wait=False on a thread pool while the next one is
+        encoded. Once QDRANT_MAX_PENDING_UPSERTS chunks are in flight, encoding
+        waits for the oldest, so memory stays flat for any number of documents.
+        
         Args:
-            documents: List of text documents to add
+            documents: Text documents to add (a list or any iterable, e.g. a file reader)
             category: Category for the documents ('user_information', 'suspects', 'call_history')
             metadata: Additional metadata for the documents
         
@@ -52,42 +80,48 @@ class QdrantRAGServer:
             bool: Success status
         """
         try:
-            points = []
+            documents = iter(documents)
+            count = 0
+            pending = deque()
             
-            for i, doc in enumerate(documents):
-                # Generate embedding
-                embedding = self.encoder.encode(doc).tolist()
-                
-                # Create point
-                point_id = str(uuid.uuid4())
-                payload = {
-                    "text": doc,
-                    "category": category,
-                    "doc_index": i,
-                    **(metadata or {})
-                }
+            with ThreadPoolExecutor(max_workers=QDRANT_UPSERT_PARALLEL) as executor:
+                while True:
+                    chunk = list(islice(documents, QDRANT_UPSERT_BATCH_SIZE))
+                    if not chunk:
+                        break
+                    
+                    # Generate embeddings for the whole chunk in batched forward passes
+                    embeddings = self._encode(chunk)
+                    
+                    ids = [str(uuid.uuid4()) for _ in chunk]
+                    payloads = [
+                        {
+                            "text": doc,
+                            "category": category,
+                            "doc_index": count + i,
+                            **(metadata or {})
+                        }
+                        for i, doc in enumerate(chunk)
+                    ]
+                    count += len(chunk)
+                    
+                    # Backpressure: wait for the oldest upload before queueing another
+                    while len(pending) >= QDRANT_MAX_PENDING_UPSERTS:
+                        pending.popleft().result()
+                    pending.append(executor.submit(self.store.upsert, ids, embeddings, payloads, wait=False))
                 
-                point = PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload=payload
-                )
-                points.append(point)
-            
-            # Upload points
-            self.client.upsert(
-                collection_name=self.collection_name,
-                points=points
-            )
+                # Surface upload errors
+                while pending:
+                    pending.popleft().result()
             
-            print(f"Added {len(documents)} documents with category '{category}'")
+            print(f"Added {count} documents with category '{category}'")
             return True
             
         except Exception as e:
             print(f"Error adding documents: {e}")
             return False
     
-    def search_documents(self, query: str, category: str = None, top_k: int = 5) -> List[Dict[str, Any]]:
+    def search_documents(self, query: str, category: str = None, top_k: int = 5, phone_number: str = None) -> List[Dict[str, Any]]:
         """
         Search for relevant documents
         
@@ -95,62 +129,80 @@ class QdrantRAGServer:
             query: Search query
             category: Filter by category (optional)
             top_k: Number of results to return
+            phone_number: Filter by the phone_number metadata field (optional)
         
         Returns:
             List of relevant documents with scores
         """
         try:
             # Generate query embedding
-            query_embedding = self.encoder.encode(query).tolist()
-            
-            # Prepare filter
-            query_filter = None
-            if category:
-                query_filter = Filter(
-                    must=[
-                        FieldCondition(
-                            key="category",
-                            match=MatchValue(value=category)
-                        )
-                    ]
-                )
+            query_embedding = self._encode([query])[0]
             
             # Search
-            search_results = self.client.search(
-                collection_name=self.collection_name,
-                query_vector=query_embedding,
-                query_filter=query_filter,
-                limit=top_k
+            search_results = self.store.search(
+                query_embedding,
+                top_k=top_k,
+                filters={"category": category or None, "phone_number": phone_number or None}
             )
             
-            # Format results
-            results = []
-            for result in search_results:
-                results.append({
-                    "text": result.payload.get("text", ""),
-                    "category": result.payload.get("category", ""),
-                    "score": result.score,
-                    "metadata": {k: v for k, v in result.payload.items() 
-                               if k not in ["text", "category"]}
-                })
-            
-            return results
+            return self._format_results(search_results)
             
         except Exception as e:
             print(f"Error searching documents: {e}")
             return []
     
+    def search_documents_batch(self, queries: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """
+        Run several searches with one encode call and one Qdrant request
+        
+        Args:
+            queries: Search specs, each with 'query' and optional 'category',
+                'phone_number' and 'top_k' (default 5)
+        
+        Returns:
+            One result list per query, in request order
+        """
+        if not queries:
+            return []
+        
+        try:
+            # One batched forward pass for every query text
+            embeddings = self._encode([spec['query'] for spec in queries])
+            
+            # One Qdrant request; results come back in request order
+            batch_results = self.store.search_batch([
+                {
+                    "vector": embedding,
+                    "top_k": spec.get('top_k', 5),
+                    "filters": {"category": spec.get('category') or None,
+                                "phone_number": spec.get('phone_number') or None}
+                }
+                for spec, embedding in zip(queries, embeddings)
+            ])
+            
+            return [self._format_results(search_results) for search_results in batch_results]
+            
+        except Exception as e:
+            print(f"Error batch searching documents: {e}")
+            return [[] for _ in queries]
+    
+    def _format_results(self, search_results) -> List[Dict[str, Any]]:
+        """Convert vector store hits into result dicts"""
+        results = []
+        for result in search_results:
+            results.append({
+                "text": result.payload.get("text", ""),
+                "category": result.payload.get("category", ""),
+                "score": result.score,
+                "metadata": {k: v for k, v in result.payload.items() 
+                           if k not in ["text", "category"]}
+            })
+        return results
+    
     def get_collection_info(self) -> Dict[str, Any]:
         """Get information about the collection"""
         try:
-            info = self.client.get_collection(self.collection_name)
-            return {
-                "name": info.config.name,
-                "vector_size": info.config.params.vectors.size,
-                "distance": info.config.params.vectors.distance,
-                "points_count": info.points_count,
-                "status": info.status
-            }
+            return self.store.info()
         except Exception as e:
             print(f"Error getting collection info: {e}")
             return {}
@@ -158,19 +210,7 @@ class QdrantRAGServer:
     def delete_documents_by_category(self, category: str) -> bool:
         """Delete all documents of a specific category"""
         try:
-            filter_condition = Filter(
-                must=[
-                    FieldCondition(
-                        key="category",
-                        match=MatchValue(value=category)
-                    )
-                ]
-            )
-            
-            self.client.delete(
-                collection_name=self.collection_name,
-                points_selector=filter_condition
-            )
+            self.store.delete_where({"category": category})
             
             print(f"Deleted documents with category '{category}'")
             return True
@@ -188,17 +228,16 @@ if __name__ == "__main__":
     CORS(app)
     
     # Initialize RAG server
-    rag_server = QdrantRAGServer(
-        host=os.getenv('QDRANT_HOST', 'localhost'),
-        port=int(os.getenv('QDRANT_PORT', 6333))
-    )
+    # Connects to QDRANT_HOST:QDRANT_PORT, or embeds Qdrant with QDRANT_MODE=local
+    rag_server = QdrantRAGServer()
     
     @app.route('/health', methods=['GET'])
     def health():
         return jsonify({
             'status': 'healthy',
             'service': 'qdrant-rag-server',
-            'collection_info': rag_server.get_collection_info()
+            'collection_info': rag_server.get_collection_info(),
+            'embedding_cache': rag_server.embedding_cache.stats()
         })
     
     @app.route('/add_documents', methods=['POST'])
@@ -241,6 +280,7 @@ if __name__ == "__main__":
         {
             "query": "search text",
             "category": "user_information", (optional)
+            "phone_number": "+15551234567", (optional)
             "top_k": 5
         }
         """
@@ -248,23 +288,74 @@ if __name__ == "__main__":
             data = request.get_json()
             query = data.get('query', '')
             category = data.get('category')
+            phone_number = data.get('phone_number')
             top_k = data.get('top_k', 5)
             
             if not query:
                 return jsonify({'error': 'Query is required'}), 400
             
-            results = rag_server.search_documents(query, category, top_k)
+            results = rag_server.search_documents(query, category, top_k, phone_number)
             
             return jsonify({
                 'results': results,
                 'query': query,
                 'category': category,
+                'phone_number': phone_number,
                 'count': len(results)
             })
             
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
+    @app.route('/search_batch', methods=['POST'])
+    def search_batch():
+        """
+        Run several searches in one request
+        
+        Expected JSON:
+        {
+            "queries": [
+                {"query": "search text", "category": "user_information", "top_k": 3},
+                {"query": "search text", "category": "suspects", "phone_number": "+15551234567"},
+                ...
+            ]
+        }
+        
+        Returns one entry per query, in request order
+        """
+        try:
+            data = request.get_json()
+            queries = data.get('queries', [])
+            
+            if not isinstance(queries, list) or not queries:
+                return jsonify({'error': 'Queries list is required'}), 400
+            if len(queries) > QDRANT_MAX_BATCH_QUERIES:
+                return jsonify({'error': f'At most {QDRANT_MAX_BATCH_QUERIES} queries per batch'}), 400
+            for i, spec in enumerate(queries):
+                if not isinstance(spec, dict) or not spec.get('query'):
+                    return jsonify({'error': f'Query is required (queries[{i}])'}), 400
+                if not isinstance(spec.get('top_k', 5), int) or spec.get('top_k', 5) < 1:
+                    return jsonify({'error': f'top_k must be a positive integer (queries[{i}])'}), 400
+            
+            batch_results = rag_server.search_documents_batch(queries)
+            
+            return jsonify({
+                'results': [
+                    {
+                        'results': results,
+                        'query': spec['query'],
+                        'category': spec.get('category'),
+                        'phone_number': spec.get('phone_number'),
+                        'count': len(results)
+                    }
+                    for spec, results in zip(queries, batch_results)
+                ],
+                'count': len(batch_results)
+            })
+            
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+    
     @app.route('/collection/info', methods=['GET'])
     def collection_info():
         """Get collection information"""
@@ -0,0 +1,359 @@
+import abc
+import contextlib
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client.models import Filter, FieldCondition, MatchValue, HasIdCondition
+from qdrant_client.models import PayloadSchemaType, VectorParamsDiff, Disabled
+from qdrant_client.models import ScalarQuantization, ScalarQuantizationConfig, ScalarType
+from qdrant_client.models import SearchParams, QuantizationSearchParams, SearchRequest
+
+# Where Qdrant runs: 'remote' connects to QDRANT_HOST:QDRANT_PORT, 'local'
+# runs qdrant-client's embedded engine in-process, in memory
+# (QDRANT_LOCAL_PATH=:memory:) or persisted to a directory
+QDRANT_MODE = os.getenv('QDRANT_MODE', 'remote').lower()
+QDRANT_HOST = os.getenv('QDRANT_HOST', 'localhost')
+QDRANT_PORT = int(os.getenv('QDRANT_PORT', 6333))
+QDRANT_LOCAL_PATH = os.getenv('QDRANT_LOCAL_PATH', ':memory:')
+
+# Collection layout, applied to new collections and migrated onto existing ones
+# at startup. Filtered payload fields get keyword indexes; with int8
+# quantization the quantized vectors stay in RAM and candidates are rescored
+# against the originals, which QDRANT_ON_DISK_VECTORS can move to disk. The
+# embedded engine has no payload indexes or quantization and skips both.
+QDRANT_PAYLOAD_INDEX_FIELDS = [
+    field.strip() for field in os.getenv('QDRANT_PAYLOAD_INDEX_FIELDS', 'category,phone_number').split(',')
+    if field.strip()
+]
+QDRANT_QUANTIZATION = os.getenv('QDRANT_QUANTIZATION', 'none').lower()  # none | int8
+QDRANT_QUANTIZATION_QUANTILE = float(os.getenv('QDRANT_QUANTIZATION_QUANTILE', 0.99))
+QDRANT_RESCORE = os.getenv('QDRANT_RESCORE', 'true').lower() == 'true'
+QDRANT_OVERSAMPLING = float(os.getenv('QDRANT_OVERSAMPLING', 2.0))
+QDRANT_ON_DISK_VECTORS = os.getenv('QDRANT_ON_DISK_VECTORS', 'false').lower() == 'true'
+
+# The embedded engine locks its directory, so every store in the process
+# shares one client per location (import this module as rag.vector_store
+# only, or a second copy would open its own clients). Calls into an embedded client are
+# serialized on its lock (id(client) -> RLock); a server handles its own
+# concurrency.
+_clients = {}
+_local_locks = {}
+_clients_lock = threading.Lock()
+
+def get_qdrant_client(mode: str = None, host: str = None, port: int = None, path: str = None) -> QdrantClient:
+    """
+    Shared Qdrant client for the configured mode
+
+    Args:
+        mode: 'remote' or 'local' (default QDRANT_MODE)
+        host: Remote host (default QDRANT_HOST)
+        port: Remote port (default QDRANT_PORT)
+        path: Local storage directory or ':memory:' (default QDRANT_LOCAL_PATH)
+    """
+    mode = (mode or QDRANT_MODE).lower()
+    if mode == 'local':
+        path = path or QDRANT_LOCAL_PATH
+        key = ('local', path if path == ':memory:' else os.path.abspath(path))
+    elif mode == 'remote':
+        key = ('remote', host or QDRANT_HOST, port or QDRANT_PORT)
+    else:
+        raise ValueError(f"Unknown QDRANT_MODE '{mode}', expected 'remote' or 'local'")
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if key[0] == 'remote':
+                client = QdrantClient(host=key[1], port=key[2])
+            elif key[1] == ':memory:':
+                client = QdrantClient(location=':memory:')
+            else:
+                os.makedirs(key[1], exist_ok=True)
+                client = QdrantClient(path=key[1])
+            if key[0] == 'local':
+                _local_locks[id(client)] = threading.RLock()
+            _clients[key] = client
+        return client
+
+def collection_exists(name: str, client: QdrantClient = None) -> bool:
+    client = client or get_qdrant_client()
+    with _local_locks.get(id(client)) or contextlib.nullcontext():
+        return any(col.name == name for col in client.get_collections().collections)
+
+class VectorHit(NamedTuple):
+    """One search result"""
+    id: Any
+    score: float
+    payload: Dict[str, Any]
+
+class VectorStore(abc.ABC):
+    """
+    Collection of vectors with payloads, searched by cosine similarity
+
+    Filters are exact-match field/value pairs on the payload. Implemented by
+    QdrantVectorStore against a Qdrant server or the embedded engine; the
+    Qdrant RAG server and the local RAG store's dense backend use it.
+    """
+
+    @abc.abstractmethod
+    def upsert(self, ids: List[Any], vectors: np.ndarray, payloads: List[Dict[str, Any]] = None,
+               wait: bool = True):
+        """Insert or replace points (wait=False returns before they are indexed)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search(self, vector: np.ndarray, top_k: int = 5, filters: Dict[str, Any] = None,
+               ids: List[Any] = None, min_score: float = None) -> List[VectorHit]:
+        """Nearest points, best first, optionally restricted by payload values and/or point ids"""
+        raise NotImplementedError
+
+    def search_batch(self, queries: List[Dict[str, Any]]) -> List[List[VectorHit]]:
+        """Several searches in one request; each dict holds search() arguments. Results in order."""
+        return [self.search(**query) for query in queries]
+
+    @abc.abstractmethod
+    def retrieve(self, ids: List[Any]) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """Stored vectors and payloads of points, in the order given"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, ids: List[Any]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_where(self, filters: Dict[str, Any]):
+        """Delete every point whose payload matches filters"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def info(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def drop(self):
+        """Delete the whole collection"""
+        raise NotImplementedError
+
+class QdrantVectorStore(VectorStore):
+    """VectorStore over one Qdrant collection (remote or embedded)"""
+
+    def __init__(self, collection_name: str, vector_size: int, client: QdrantClient = None,
+                 payload_index_fields: List[str] = None):
+        self.client = client or get_qdrant_client()
+        self.collection_name = collection_name
+        self.vector_size = vector_size
+        self._lock = _local_locks.get(id(self.client)) or contextlib.nullcontext()
+        self.local = id(self.client) in _local_locks
+        self.payload_index_fields = QDRANT_PAYLOAD_INDEX_FIELDS if payload_index_fields is None \
+            else payload_index_fields
+
+        self.setup()
+
+    # ---------- collection layout ----------
+
+    def setup(self):
+        """Create the collection if it doesn't exist, else migrate it to the configured layout"""
+        with self._lock:
+            self._setup()
+
+    def _setup(self):
+        try:
+            collections = self.client.get_collections()
+            collection_exists = any(col.name == self.collection_name for col in collections.collections)
+
+            if not collection_exists:
+                self.client.create_collection(
+                    collection_name=self.collection_name,
+                    vectors_config=VectorParams(
+                        size=self.vector_size,
+                        distance=Distance.COSINE,
+                        on_disk=QDRANT_ON_DISK_VECTORS
+                    ),
+                    quantization_config=None if self.local else self._quantization_config()
+                )
+                print(f"Created collection: {self.collection_name}")
+            else:
+                print(f"Collection {self.collection_name} already exists")
+                if not self.local:
+                    self._migrate_collection()
+
+            if not self.local:
+                self._ensure_payload_indexes()
+
+        except Exception as e:
+            print(f"Error setting up collection: {e}")
+
+    def _quantization_config(self):
+        """Quantization settings from the environment (None when disabled)"""
+        if QDRANT_QUANTIZATION == 'int8':
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(
+                    type=ScalarType.INT8,
+                    quantile=QDRANT_QUANTIZATION_QUANTILE,
+                    always_ram=True
+                )
+            )
+        if QDRANT_QUANTIZATION != 'none':
+            print(f"Warning: Unknown QDRANT_QUANTIZATION '{QDRANT_QUANTIZATION}', quantization disabled")
+        return None
+
+    def _migrate_collection(self):
+        """
+        Bring an existing collection in line with the configured vector storage
+        and quantization. Qdrant applies the change in place and rebuilds
+        segments in the background; searches keep working meanwhile.
+        """
+        info = self.client.get_collection(self.collection_name)
+        vectors = info.config.params.vectors
+        current_on_disk = bool(getattr(vectors, 'on_disk', False))
+        current_quantization = info.config.quantization_config
+        wanted_quantization = self._quantization_config()
+
+        changes = {}
+        if current_on_disk != QDRANT_ON_DISK_VECTORS:
+            # The collection uses a single unnamed vector
+            changes['vectors_config'] = {'': VectorParamsDiff(on_disk=QDRANT_ON_DISK_VECTORS)}
+        if wanted_quantization is None and current_quantization is not None:
+            changes['quantization_config'] = Disabled.DISABLED
+        elif wanted_quantization is not None and current_quantization != wanted_quantization:
+            changes['quantization_config'] = wanted_quantization
+
+        if changes:
+            self.client.update_collection(collection_name=self.collection_name, **changes)
+            print(f"Migrated collection {self.collection_name}: {', '.join(sorted(changes))}")
+
+    def _ensure_payload_indexes(self):
+        """Create keyword indexes for filtered payload fields that lack one"""
+        info = self.client.get_collection(self.collection_name)
+        indexed = set((info.payload_schema or {}).keys())
+        for field in self.payload_index_fields:
+            if field not in indexed:
+                self.client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field,
+                    field_schema=PayloadSchemaType.KEYWORD
+                )
+                print(f"Created payload index on '{field}'")
+
+    # ---------- queries ----------
+
+    @staticmethod
+    def _build_filter(filters: Dict[str, Any] = None, ids: List[Any] = None):
+        """Payload filter for a search (served by the keyword payload indexes)"""
+        conditions = [
+            FieldCondition(key=field, match=MatchValue(value=value))
+            for field, value in (filters or {}).items()
+            if value is not None
+        ]
+        if ids is not None:
+            conditions.append(HasIdCondition(has_id=list(ids)))
+        return Filter(must=conditions) if conditions else None
+
+    def _search_params(self):
+        """Quantized search oversamples candidates and rescores them with the original vectors"""
+        if self.local or QDRANT_QUANTIZATION != 'int8':
+            return None
+        return SearchParams(
+            quantization=QuantizationSearchParams(
+                rescore=QDRANT_RESCORE,
+                oversampling=QDRANT_OVERSAMPLING
+            )
+        )
+
+    @staticmethod
+    def _hits(points) -> List[VectorHit]:
+        return [VectorHit(point.id, point.score, point.payload or {}) for point in points]
+
+    def upsert(self, ids: List[Any], vectors: np.ndarray, payloads: List[Dict[str, Any]] = None,
+               wait: bool = True):
+        payloads = payloads or [{} for _ in ids]
+        points = [
+            PointStruct(id=point_id, vector=np.asarray(vector, dtype=np.float32).tolist(), payload=payload)
+            for point_id, vector, payload in zip(ids, vectors, payloads)
+        ]
+        with self._lock:
+            self.client.upsert(collection_name=self.collection_name, points=points, wait=wait)
+
+    def search(self, vector: np.ndarray, top_k: int = 5, filters: Dict[str, Any] = None,
+               ids: List[Any] = None, min_score: float = None) -> List[VectorHit]:
+        query_filter = self._build_filter(filters, ids)
+        with self._lock:
+            points = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=np.asarray(vector, dtype=np.float32).tolist(),
+                query_filter=query_filter,
+                search_params=self._search_params(),
+                score_threshold=min_score,
+                limit=top_k
+            )
+        return self._hits(points)
+
+    def search_batch(self, queries: List[Dict[str, Any]]) -> List[List[VectorHit]]:
+        search_params = self._search_params()
+        requests = [
+            SearchRequest(
+                vector=np.asarray(query['vector'], dtype=np.float32).tolist(),
+                filter=self._build_filter(query.get('filters'), query.get('ids')),
+                params=search_params,
+                score_threshold=query.get('min_score'),
+                limit=query.get('top_k', 5),
+                with_payload=True
+            )
+            for query in queries
+        ]
+        # Qdrant answers a batch in request order
+        with self._lock:
+            batch = self.client.search_batch(collection_name=self.collection_name, requests=requests)
+        return [self._hits(points) for points in batch]
+
+    def retrieve(self, ids: List[Any]) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        with self._lock:
+            points = self.client.retrieve(
+                collection_name=self.collection_name,
+                ids=list(ids),
+                with_payload=True,
+                with_vectors=True
+            )
+        points = {point.id: point for point in points}
+        vectors = np.asarray([points[point_id].vector for point_id in ids], dtype=np.float32)
+        return vectors.reshape(-1, self.vector_size), [points[point_id].payload or {} for point_id in ids]
+
+    def delete(self, ids: List[Any]):
+        if ids:
+            # By filter: the embedded engine raises on ids it doesn't hold
+            with self._lock:
+                self.client.delete(collection_name=self.collection_name, points_selector=self._build_filter(ids=ids))
+
+    def delete_where(self, filters: Dict[str, Any]):
+        with self._lock:
+            self.client.delete(collection_name=self.collection_name, points_selector=self._build_filter(filters))
+
+    def count(self) -> int:
+        with self._lock:
+            return self.client.count(collection_name=self.collection_name, exact=True).count
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            info = self.client.get_collection(self.collection_name)
+        return {
+            "name": self.collection_name,
+            "mode": 'local' if self.local else 'remote',
+            "vector_size": info.config.params.vectors.size,
+            "distance": info.config.params.vectors.distance,
+            "points_count": info.points_count,
+            "status": info.status,
+            "on_disk_vectors": bool(getattr(info.config.params.vectors, 'on_disk', False)),
+            "quantization": "int8" if getattr(info.config.quantization_config, 'scalar', None) else "none",
+            "payload_indexes": sorted((info.payload_schema or {}).keys())
+        }
+
+    def drop(self):
+        with self._lock:
+            self.client.delete_collection(self.collection_name)
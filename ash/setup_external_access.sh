@@ -55,7 +55,8 @@ echo "   # Install gunicorn for production:"
 echo "   pip install gunicorn"
 echo ""
 echo "   # Run with gunicorn (production):"
-echo "   gunicorn -w 4 -b 0.0.0.0:5000 app:create_app()"
+echo "   # (WEB_CONCURRENCY sets the worker count and sizes torch threads per worker)"
+echo "   WEB_CONCURRENCY=4 gunicorn --workers 4 -b 0.0.0.0:5000 app:create_app()"
 echo ""
 echo "   # Or use systemd service (recommended):"
 echo "   sudo cp spam-detection.service /etc/systemd/system/"
@@ -203,6 +203,24 @@ def test_rag_functions():
     else:
         print(f"❌ Call history query failed: {result['error']}")
     
+    # Test several lookups in one batch against the RAG server
+    batch_query = {
+        "queries": [
+            {"query": "John Smith contact preferences", "category": "user_information", "top_k": 3},
+            {"query": "IRS scam calls", "category": "suspects", "phone_number": "+1234567890"},
+            {"query": "calls from suspicious numbers", "category": "call_history"}
+        ]
+    }
+    
+    result = test_endpoint(f"{RAG_SERVER_URL}/search_batch", "POST", batch_query)
+    
+    if result["success"]:
+        response = result["response"]
+        counts = [entry.get('count', 0) for entry in response.get('results', [])]
+        print(f"✅ Batch search: {len(counts)} queries, results per query {counts}")
+    else:
+        print(f"❌ Batch search failed: {result['error']}")
+    
     print()
 
 def test_training_functions():
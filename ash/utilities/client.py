@@ -91,6 +91,21 @@ class SpamDetectionClient:
         data = {"query": query, "top_k": top_k}
         return self._make_request("/api/rag/search_all", "POST", data)
     
+    def lookup_documents(self, metadata: Dict, category: str = None, limit: int = 100) -> Dict:
+        """Get documents whose metadata matches exactly (e.g. {"phone_number": ...})"""
+        data = {"metadata": metadata, "category": category, "limit": limit}
+        return self._make_request("/api/rag/lookup", "POST", data)
+    
+    def delete_documents(self, ids: List[int]) -> Dict:
+        """Delete RAG documents by id"""
+        data = {"ids": ids}
+        return self._make_request("/api/rag/delete_documents", "POST", data)
+    
+    def update_document(self, doc_id: int, **fields) -> Dict:
+        """Replace title, content, category and/or metadata of a RAG document"""
+        data = {"id": doc_id, **fields}
+        return self._make_request("/api/rag/update_document", "POST", data)
+    
     def post_suspect_information(self, documents: List[str], metadata: Dict = None) -> Dict:
         """Add suspect information to RAG storage"""
         data = {"documents": documents, "metadata": metadata or {}}
@@ -101,6 +116,11 @@ class SpamDetectionClient:
         data = {"documents": documents, "metadata": metadata or {}}
         return self._make_request("/api/rag/add_user_documents", "POST", data)
     
+    def bulk_add_documents(self, documents: List[Dict]) -> Dict:
+        """Add many documents ({"content", "title", "category", "metadata"}) in batches"""
+        data = {"documents": documents}
+        return self._make_request("/api/rag/bulk_add", "POST", data)
+    
     # ==================== TRAINING FUNCTIONS ====================
     
     def add_training_samples(self, samples: List[Dict]) -> Dict:
@@ -108,6 +128,14 @@ class SpamDetectionClient:
         data = {"samples": samples}
         return self._make_request("/api/training/add_training_samples", "POST", data)
     
+    def get_training_job(self, job_id: str) -> Dict:
+        """Get status, progress and metrics of a training job"""
+        return self._make_request(f"/api/training/jobs/{job_id}")
+    
+    def get_training_job_logs(self, job_id: str, after: int = 0) -> Dict:
+        """Get log lines of a training job"""
+        return self._make_request(f"/api/training/jobs/{job_id}/logs?after={after}")
+    
     def download_sample_csv(self) -> str:
         """Download sample training CSV content"""
         try: